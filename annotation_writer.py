@@ -0,0 +1,99 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json, os
+
+class StreamingAnnotationWriter:
+    # Writes the annotations of every image to a JSON lines file as soon as the image is done, instead
+    # of keeping all of them in memory until the end of the rendering.
+    # The first line holds the header ('info', 'licenses' and 'categories'), every other line holds
+    # the image metadata, the annotations and the scene description of one image.
+
+    def __init__(self, path: str, header: dict):
+        self.path = path
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "a")
+        if new_file:
+            self.write_line({"header" : header})
+
+    def write_line(self, record: dict):
+        self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.file.flush()
+
+    def write_image(self, image: dict, annotations: list, scene: dict):
+        self.write_line({
+            "image" : image,
+            "annotations" : annotations,
+            "scene" : scene
+        })
+
+    def tell(self) -> int:
+        # Returns the size of the file written so far
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+def iter_records(path: str):
+    # Yields the image records of a JSON lines annotations file, skipping the header
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            record = json.loads(line)
+            if "header" not in record:
+                yield record
+
+def read_header(path: str) -> dict:
+    with open(path, "r") as f:
+        return json.loads(f.readline())["header"]
+
+def write_coco(out_path: str, header: dict, sections: dict):
+    # Writes a COCO style JSON file one element at a time, so the whole dataset is never in memory
+    # Args:
+    # - out_path (str): path of the JSON file
+    # - header (dict): values written as they are (e.g. 'info', 'licenses', 'categories')
+    # - sections (dict): name of each list (e.g. 'images') -> function returning an iterator on its elements
+    tmp_path = f"{out_path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write("{")
+        first_key = True
+        for key, value in header.items():
+            f.write(f"{'' if first_key else ', '}{json.dumps(key)}: {json.dumps(value)}")
+            first_key = False
+
+        for key, get_elements in sections.items():
+            f.write(f"{'' if first_key else ', '}{json.dumps(key)}: [")
+            first_key = False
+            for i, element in enumerate(get_elements()):
+                f.write(f"{'' if i == 0 else ', '}{json.dumps(element)}")
+            f.write("]")
+        f.write("}")
+
+    os.replace(tmp_path, out_path)
+
+def assemble_annotations(jsonl_path: str, out_path: str):
+    # Builds the COCO style annotations file from a JSON lines annotations file, the lines file is read
+    # once for every section so memory usage does not depend on the number of images
+    header = read_header(jsonl_path)
+    write_coco(out_path, header, {
+        "images" : lambda: (record["image"] for record in iter_records(jsonl_path)),
+        "annotations" : lambda: (ann for record in iter_records(jsonl_path) for ann in record["annotations"]),
+        "scenes" : lambda: (record["scene"] for record in iter_records(jsonl_path))
+    })
@@ -0,0 +1,100 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os, time
+import bpy #type: ignore
+
+class AssetCache:
+    # Loads every shape file only once and keeps the loaded object as a hidden template, new
+    # objects are created by copying the template instead of appending the file again.
+    # Templates are never linked to a scene, so they are not rendered.
+
+    def __init__(self):
+        self.templates = {} #(filepath, name) -> template object
+        self.stats = {} #(filepath, name) -> {"hits", "misses", "load_time"}
+
+    def get_template(self, shape_dir: str, shape_rule: dict):
+        # Returns the template object of a shape, loading its file if needed
+        # Args:
+        # - shape_dir (str): directory in which the shape file is stored
+        # - shape_rule (dict): rule of the shape
+        filepath = os.path.abspath(os.path.join(shape_dir, shape_rule["file"]))
+        name = shape_rule["name"]
+        key = (filepath, name)
+        stats = self.stats.setdefault(key, {"hits" : 0, "misses" : 0, "load_time" : 0})
+
+        template = self.templates.get(key, None)
+        if template is not None:
+            stats["hits"] += 1
+            return template
+
+        stats["misses"] += 1
+        start_time = time.time()
+        with bpy.data.libraries.load(filepath, link=False) as (data_from, data_to):
+            if name not in data_from.objects:
+                raise Exception(f"Could not find object '{name}' in file: {filepath}")
+            data_to.objects = [name]
+        stats["load_time"] += time.time() - start_time
+
+        template = data_to.objects[0]
+        template.name = f"TEMPLATE_{name}"
+        if template.type == "MESH" and len(template.data.materials) == 0: #materials are linked to the objects
+            template.data.materials.append(None)
+        template.use_fake_user = True #keep the template even if it has no users
+        self.templates[key] = template
+
+        return template
+
+    def instantiate(self, shape_dir: str, shape_rule: dict, obj_name: str, collection=None):
+        # Creates a new object from the template of a shape and links it to a collection
+        # NOTE: The mesh is shared with the template, transformations and materials are set on the object
+        #       (see 'DatasetRenderer.try_shape_placement' and 'DatasetRenderer.finish_shape').
+        # Args:
+        # - shape_dir (str): directory in which the shape file is stored
+        # - shape_rule (dict): rule of the shape
+        # - obj_name (str): name of the new object
+        # - collection: collection to link the object to, if None the active one is used
+        template = self.get_template(shape_dir, shape_rule)
+
+        obj = template.copy()
+        obj.use_fake_user = False
+        obj.name = obj_name
+
+        if collection is None:
+            collection = bpy.context.collection
+        collection.objects.link(obj)
+
+        return obj
+
+    def get_stats(self) -> dict:
+        # Returns hits, misses and load time of every asset, keyed by '<file>:<object name>'
+        return {
+            f"{os.path.basename(filepath)}:{name}" : dict(stats)
+            for (filepath, name), stats in self.stats.items()
+        }
+
+    def print_stats(self):
+        stats = self.get_stats()
+        if len(stats) == 0:
+            return
+
+        print("Asset cache:")
+        for asset, asset_stats in stats.items():
+            print(f"  {asset} - hits: {asset_stats['hits']} - misses: {asset_stats['misses']} - " +
+                  f"load time: {asset_stats['load_time']:.3f}s")
@@ -0,0 +1,177 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import hashlib, json, os, random, subprocess, tempfile, time
+import numpy as np
+import bpy #type:ignore
+from SSHAPE_Dataset_generator.configure_gpus import set_render_args, benchmark, load_render_profile
+from SSHAPE_Dataset_generator.checkpoint import write_json_atomic
+from SSHAPE_Dataset_generator.utils import change_args, get_group_args, get_pinning
+
+CALIBRATION_CACHE_VERSION = 1
+BENCHMARK_FILES = [f"benchmark_files/benchmark_{i}.blend" for i in range(1, 11)]
+CALIBRATION_SEED = 0 #every group renders the same scenes
+
+def get_render_settings(args, group: list) -> dict:
+    # Returns the render settings which affect the time taken by a group of devices
+    group_args = get_group_args(group)
+    return {
+        "engine" : args.render_engine,
+        "resolution" : [args.images_width, args.images_height],
+        "preview_scale" : None if args.render_engine == "CYCLES" else args.preview_scale,
+        "profile" : load_render_profile(args.render_profile, args.render_profiles_file, group_args["device_type"]),
+        "threads" : group_args.get("cpu_threads", args.cpu_threads)
+    }
+
+def get_workload(args, rules) -> dict:
+    # Returns what is rendered during the calibration
+    if args.calibration_scenes == 0:
+        return {"files" : BENCHMARK_FILES}
+
+    return {
+        "scenes" : args.calibration_scenes,
+        "samples" : args.calibration_samples,
+        "base_scene" : os.path.abspath(args.base_scene),
+        "images_size" : [args.images_width, args.images_height],
+        "num_objects" : [args.min_num_objects, args.max_num_objects],
+        "num_decoys" : [args.min_num_decoys, args.max_num_decoys],
+        "rules" : hashlib.sha1(json.dumps(rules.get_dict(), sort_keys=True).encode()).hexdigest()
+    }
+
+def get_calibration_key(devices: list, settings: dict, workload: dict) -> str:
+    key = {
+        "version" : CALIBRATION_CACHE_VERSION,
+        "devices" : sorted(devices),
+        "blender" : bpy.app.version_string,
+        "settings" : settings,
+        "workload" : workload
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+class CalibrationCache:
+    # Stores the time taken by every group of devices to render the calibration workload, keyed by the
+    # devices, the blender version, the render settings and the workload (see 'get_calibration_key')
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+
+    def get(self, key: str):
+        entry = self.entries.get(key, None)
+        return entry["time"] if entry is not None else None
+
+    def set(self, key: str, devices: list, calibration_time: float):
+        self.entries[key] = {"devices" : devices, "time" : calibration_time, "date" : time.strftime("%Y-%m-%d %H:%M:%S")}
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        write_json_atomic(self.path, self.entries)
+
+def calibrate_groups(args, rules, argv: list, gpu_groups: list) -> list:
+    # Returns the time taken by every gpu group to render the calibration workload, groups which are not in
+    # the calibration cache are calibrated at the same time, each one in its own blender process
+    # Args:
+    # - argv (list): command line arguments of the run, used by the calibration processes
+    cache = CalibrationCache(args.calibration_cache)
+    workload = get_workload(args, rules)
+    keys = [get_calibration_key(group, get_render_settings(args, group), workload) for group in gpu_groups]
+    times = [cache.get(key) for key in keys]
+
+    processes = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i, group in enumerate(gpu_groups):
+            if times[i] is not None:
+                print(f"Calibration of devices {group} found in cache: {times[i]:.2f}s")
+                continue
+            result_path = os.path.join(tmp_dir, f"calibration_{i}.json")
+            group_argv = change_args(argv.copy(), use_multiple_gpus=0, gpu_groups=None, resume=None, **get_group_args(group))
+            processes.append((i, result_path, subprocess.Popen(
+                ["blender", "-b", "--python", "calibration.py", "--", "--result", result_path] + group_argv,
+                preexec_fn=get_pinning(group)
+            )))
+
+        for i, result_path, process in processes:
+            if process.wait() != 0 or not os.path.exists(result_path):
+                raise Exception(f"Calibration of devices {gpu_groups[i]} failed")
+            with open(result_path, "r") as f:
+                times[i] = json.load(f)["time"]
+            cache.set(keys[i], gpu_groups[i], times[i])
+            print(f"Calibration of devices {gpu_groups[i]}: {times[i]:.2f}s")
+
+    return times
+
+def calibrate_on_scenes(args, rules) -> float:
+    # Renders scenes sampled from the rules and the arguments of the run at reduced samples, returns the
+    # rendering time (the first render is not counted, it includes loading the scene on the devices)
+    from SSHAPE_Dataset_generator.render import DatasetRenderer
+    from bpy import context #type:ignore
+
+    bpy.ops.wm.open_mainfile(filepath=args.base_scene)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        #nothing is written to the output directory of the run
+        args.output_dir = tmp_dir
+        args.split = "calibration"
+        args.scene_plan = None
+        args.scheduler = "static"
+        args.shard_id = None
+        args.create_run_log = 0
+        args.stream_annotations = 0
+
+        window = context.window_manager.windows[0]
+        with context.temp_override(window=window):
+            renderer = DatasetRenderer(args, rules)
+            overall_time = 0
+            for i in range(args.calibration_scenes + 1):
+                random.seed(CALIBRATION_SEED + i)
+                renderer.placement.rng = np.random.default_rng(CALIBRATION_SEED + i)
+                renderer.build_scene(i, "calibration.png")
+                bpy.context.scene.cycles.samples = args.calibration_samples
+
+                start_time = time.time()
+                bpy.ops.render.render(write_still=False)
+                if i > 0: #warm up
+                    overall_time += time.time() - start_time
+                renderer.clear_scene()
+            renderer.output_writer.close()
+
+    return overall_time
+
+if __name__ == "__main__":
+    #Calibrates one group of devices, started by 'calibrate_groups'
+    #Usage: blender -b --python calibration.py -- --result {OUTPUT FILE} {ARGUMENTS OF THE RUN} --use_devices {IDS}
+    import argparse, pathlib
+    from SSHAPE_Dataset_generator.utils import setup_argparser, extract_args, load_run_arguments
+
+    os.chdir(pathlib.Path(__file__).parent.resolve())
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--result", required=True,
+                    help="JSON file in which the calibration time is written.")
+    calibration_args, run_argv = ap.parse_known_args(extract_args())
+    args, rules, _ = load_run_arguments(setup_argparser(), run_argv)
+
+    if args.calibration_scenes == 0:
+        calibration_time = benchmark(BENCHMARK_FILES, args.use_devices,
+                                     load_render_profile(args.render_profile, args.render_profiles_file, args.device_type),
+                                     args.cpu_threads, args.render_engine,
+                                     100 if args.render_engine == "CYCLES" else args.preview_scale)
+    else:
+        calibration_time = calibrate_on_scenes(args, rules)
+
+    write_json_atomic(calibration_args.result, {"devices" : args.use_devices, "time" : calibration_time})
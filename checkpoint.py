@@ -0,0 +1,115 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json, os, shutil
+
+BASE_FILENAME = "base.json"
+
+def write_json_atomic(path: str, obj):
+    # Writes a JSON file so that it's either completely written or not written at all, even if the
+    # process is killed while writing
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def get_delta_filename(seq: int) -> str:
+    return f"delta_{seq:08d}.json"
+
+class CheckpointWriter:
+    # Saves the rendering progress in a checkpoint directory.
+    # The base file holds the arguments, the rules and the annotations at the start of the run, every
+    # following checkpoint only holds what changed since the previous one (new images, annotations and
+    # scenes, and the current state), so its cost doesn't grow with the size of the dataset.
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.next_seq = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def reset(self, base: dict):
+        # Removes all the previous checkpoints and writes a new base
+        # Args:
+        # - base (dict): dict with 'state', 'args', 'rules' and 'annotations'
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        write_json_atomic(os.path.join(self.directory, BASE_FILENAME), base)
+        self.next_seq = 0
+
+    def resume(self, next_seq: int):
+        # Continues writing checkpoints in a directory which is being resumed
+        self.next_seq = next_seq
+
+    def write_delta(self, state: dict, images: list, annotations: list, scenes: list) -> str:
+        # Writes a new checkpoint with the changes since the previous one and returns its path
+        path = os.path.join(self.directory, get_delta_filename(self.next_seq))
+        write_json_atomic(path, {
+            "seq" : self.next_seq,
+            "state" : state,
+            "images" : images,
+            "annotations" : annotations,
+            "scenes" : scenes
+        })
+        self.next_seq += 1
+        return path
+
+def load_checkpoint(path: str) -> dict:
+    # Loads a checkpoint, either a single checkpoint file or a checkpoint directory, in which case the base
+    # and all the following checkpoints are combined.
+    # Returns a dict with 'state', 'args', 'rules' and 'annotations'.
+    if not os.path.isdir(path):
+        with open(path, "r") as f:
+            return json.load(f)
+
+    with open(os.path.join(path, BASE_FILENAME), "r") as f:
+        checkpoint = json.load(f)
+
+    seq = 0
+    while os.path.exists(os.path.join(path, get_delta_filename(seq))):
+        with open(os.path.join(path, get_delta_filename(seq)), "r") as f:
+            delta = json.load(f)
+        checkpoint["state"] = delta["state"]
+        for key in ["images", "annotations", "scenes"]:
+            checkpoint["annotations"][key].extend(delta[key])
+        seq += 1
+
+    checkpoint["checkpoint_dir"] = os.path.abspath(path)
+    checkpoint["next_seq"] = seq
+    return checkpoint
+
+def load_checkpoint_state(directory: str):
+    # Returns the state of the last checkpoint in a checkpoint directory without loading the annotations,
+    # None if there is no checkpoint
+    if not os.path.exists(os.path.join(directory, BASE_FILENAME)):
+        return None
+
+    seq = 0
+    while os.path.exists(os.path.join(directory, get_delta_filename(seq + 1))):
+        seq += 1
+    path = os.path.join(directory, get_delta_filename(seq))
+    if not os.path.exists(path):
+        path = os.path.join(directory, BASE_FILENAME)
+    with open(path, "r") as f:
+        return json.load(f)["state"]
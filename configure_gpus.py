@@ -17,9 +17,10 @@ You should have received a copy of the GNU General Public License along with SSH
 If not, see <https://www.gnu.org/licenses/>.
 """
 
-import time
+import time, os, json
 import bpy #type:ignore
 from SSHAPE_Dataset_generator.utils import extract_args
+from SSHAPE_Dataset_generator.supervisor import retry
 import argparse
 
 def setup_argparser():
@@ -30,47 +31,142 @@ def setup_argparser():
                     help="IDS of devices to use for benchmark")
     ap.add_argument("--benchmark_file", default="cube_diorama.blend",
                     help="File to render for benchmark")
+    ap.add_argument("--benchmark_engines", default=["CYCLES"], nargs="+", choices=RENDER_ENGINES,
+                    help="Render engines to compare in the benchmark")
+    ap.add_argument("--benchmark_renders", default=1, type=int,
+                    help="Number of times the file is rendered with every engine")
+    ap.add_argument("--preview_scale", default=100, type=int,
+                    help="Resolution percentage used by EEVEE and Workbench in the benchmark")
     return ap
 
-def set_render_args(devices_to_use="all"):
-    render_args = bpy.context.scene.render
-    render_args.engine = "CYCLES"
-    render_args.resolution_x = 640
-    render_args.resolution_y = 640
-    render_args.resolution_percentage = 100
-
-    cycles_prefs = bpy.context.preferences.addons['cycles'].preferences 
-    cycles_prefs.compute_device_type = 'CUDA'
-    bpy.context.scene.cycles.device = 'GPU'
-    bpy.context.preferences.addons["cycles"].preferences.get_devices()
-
-    for d in bpy.context.preferences.addons["cycles"].preferences.devices:
-        if d["id"] in devices_to_use or devices_to_use == "all":
-            d["use"] = 1
-        else:
-            d["use"] = 0
+# Engines which can render the dataset, EEVEE and Workbench are rasterizers meant for fast previews
+RENDER_ENGINES = ["CYCLES", "BLENDER_EEVEE", "BLENDER_WORKBENCH"]
+
+# Values used by a render profile for every setting it doesn't set (see 'render_profiles.json')
+DEFAULT_PROFILE = {
+    "device_type" : "CUDA",
+    "samples" : 32,
+    "adaptive_threshold" : None, #None disables adaptive sampling
+    "denoiser" : None, #None disables denoising, otherwise 'OPENIMAGEDENOISE' or 'OPTIX'
+    "max_bounces" : 12,
+    "transparent_min_bounces" : 6,
+    "transparent_max_bounces" : 8,
+    "blur_glossy" : 2.0,
+    "tile_size" : None, #None lets blender choose
+    "persistent_data" : False
+}
+
+def load_render_profile(name="default", path="render_profiles.json", device_type=None):
+    # Returns the settings of a render profile, completed with the default ones
+    # Args:
+    # - name (str): name of the profile
+    # - path (str): JSON file with the profiles
+    # - device_type (str): if set overrides the device type of the profile
+    profile = dict(DEFAULT_PROFILE)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            profiles = json.load(f)
+        if name not in profiles:
+            raise Exception(f"Render profile '{name}' not found in {path}")
+        profile.update(profiles[name])
+    elif name != "default":
+        raise Exception(f"Render profiles file not found: {path}")
+
+    if device_type is not None:
+        profile["device_type"] = device_type
+
+    return profile
+
+def get_engine_id(engine: str) -> str:
+    # Returns the identifier blender uses for an engine, EEVEE is called 'BLENDER_EEVEE_NEXT' in
+    # some blender versions
+    engines = bpy.types.RenderSettings.bl_rna.properties["engine"].enum_items.keys()
+    if engine == "BLENDER_EEVEE" and engine not in engines and "BLENDER_EEVEE_NEXT" in engines:
+        return "BLENDER_EEVEE_NEXT"
+    return engine
+
+def set_preview_args(engine: str, profile: dict):
+    # Sets the quality settings of the rasterized preview engines
+    # Args:
+    # - engine (str): 'BLENDER_EEVEE' or 'BLENDER_WORKBENCH'
+    # - profile (dict): render profile, its samples are used as anti aliasing samples (at most 16)
+    scene = bpy.context.scene
+    if engine == "BLENDER_EEVEE":
+        scene.eevee.taa_render_samples = min(profile["samples"], 16)
+    elif engine == "BLENDER_WORKBENCH":
+        scene.display.shading.light = "STUDIO"
+        scene.display.shading.color_type = "MATERIAL" #viewport color of the materials, set to the rule color
+        scene.display.render_aa = "8" if profile["samples"] >= 8 else "FXAA"
+
+def set_render_args(devices_to_use="all", profile=None, resolution=(640, 640), threads=0, engine="CYCLES",
+                    scale=100):
+    # Sets render engine, devices and performance settings, call it once before rendering
+    # Args:
+    # - devices_to_use: list of ids of the devices to use or "all"
+    # - profile (dict): render profile (see 'load_render_profile'), if None the default one is used
+    # - resolution (tuple): width and height of the images
+    # - threads (int): number of cpu threads used for rendering, 0 to use all the available ones
+    # - engine (str): one of RENDER_ENGINES
+    # - scale (int): resolution percentage, images are rendered at resolution * scale / 100
+    if profile is None:
+        profile = DEFAULT_PROFILE
 
+    render_args = bpy.context.scene.render
+    render_args.engine = get_engine_id(engine)
+    render_args.resolution_x = resolution[0]
+    render_args.resolution_y = resolution[1]
+    render_args.resolution_percentage = scale
+    if engine != "CYCLES":
+        set_preview_args(engine, profile)
+    render_args.use_persistent_data = profile["persistent_data"]
+
+    render_args.threads_mode = "FIXED" if threads > 0 else "AUTO"
+    if threads > 0:
+        render_args.threads = threads
+
+    if profile["device_type"] == "CPU":
+        bpy.context.scene.cycles.device = 'CPU'
+    else:
+        cycles_prefs = bpy.context.preferences.addons['cycles'].preferences 
+        cycles_prefs.compute_device_type = profile["device_type"]
+        bpy.context.scene.cycles.device = 'GPU'
+        bpy.context.preferences.addons["cycles"].preferences.get_devices()
+
+        for d in bpy.context.preferences.addons["cycles"].preferences.devices:
+            if d["id"] in devices_to_use or devices_to_use == "all":
+                d["use"] = 1
+            else:
+                d["use"] = 0
+
+    cycles = bpy.context.scene.cycles
     bpy.data.worlds['World'].cycles.sample_as_light = True
-    bpy.context.scene.cycles.blur_glossy = 2.0
-    bpy.context.scene.cycles.samples = 32
-    bpy.context.scene.cycles.transparent_min_bounces = 6
-    bpy.context.scene.cycles.transparent_max_bounces = 8
-
-def benchmark(files, devices_to_use="all"):
+    cycles.blur_glossy = profile["blur_glossy"]
+    cycles.samples = profile["samples"]
+    cycles.use_adaptive_sampling = profile["adaptive_threshold"] is not None
+    if profile["adaptive_threshold"] is not None:
+        cycles.adaptive_threshold = profile["adaptive_threshold"]
+    cycles.use_denoising = profile["denoiser"] is not None
+    if profile["denoiser"] is not None:
+        #the OptiX denoiser needs an nvidia gpu
+        cycles.denoiser = "OPENIMAGEDENOISE" if profile["device_type"] == "CPU" else profile["denoiser"]
+    cycles.max_bounces = profile["max_bounces"]
+    cycles.transparent_min_bounces = profile["transparent_min_bounces"]
+    cycles.transparent_max_bounces = profile["transparent_max_bounces"]
+    if profile["tile_size"] is not None:
+        cycles.use_auto_tile = True
+        cycles.tile_size = profile["tile_size"]
+
+def benchmark(files, devices_to_use="all", profile=None, threads=0, engine="CYCLES", scale=100, renders=1):
     #Checks how much time does it take to render all files
     #NOTE: This doesn't count the time each file takes to be loaded, only the rendering time
     overall_time = 0
 
     for filename in files:
         bpy.ops.wm.open_mainfile(filepath=filename)
-        set_render_args(devices_to_use)
+        set_render_args(devices_to_use, profile, threads=threads, engine=engine, scale=scale)
         start_time = time.time()
-        while True:
-            try:
-                bpy.ops.render.render(write_still=False)
-                break
-            except Exception as e:
-                print(e)
+        for _ in range(renders):
+            retry(lambda: bpy.ops.render.render(write_still=False), description=f"Benchmark render of {filename}")
         overall_time += time.time() - start_time
 
     return overall_time
@@ -101,12 +197,17 @@ if __name__ == "__main__":
         filename = args.benchmark_file
         devices_to_use = args.benchmark_devices
 
-        time_taken = benchmark([filename], devices_to_use)
+        results = ""
+        for engine in args.benchmark_engines:
+            scale = 100 if engine == "CYCLES" else args.preview_scale
+            time_taken = benchmark([filename], devices_to_use, engine=engine, scale=scale,
+                                   renders=args.benchmark_renders)
+            results += f"{engine} ({scale}%) - time: {time_taken:.3f}s - " + \
+                       f"images/s: {args.benchmark_renders / time_taken:.2f}\n"
         print(f"""
 Available devices:
 {gpus_info}
 
 Rendering benchmark on: {filename}
 Using devices: {devices_to_use}
-time: {time_taken}
-        """)
\ No newline at end of file
+{results}""")
\ No newline at end of file
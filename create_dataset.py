@@ -20,10 +20,11 @@ If not, see <https://www.gnu.org/licenses/>.
 from SSHAPE_Dataset_generator.utils import *
 from SSHAPE_Dataset_generator.render import DatasetRenderer
 from SSHAPE_Dataset_generator.rules_utils import Rules
-from SSHAPE_Dataset_generator import configure_gpus
+from SSHAPE_Dataset_generator.multi_gpu import MultiGpuRun, is_run_manifest, load_run_manifest
+from SSHAPE_Dataset_generator.supervisor import run_supervised, run_pinned
 import bpy, bpy_extras  #type:ignore
 from bpy import context #type:ignore
-import os, pathlib, json, subprocess, sys
+import os, pathlib, json, sys
 import signal
 
 sys.stdout = sys.stderr
@@ -36,83 +37,38 @@ parser = setup_argparser()
 
 if __name__ == "__main__":
     argv = extract_args()
-    args = parser.parse_args(argv)
-
-    assert args.rules is not None, "'rules' argument is not optional"
-
-    checkpoint = None
-    rules = None
-
-    if args.resume is not None:
-        with open(args.resume, "r") as f:
-            checkpoint = json.load(f)
-            parser.set_defaults(**checkpoint["args"])
-            args = parser.parse_args([])
-            rules = Rules(checkpoint["rules"])
-    elif args.config is not None:
-        #override default values of parser with arguments from configuration file
-        with open(args.config, "r") as f:
-            parser.set_defaults(**json.load(f))
-            args = parser.parse_args(argv)
-    if rules is None:
-        with open(args.rules, "r") as f:
-            rules = Rules(json.load(f))
-
-    assert args.base_scene is not None, "'base_scene' argument is not optional"
-
-    if args.test_mode == 1:
-        args.num_images = 1 #in testing mode only one image will be shown
-
-    if not args.use_multiple_gpus:
+    manifest = None
+    resume_path = parser.parse_args(argv).resume
+    if resume_path is not None and is_run_manifest(resume_path):
+        #resume a multi gpu run with the arguments it was started with, gpu groups can be changed
+        manifest = load_run_manifest(resume_path)
+        gpu_groups = parser.parse_args(argv).gpu_groups
+        argv = manifest["argv"] if gpu_groups is None else change_args(manifest["argv"].copy(), gpu_groups=gpu_groups)
+    args, rules, checkpoint = load_run_arguments(parser, argv)
+
+    if args.supervise == 1 and not args.use_multiple_gpus:
+        #render in a child process, restarted from its checkpoint after hangs or memory over --max_rss_mb
+        checkpoint_dir = os.path.abspath(os.path.join(
+            args.output_dir, args.split,
+            get_split_filename(args.split, "checkpoint", args.filename_prefix, args.shard_id)
+        ))
+        sys.exit(run_supervised(change_args(argv.copy(), supervise=0), args, checkpoint_dir))
+    elif not args.use_multiple_gpus and not is_pinned(args.cpu_cores):
+        #blender's threads already exist, render in a child process pinned to --cpu_cores before blender starts
+        sys.exit(run_pinned(argv, args.cpu_cores))
+    elif not args.use_multiple_gpus:
         bpy.ops.wm.open_mainfile(filepath=args.base_scene)
         window = context.window_manager.windows[0]
         with context.temp_override(window=window):
             renderer = DatasetRenderer(args, rules, checkpoint=checkpoint)
             signal.signal(signal.SIGINT, renderer.stop)
+            signal.signal(signal.SIGTERM, renderer.stop)
             renderer.render()
+        sys.exit(renderer.exit_code)
     else:
-        if args.resume:
-            pass
-        else:
-            assert args.gpu_groups is not None, "'gpu_groups' argument is not optional when multi gpu rendering is enabled" 
-            #do a benchmark on each gpu group to check how fast each one is
-            gpu_groups = [g.split(",") for g in args.gpu_groups]
-            print(gpu_groups)
-
-            benchmark_files = [f"benchmark_files/benchmark_{i}.blend" for i in range(1, 11)]
-            times = []
-            for group in gpu_groups:
-                group_time = configure_gpus.benchmark(benchmark_files, group)
-                times.append(group_time)
-            
-            #subdivide the number of images according to the speed of each group
-            ranges = divide_workloads(times, args.num_images)
-            print(ranges)
-
-            #start subprocesses for each group
-            subprocesses = []
-            for i, group_range in enumerate(ranges):
-                group_args = argv.copy()
-                group_args = change_args(args=group_args, 
-                            start_index=group_range[0],
-                            num_images=group_range[1],
-                            use_multiple_gpus=0,
-                            use_devices=" ".join([f'"{g}"' for g in gpu_groups[i]]),
-                            gpu_groups=None
-                            )
-                
-                
-                sp = subprocess.Popen(["blender", "-b", "--python", "create_dataset.py", "--"] + group_args)
-                subprocesses.append(sp)
-
-            #wait for each subprocess
-            for sp in subprocesses:
-                sp.wait()
-
-            
-
-            
-
-
-
-
+        assert args.gpu_groups is not None or args.cpu_workers > 0, \
+            "'gpu_groups' or 'cpu_workers' argument is required when multi gpu rendering is enabled"
+        run = MultiGpuRun(args, rules, argv, manifest)
+        signal.signal(signal.SIGINT, run.stop)
+        signal.signal(signal.SIGTERM, run.stop)
+        run.run()
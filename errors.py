@@ -40,3 +40,7 @@ class UndefinedMaterialError(Exception):
 class UndefinedColorError(Exception):
     def __init__(self, color):
         super().__init__(f"Trying to apply undefined color: '{color}'")
+
+class RenderFailedError(Exception):
+    def __init__(self, description, attempts, error):
+        super().__init__(f"{description} failed {attempts} times, last error: {error}")
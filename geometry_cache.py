@@ -0,0 +1,242 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import hashlib, json, os
+import numpy as np
+
+try: #geometry can be read outside of blender, but it can only be computed inside of it
+    import bpy, bmesh #type: ignore
+except ImportError:
+    bpy = None
+
+#Increase when the content of cached entries changes, old entries are then computed again
+GEOMETRY_CACHE_VERSION = 1
+
+def get_file_hash(path: str) -> str:
+    # Returns the sha1 hash of the content of a file
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def compute_convex_hull(coords: np.ndarray) -> tuple:
+    # Returns the vertices (N, 3) and the triangles (M, 3) of the convex hull of a set of points
+    bm = bmesh.new()
+    for co in coords:
+        bm.verts.new(co)
+    bmesh.ops.convex_hull(bm, input=bm.verts)
+    bm.verts.index_update()
+
+    polygons = [[v.index for v in face.verts] for face in bm.faces]
+    bm.free()
+
+    used = sorted({i for polygon in polygons for i in polygon})
+    remap = {old : new for new, old in enumerate(used)}
+    triangles = []
+    for polygon in polygons: #fan triangulation, hull faces are convex
+        for k in range(1, len(polygon) - 1):
+            triangles.append([remap[polygon[0]], remap[polygon[k]], remap[polygon[k + 1]]])
+
+    return coords[used], np.array(triangles, dtype=np.int64).reshape(-1, 3)
+
+def point_in_triangle(point: np.ndarray, a: np.ndarray, b: np.ndarray, c: np.ndarray, eps=1e-6) -> bool:
+    # Returns true if a point lying on the plane of a triangle is inside of it
+    v0, v1, v2 = c - a, b - a, point - a
+    dot00, dot01, dot02 = v0 @ v0, v0 @ v1, v0 @ v2
+    dot11, dot12 = v1 @ v1, v1 @ v2
+    denominator = dot00 * dot11 - dot01 * dot01
+    if abs(denominator) < eps:
+        return False
+    u = (dot11 * dot02 - dot01 * dot12) / denominator
+    v = (dot00 * dot12 - dot01 * dot02) / denominator
+    return u >= -eps and v >= -eps and u + v <= 1 + eps
+
+def compute_shape_geometry(coords: np.ndarray) -> dict:
+    # Computes the geometry of a shape from the local coordinates of its vertices:
+    # - hull: vertices of the convex hull
+    # - ground_offset: height of the origin when the shape lies on the plane without rotations
+    # - resting_faces: faces of the convex hull (coplanar triangles merged) with their outward normal,
+    #   area, distance from the origin and whether the shape can rest on them without tipping over
+    hull, triangles = compute_convex_hull(coords)
+    a, b, c = hull[triangles[:, 0]], hull[triangles[:, 1]], hull[triangles[:, 2]]
+
+    normals = np.cross(b - a, c - a)
+    areas = np.linalg.norm(normals, axis=1) / 2
+    valid = areas > 1e-12
+    a, b, c, normals, areas = a[valid], b[valid], c[valid], normals[valid], areas[valid]
+    normals /= (areas * 2)[:, None]
+
+    #make every normal point outwards
+    inner_point = hull.mean(axis=0)
+    centers = (a + b + c) / 3
+    outwards = np.sign(np.einsum("ij,ij->i", normals, centers - inner_point))
+    normals *= np.where(outwards == 0, 1, outwards)[:, None]
+
+    #center of mass as weighted sum of the tetrahedra connecting each face to the inner point
+    volumes = np.abs(np.einsum("ij,ij->i", a - inner_point, np.cross(b - inner_point, c - inner_point))) / 6
+    if volumes.sum() > 0:
+        centroid = ((a + b + c + inner_point) / 4 * volumes[:, None]).sum(axis=0) / volumes.sum()
+    else: #flat shape
+        centroid = inner_point
+
+    offsets = np.einsum("ij,ij->i", normals, a)
+    faces = {}
+    for i in range(len(normals)):
+        key = (*np.round(normals[i], 4), round(float(offsets[i]), 4))
+        faces.setdefault(key, []).append(i)
+
+    resting_faces = []
+    for indices in faces.values():
+        normal = normals[indices[0]]
+        offset = offsets[indices[0]]
+        #the shape is stable if its center of mass projects inside the face
+        projection = centroid - (centroid @ normal - offset) * normal
+        stable = any(point_in_triangle(projection, a[i], b[i], c[i]) for i in indices)
+        resting_faces.append({
+            "normal" : [float(k) for k in normal],
+            "area" : float(areas[indices].sum()),
+            "offset" : float(offset),
+            "stable" : bool(stable)
+        })
+
+    return {
+        "hull" : hull.tolist(),
+        "ground_offset" : float(-hull[:, 2].min()),
+        "resting_faces" : resting_faces
+    }
+
+class GeometryCache:
+    # Stores geometry which never changes for a shape, so it does not need to be computed from
+    # the mesh every time the shape is placed.
+    # Entries are saved in 'cache_dir' with the hash of the shape file, when a shape file changes
+    # its geometry is computed again.
+
+    def __init__(self, cache_dir: str, asset_cache=None):
+        # Args:
+        # - cache_dir (str): directory in which the entries are saved
+        # - asset_cache (AssetCache): used to load shapes whose geometry is not in the cache,
+        #   if None only entries already saved can be used
+        self.cache_dir = cache_dir
+        self.asset_cache = asset_cache
+        self.entries = {} #(filepath, name) -> geometry
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, shape_dir: str, shape_rule: dict) -> dict:
+        # Returns the geometry of a shape, computing it if it's not already in the cache
+        # Args:
+        # - shape_dir (str): directory in which the shape file is stored
+        # - shape_rule (dict): rule of the shape
+        filepath = os.path.abspath(os.path.join(shape_dir, shape_rule["file"]))
+        key = (filepath, shape_rule["name"])
+        geometry = self.entries.get(key, None)
+        if geometry is not None:
+            return geometry
+
+        file_hash = get_file_hash(filepath)
+        entry_path = os.path.join(self.cache_dir, f"{file_hash}_{shape_rule['name']}.json")
+        try:
+            with open(entry_path, "r") as f:
+                geometry = json.load(f)
+            if geometry.get("version", None) != GEOMETRY_CACHE_VERSION:
+                geometry = None
+        except (OSError, json.JSONDecodeError):
+            geometry = None
+
+        if geometry is None:
+            if self.asset_cache is None or bpy is None:
+                raise Exception(f"Geometry of shape '{shape_rule['name']}' is not in the cache and can't be computed, " +
+                                "build the geometry cache with blender first.")
+            print(f"Computing geometry of shape: {shape_rule['name']}")
+            template = self.asset_cache.get_template(shape_dir, shape_rule)
+            coords = np.empty(len(template.data.vertices) * 3, dtype=np.float64)
+            template.data.vertices.foreach_get("co", coords)
+
+            geometry = compute_shape_geometry(coords.reshape(-1, 3))
+            geometry["version"] = GEOMETRY_CACHE_VERSION
+            geometry["file"] = shape_rule["file"]
+            geometry["name"] = shape_rule["name"]
+            geometry["hash"] = file_hash
+
+            #write to a temporary file first, other workers could be reading the same entry
+            tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(geometry, f)
+            os.replace(tmp_path, entry_path)
+
+        geometry["hull"] = np.array(geometry["hull"], dtype=np.float64)
+        self.entries[key] = geometry
+        return geometry
+
+    def build(self, rules, objects_dir: str, decoys_dir: str):
+        # Makes sure the geometry of every shape in the rules is in the cache
+        for shape_rule in rules.objects:
+            self.get(objects_dir, shape_rule)
+        for shape_rule in rules.decoys:
+            self.get(decoys_dir, shape_rule)
+
+def choose_resting_face(geometry: dict, rng) -> dict:
+    # Returns a random face on which the shape can rest, larger faces are more likely to be chosen
+    # Args:
+    # - geometry (dict): geometry of the shape
+    # - rng: random number generator (e.g. the random module)
+    faces = [face for face in geometry["resting_faces"] if face["stable"]]
+    if len(faces) == 0:
+        faces = geometry["resting_faces"]
+    return rng.choices(faces, weights=[face["area"] for face in faces])[0]
+
+def get_ground_offset(hull: np.ndarray) -> float:
+    # Returns the height at which the origin of a shape must be placed for it to lie on the plane
+    # Args:
+    # - hull (np.ndarray): vertices of the convex hull, already rotated and scaled
+    return float(-hull[:, 2].min())
+
+def get_transformed_ground_offset(geometry: dict, transform: np.ndarray) -> float:
+    # Returns the height at which the origin of a rotated and scaled shape must be placed for it to lie on the plane
+    # NOTE: When the transformation doesn't move points along z (e.g. rotations around z and scale) the
+    #       cached ground offset is just scaled, otherwise the convex hull is transformed
+    # Args:
+    # - geometry (dict): geometry of the shape
+    # - transform (np.ndarray): 3x3 rotation and scale matrix of the shape
+    if transform[2, 0] == 0 and transform[2, 1] == 0 and transform[2, 2] > 0:
+        return float(geometry["ground_offset"] * transform[2, 2])
+    return get_ground_offset(geometry["hull"] @ transform.T)
+
+if __name__ == "__main__":
+    #Builds the geometry cache for all the shapes in the rules
+    #Usage: blender -b --python geometry_cache.py -- {ARGUMENTS}
+    import pathlib
+    from SSHAPE_Dataset_generator.utils import setup_argparser, extract_args
+    from SSHAPE_Dataset_generator.rules_utils import Rules
+    from SSHAPE_Dataset_generator.asset_cache import AssetCache
+
+    os.chdir(pathlib.Path(__file__).parent.resolve())
+    parser = setup_argparser()
+    argv = extract_args()
+    args = parser.parse_args(argv)
+    if args.config is not None:
+        with open(args.config, "r") as f:
+            parser.set_defaults(**json.load(f))
+            args = parser.parse_args(argv)
+
+    with open(args.rules, "r") as f:
+        rules = Rules(json.load(f))
+
+    GeometryCache(args.geometry_cache_dir, AssetCache()).build(rules, args.objects_dir, args.decoys_dir)
+    print(f"Geometry cache built in: {args.geometry_cache_dir}")
@@ -0,0 +1,86 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+import bpy #type: ignore
+
+BACKGROUND_DEPTH = 1e9 #the Z pass of pixels not covered by any object is ~1e10
+
+class PassesGroundTruth:
+    # Creates instance and depth ground truth from the render passes of the main render, so every image is
+    # rendered only once instead of once for the RGB image and once more with bpycv.
+    # The object index pass (object pass_index, set from inst_id) and the Z pass are combined in the
+    # compositor into a Viewer node (R = instance id, G = depth) whose float pixels are read back after the
+    # render. The Composite node still gets the unchanged RGB image, which blender writes as usual.
+
+    def __init__(self, scene=None):
+        self.scene = bpy.context.scene if scene is None else scene
+        self.setup_passes()
+        self.setup_compositor()
+
+    def setup_passes(self):
+        view_layer = self.scene.view_layers[0]
+        view_layer.use_pass_object_index = True
+        view_layer.use_pass_z = True
+
+    def setup_compositor(self):
+        self.scene.use_nodes = True
+        self.scene.render.use_compositing = True
+        tree = self.scene.node_tree
+        nodes, links = tree.nodes, tree.links
+
+        render_layers = next((node for node in nodes if node.type == "R_LAYERS"), None)
+        if render_layers is None:
+            render_layers = nodes.new("CompositorNodeRLayers")
+
+        composite = next((node for node in nodes if node.type == "COMPOSITE"), None)
+        if composite is None:
+            composite = nodes.new("CompositorNodeComposite")
+            links.new(render_layers.outputs["Image"], composite.inputs["Image"])
+
+        #the combine node was renamed in blender 3.3
+        if hasattr(bpy.types, "CompositorNodeCombineColor"):
+            combine = nodes.new("CompositorNodeCombineColor")
+            combine.mode = "RGB"
+        else:
+            combine = nodes.new("CompositorNodeCombRGBA")
+        combine.name = "GroundTruthCombine"
+        links.new(render_layers.outputs["IndexOB"], combine.inputs[0])
+        links.new(render_layers.outputs["Depth"], combine.inputs[1])
+
+        viewer = nodes.new("CompositorNodeViewer")
+        viewer.name = "GroundTruthViewer"
+        viewer.use_alpha = False
+        links.new(combine.outputs[0], viewer.inputs["Image"])
+        nodes.active = viewer
+
+    def read(self) -> dict:
+        # Returns the ground truth of the last render, same format as bpycv.render_data:
+        # 'inst' (instance id of every pixel, 0 for background) and 'depth' (in meters, 0 for background)
+        image = bpy.data.images["Viewer Node"]
+        width, height = image.size
+        pixels = np.empty(width * height * 4, dtype=np.float32)
+        image.pixels.foreach_get(pixels)
+        pixels = np.flipud(pixels.reshape(height, width, 4)) #blender images start from the bottom row
+
+        inst = np.rint(pixels[:, :, 0]).astype(np.int32)
+        depth = pixels[:, :, 1].copy()
+        depth[depth >= BACKGROUND_DEPTH] = 0
+
+        return {"inst" : inst, "depth" : depth}
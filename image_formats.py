@@ -0,0 +1,166 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os, time
+os.environ.setdefault("OPENCV_IO_ENABLE_OPENEXR", "1") #must be set before OpenCV writes the first EXR file
+import cv2
+import numpy as np
+
+# Supported output formats of every kind of image, the first one is the default
+RGB_FORMATS = ["png", "jpg", "webp"]
+SEGMENTATION_FORMATS = ["png", "webp"] #lossless only, instance ids must not change
+DEPTH_FORMATS = ["png", "exr"]
+
+EXTENSIONS = {"png" : ".png", "jpg" : ".jpg", "webp" : ".webp", "exr" : ".exr"}
+BLENDER_FORMATS = {"png" : "PNG", "jpg" : "JPEG", "webp" : "WEBP"}
+
+WEBP_LOSSLESS_QUALITY = 101 #OpenCV writes lossless WebP for quality above 100
+
+def get_filename(basename: str, image_format: str) -> str:
+    return basename + EXTENSIONS[image_format]
+
+def check_format(image_format: str):
+    # Raises an exception if the installed OpenCV build can't write a format
+    # NOTE: Some OpenCV builds are compiled without OpenEXR or WebP
+    if not cv2.haveImageWriter("x" + EXTENSIONS[image_format]):
+        raise Exception(f"The installed OpenCV build can't write {image_format} images")
+
+def get_cv2_params(image_format: str, png_compression: int = 3, quality: int = 95) -> list:
+    # Returns the OpenCV encoding parameters of a format
+    # Args:
+    # - image_format (str): one of the keys of EXTENSIONS
+    # - png_compression (int): PNG compression level from 0 to 9
+    # - quality (int): JPEG/WebP quality from 1 to 100, above 100 WebP is lossless
+    if image_format == "png":
+        return [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    if image_format == "jpg":
+        return [cv2.IMWRITE_JPEG_QUALITY, min(quality, 100)]
+    if image_format == "webp":
+        return [cv2.IMWRITE_WEBP_QUALITY, quality]
+    if image_format == "exr":
+        return [cv2.IMWRITE_EXR_TYPE, cv2.IMWRITE_EXR_TYPE_HALF]
+    raise Exception(f"Unknown image format: {image_format}")
+
+def get_segmentation_params(image_format: str, png_compression: int = 3) -> list:
+    return get_cv2_params(image_format, png_compression, WEBP_LOSSLESS_QUALITY)
+
+def encode_depth(depth: np.ndarray, image_format: str) -> np.ndarray:
+    # Converts a depth map in meters to the data stored in the file:
+    # millimeters as 16 bit integers for PNG, meters as floats for EXR (saved as half floats)
+    if image_format == "exr":
+        return depth.astype(np.float32)
+    return np.uint16(depth * 1000)
+
+def set_blender_format(image_settings, image_format: str, png_compression: int = 3, quality: int = 95):
+    # Sets the file format of the images written by blender
+    # Args:
+    # - image_settings: bpy.context.scene.render.image_settings
+    image_settings.file_format = BLENDER_FORMATS[image_format]
+    if image_format == "jpg": #can't store alpha, png and webp keep the color mode of the base scene
+        image_settings.color_mode = "RGB"
+    if image_format == "png":
+        image_settings.compression = round(png_compression * 100 / 9) #blender uses a percentage
+    else:
+        image_settings.quality = min(quality, 100)
+
+def benchmark(images: list, configs: list, repeats: int = 3) -> list:
+    # Encodes every image with every configuration in memory and returns the average encode time (ms)
+    # and size (bytes) per image of each configuration
+    # Args:
+    # - images (list): list of np.ndarray
+    # - configs (list): list of (name, extension, params)
+    results = []
+    for name, extension, params in configs:
+        if not cv2.haveImageWriter("x" + extension):
+            print(f"Skipping {name}, not supported by the installed OpenCV build")
+            continue
+        encode_time = 0
+        size = 0
+        for image in images:
+            for _ in range(repeats):
+                start_time = time.perf_counter()
+                ok, buffer = cv2.imencode(extension, image, params)
+                encode_time += time.perf_counter() - start_time
+                if not ok:
+                    raise Exception(f"Could not encode image as {name}")
+            size += len(buffer)
+        results.append({
+            "format" : name,
+            "encode_ms" : encode_time / (len(images) * repeats) * 1000,
+            "bytes" : size / len(images)
+        })
+    return results
+
+def get_benchmark_configs(kind: str) -> list:
+    if kind == "rgb":
+        configs = [(f"png (compression {level})", ".png", get_cv2_params("png", png_compression=level))
+                   for level in [0, 1, 3, 6, 9]]
+        configs += [(f"jpg (quality {quality})", ".jpg", get_cv2_params("jpg", quality=quality))
+                    for quality in [75, 90, 95]]
+        configs += [(f"webp (quality {quality})", ".webp", get_cv2_params("webp", quality=quality))
+                    for quality in [75, 90]]
+        configs += [("webp (lossless)", ".webp", get_cv2_params("webp", quality=WEBP_LOSSLESS_QUALITY))]
+        return configs
+    if kind == "segmentation":
+        return [(f"png (compression {level})", ".png", get_segmentation_params("png", level)) for level in [0, 1, 3, 9]] + \
+               [("webp (lossless)", ".webp", get_segmentation_params("webp"))]
+    if kind == "depth":
+        return [(f"png uint16 mm (compression {level})", ".png", get_cv2_params("png", png_compression=level))
+                for level in [0, 1, 3, 9]] + [("exr half", ".exr", get_cv2_params("exr"))]
+    raise Exception(f"Unknown image kind: {kind}")
+
+if __name__ == "__main__":
+    #Compares encode time and size of the supported formats on already rendered images
+    #Usage: python image_formats.py --images {DIRECTORY} --kind rgb|segmentation|depth
+    import argparse
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--images", required=True,
+                    help="Directory with the images to encode (e.g. the images/segmentation/depth directory of a split).")
+    ap.add_argument("--kind", default="rgb", choices=["rgb", "segmentation", "depth"],
+                    help="Kind of images in the directory.")
+    ap.add_argument("--max_images", default=20, type=int,
+                    help="Maximum number of images to use.")
+    ap.add_argument("--repeats", default=3, type=int,
+                    help="Number of times each image is encoded.")
+    args = ap.parse_args()
+
+    images = []
+    for filename in sorted(os.listdir(args.images))[:args.max_images]:
+        image = cv2.imread(os.path.join(args.images, filename), cv2.IMREAD_UNCHANGED)
+        if image is None:
+            continue
+        if args.kind == "depth" and image.dtype != np.uint16: #exr depth in meters
+            image = encode_depth(image, "png")
+        images.append(image)
+
+    if len(images) == 0:
+        raise Exception(f"No images found in: {args.images}")
+
+    configs = get_benchmark_configs(args.kind)
+    if args.kind == "depth": #exr stores meters as floats
+        images_exr = [encode_depth(image / 1000, "exr") for image in images]
+        results = benchmark(images, configs[:-1], args.repeats) + benchmark(images_exr, configs[-1:], args.repeats)
+    else:
+        results = benchmark(images, configs, args.repeats)
+
+    print(f"{len(images)} images, {images[0].shape[1]}x{images[0].shape[0]}")
+    print(f"{'format':<32}{'encode ms/img':>15}{'KB/img':>12}")
+    for result in results:
+        print(f"{result['format']:<32}{result['encode_ms']:>15.2f}{result['bytes'] / 1024:>12.1f}")
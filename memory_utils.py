@@ -0,0 +1,67 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os, resource
+import bpy #type: ignore
+
+#Collections of bpy.data whose size is tracked in the run log
+TRACKED_DATABLOCKS = ["objects", "meshes", "lights", "materials", "images", "node_groups"]
+
+#Collections of bpy.data whose orphans are removed when purging
+PURGED_DATABLOCKS = ["meshes", "lights", "materials", "images"]
+
+def get_datablock_counts() -> dict:
+    # Returns the number of datablocks for each tracked collection of bpy.data
+    return {name : len(getattr(bpy.data, name)) for name in TRACKED_DATABLOCKS}
+
+def get_process_rss() -> int:
+    # Returns the resident set size of the current process in bytes
+    # NOTE: Where /proc is not available the peak resident set size is returned instead
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if os.uname().sysname == "Darwin" else rss * 1024 #kilobytes on linux
+
+def is_orphan(datablock) -> bool:
+    # Returns true if nothing uses the datablock and it is not protected by a fake user
+    if datablock.users > 0 or datablock.use_fake_user:
+        return False
+    #render results and viewer images are owned by blender
+    if getattr(datablock, "type", None) in ["RENDER_RESULT", "COMPOSITING"]:
+        return False
+    return True
+
+def purge_orphans() -> int:
+    # Removes orphan meshes, lights, materials and images from bpy.data and returns how many
+    # were removed.
+    # Removing a datablock can leave the ones it used without users, so this is repeated
+    # until nothing else is found.
+    removed = 0
+    while True:
+        removed_pass = 0
+        for name in PURGED_DATABLOCKS:
+            collection = getattr(bpy.data, name)
+            for datablock in [d for d in collection if is_orphan(d)]:
+                collection.remove(datablock)
+                removed_pass += 1
+        removed += removed_pass
+        if removed_pass == 0:
+            return removed
@@ -0,0 +1,198 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import bisect, glob, json, os, re
+from SSHAPE_Dataset_generator.annotation_writer import iter_records, read_header, write_coco
+from SSHAPE_Dataset_generator.utils import get_split_filename
+
+SHARD_PATTERN = re.compile(r"_shard([^_]+)_annotations\.jsonl?$")
+
+def get_shard_id(path: str):
+    # Returns the shard id in the name of an annotations shard, None if it's not a shard
+    match = SHARD_PATTERN.search(os.path.basename(path))
+    return match.group(1) if match is not None else None
+
+def find_shards(directory: str, split: str, prefix: str = None) -> list:
+    # Returns the annotation shards of a split sorted by shard id, if a shard has both the JSON lines
+    # file and the JSON file (e.g. a finished streaming run) the JSON lines one is used
+    shards = {}
+    for path in glob.glob(os.path.join(directory, get_split_filename(split, "annotations.json*", prefix, "*"))):
+        shard_id = get_shard_id(path)
+        if shard_id is None:
+            continue
+        if shard_id not in shards or path.endswith(".jsonl"):
+            shards[shard_id] = path
+
+    def sort_key(shard_id):
+        return (0, int(shard_id), "") if shard_id.isdigit() else (1, 0, shard_id)
+    return [shards[shard_id] for shard_id in sorted(shards, key=sort_key)]
+
+def read_shard_header(path: str) -> dict:
+    if path.endswith(".jsonl"):
+        return read_header(path)
+    with open(path, "r") as f:
+        annotations = json.load(f)
+    return {key : annotations[key] for key in ["info", "licenses", "categories"]}
+
+def iter_shard_records(path: str):
+    # Yields a dict with 'image', 'annotations' and 'scene' for every image of a shard
+    # NOTE: A JSON shard has to be loaded as a whole, a JSON lines shard is read one line at a time
+    if path.endswith(".jsonl"):
+        yield from iter_records(path)
+        return
+
+    with open(path, "r") as f:
+        annotations = json.load(f)
+    image_annotations = {}
+    for annotation in annotations["annotations"]:
+        image_annotations.setdefault(annotation["image_id"], []).append(annotation)
+    for image, scene in zip(annotations["images"], annotations["scenes"]):
+        yield {"image" : image, "annotations" : image_annotations.get(image["id"], []), "scene" : scene}
+
+def get_max_object_id(record: dict) -> int:
+    ids = [annotation["id"] for annotation in record["annotations"]]
+    ids += [obj["id"] for group in ["objects", "decoys"] for obj in record["scene"].get(group, [])]
+    return max(ids, default=-1)
+
+class ChunkOwners:
+    # Finds which worker completed the chunk of an image, using the work queue of a dynamic multi gpu run.
+    # A chunk lost by a dead worker is rendered again by another one, so the images the dead worker
+    # rendered before dying are duplicates and only the ones of the worker which completed it are kept.
+
+    def __init__(self, work_queue_path: str):
+        with open(work_queue_path, "r") as f:
+            chunks = sorted(json.load(f)["chunks"], key=lambda chunk: chunk["start"])
+        self.starts = [chunk["start"] for chunk in chunks]
+        self.chunks = chunks
+
+    def get_owner(self, image_id: int):
+        i = bisect.bisect_right(self.starts, image_id) - 1
+        if i < 0 or image_id >= self.chunks[i]["stop"] or self.chunks[i]["status"] != "done":
+            return None
+        return self.chunks[i]["worker"]
+
+def merge_shards(shard_paths: list, out_path: str, work_queue_path: str = None) -> dict:
+    # Merges annotation shards into a single COCO style annotations file, only one shard is read at a time.
+    # Image ids are the image indices, so they are kept; annotation (and scene object) ids restart from 0
+    # in every shard, so each shard's ids are moved after the ones of the previous shards.
+    # Returns the number of images, annotations and duplicate images of every shard.
+    # Args:
+    # - shard_paths (list): shards (JSON or JSON lines annotations files) in the order they are merged
+    # - out_path (str): path of the merged annotations file
+    # - work_queue_path (str): work queue of the run, used to drop images rendered twice (see 'ChunkOwners')
+    if len(shard_paths) == 0:
+        raise Exception("No annotation shards to merge")
+
+    header = read_shard_header(shard_paths[0])
+    for path in shard_paths[1:]:
+        if read_shard_header(path)["categories"] != header["categories"]:
+            raise Exception(f"The categories of shard {path} are different from the ones of {shard_paths[0]}")
+
+    owners = ChunkOwners(work_queue_path) if work_queue_path is not None else None
+
+    #first pass: choose which shard keeps every image and compute the id offset of every shard
+    kept = [] #set of image ids kept from every shard
+    offsets = []
+    seen = set()
+    stats = {}
+    offset = 0
+    for path in shard_paths:
+        shard_id = get_shard_id(path)
+        shard_kept = set()
+        shard_stats = {"images" : 0, "annotations" : 0, "duplicates" : 0}
+        max_id = -1
+        for record in iter_shard_records(path):
+            image_id = record["image"]["id"]
+            max_id = max(max_id, get_max_object_id(record))
+            owner = owners.get_owner(image_id) if owners is not None else None
+            if owner is not None and shard_id is not None and owner != shard_id:
+                keep = False
+            else:
+                keep = image_id not in seen #without a work queue the first copy of an image is kept
+            if not keep:
+                shard_stats["duplicates"] += 1
+                continue
+            seen.add(image_id)
+            shard_kept.add(image_id)
+            shard_stats["images"] += 1
+            shard_stats["annotations"] += len(record["annotations"])
+        kept.append(shard_kept)
+        offsets.append(offset)
+        offset += max_id + 1
+        stats[path] = shard_stats
+
+    def iter_kept(section):
+        emitted = set() #a shard may hold more copies of an image, only the first one is kept
+        for path, shard_kept, shard_offset in zip(shard_paths, kept, offsets):
+            for record in iter_shard_records(path):
+                image_id = record["image"]["id"]
+                if image_id not in shard_kept or image_id in emitted:
+                    continue
+                emitted.add(image_id)
+                if section == "images":
+                    yield record["image"]
+                elif section == "annotations":
+                    for annotation in record["annotations"]:
+                        yield {**annotation, "id" : annotation["id"] + shard_offset}
+                else:
+                    scene = dict(record["scene"])
+                    for group in ["objects", "decoys"]:
+                        scene[group] = [{**obj, "id" : obj["id"] + shard_offset} for obj in scene.get(group, [])]
+                    yield scene
+
+    write_coco(out_path, header, {
+        "images" : lambda: iter_kept("images"),
+        "annotations" : lambda: iter_kept("annotations"),
+        "scenes" : lambda: iter_kept("scenes")
+    })
+
+    return stats
+
+if __name__ == "__main__":
+    #Merges the annotation shards written by the gpu groups of a multi gpu run
+    #Usage: python merge_annotations.py --output_dir {OUTPUT DIR} --split {SPLIT} [--shards {FILES}]
+    import argparse
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--output_dir", default="./output",
+                    help="Output directory of the run.")
+    ap.add_argument("--split", default="train",
+                    help="Split to merge.")
+    ap.add_argument("--filename_prefix", default=None,
+                    help="Prefix of the files of the run.")
+    ap.add_argument("--shards", default=None, nargs="+",
+                    help="Shards to merge, if unset all the shards of the split are merged.")
+    ap.add_argument("--work_queue", default=None,
+                    help="Work queue of a dynamic run, if unset the one of the split is used if it exists.")
+    ap.add_argument("--out", default=None,
+                    help="Merged annotations file, if unset it's the annotations file of the split.")
+    args = ap.parse_args()
+
+    split_dir = os.path.join(args.output_dir, args.split)
+    shards = args.shards if args.shards is not None else find_shards(split_dir, args.split, args.filename_prefix)
+    out_path = args.out or os.path.join(split_dir, get_split_filename(args.split, "annotations.json", args.filename_prefix))
+    work_queue = args.work_queue
+    if work_queue is None and os.path.exists(os.path.join(split_dir, f"{args.split}_work_queue.json")):
+        work_queue = os.path.join(split_dir, f"{args.split}_work_queue.json")
+
+    stats = merge_shards(shards, out_path, work_queue)
+    for path, shard_stats in stats.items():
+        print(f"{path} - images: {shard_stats['images']} - annotations: {shard_stats['annotations']} - " +
+              f"duplicates: {shard_stats['duplicates']}")
+    print(f"Merged annotations saved in: {out_path}")
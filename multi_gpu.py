@@ -0,0 +1,266 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json, os, signal, time
+from SSHAPE_Dataset_generator.utils import (change_args, divide_workloads, get_split_filename, get_device_groups,
+                                            get_group_args, get_pinning)
+from SSHAPE_Dataset_generator.checkpoint import write_json_atomic, load_checkpoint_state, BASE_FILENAME
+from SSHAPE_Dataset_generator.scheduler import WorkQueue
+from SSHAPE_Dataset_generator.merge_annotations import find_shards, merge_shards
+from SSHAPE_Dataset_generator.supervisor import (EXIT_RESTART, start_process, get_hung_image, kill_hung_process,
+                                                 get_heartbeat_path, get_quarantine_path)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+INTERRUPTED = "interrupted"
+FAILED = "failed"
+
+def get_manifest_path(output_dir: str, split: str, prefix: str = None) -> str:
+    return os.path.abspath(os.path.join(output_dir, split, get_split_filename(split, "run_manifest.json", prefix)))
+
+def is_run_manifest(path: str) -> bool:
+    # Returns true if a file passed to '--resume' is the manifest of a multi gpu run
+    # The manifest is recognized by the name given by get_manifest_path, checkpoints can be too large to parse twice
+    return not os.path.isdir(path) and os.path.basename(path).endswith("_run_manifest.json")
+
+def load_run_manifest(path: str) -> dict:
+    with open(path, "r") as f:
+        return json.load(f)
+
+class MultiGpuRun:
+    # Renders a split with one blender process (worker) for each gpu group.
+    # The run manifest keeps the arguments of the run and the range, devices, checkpoint and status of every
+    # worker, it's updated every time a worker starts or stops so that an interrupted run can be resumed by
+    # passing it to '--resume': only the unfinished workers are started again, on the gpu groups available.
+    # Stop signals received by the parent are forwarded to every worker, which saves its checkpoint.
+
+    def __init__(self, args, rules, argv: list, manifest: dict = None):
+        # Args:
+        # - args: arguments of the run
+        # - rules: rules of the run
+        # - argv (list): command line arguments of the run, used to build the ones of the workers
+        # - manifest (dict): manifest of the run to resume, None to start a new run
+        self.args = args
+        self.rules = rules
+        self.gpu_groups = get_device_groups(args) #gpu and cpu groups
+        self.manifest_path = get_manifest_path(args.output_dir, args.split, args.filename_prefix)
+        self.stopping = False
+        self.processes = {} #worker_id -> process
+
+        split_dir = os.path.join(args.output_dir, args.split)
+        os.makedirs(split_dir, exist_ok=True)
+        self.work_queue = None
+        if args.scheduler == "dynamic":
+            self.work_queue = WorkQueue(os.path.abspath(os.path.join(split_dir, f"{args.split}_work_queue.json")))
+
+        if manifest is None:
+            self.manifest = {"argv" : argv, "scheduler" : args.scheduler, "status" : RUNNING, "workers" : []}
+            self.create_workers()
+        else:
+            self.manifest = manifest
+            self.manifest["status"] = RUNNING
+            self.resume_workers()
+        self.save_manifest()
+
+    def save_manifest(self):
+        write_json_atomic(self.manifest_path, self.manifest)
+
+    def new_worker(self, worker_id: int, start: int, stop: int) -> dict:
+        return {
+            "worker_id" : str(worker_id),
+            "shard_id" : str(worker_id),
+            "range" : [start, stop],
+            "devices" : None,
+            "checkpoint" : os.path.abspath(os.path.join(
+                self.args.output_dir, self.args.split,
+                get_split_filename(self.args.split, "checkpoint", self.args.filename_prefix, worker_id)
+            )),
+            "status" : PENDING,
+            "return_code" : None,
+            "restarts" : 0
+        }
+
+    def create_workers(self):
+        args = self.args
+        if self.work_queue is not None:
+            #every group takes chunks of images from a shared queue, faster groups render more images
+            self.work_queue.create(args.start_index, args.num_images, args.chunk_size)
+            ranges = [[args.start_index, args.num_images] for _ in self.gpu_groups]
+        else:
+            #check how fast each gpu group is
+            from SSHAPE_Dataset_generator.calibration import calibrate_groups
+            times = calibrate_groups(args, self.rules, self.manifest["argv"], self.gpu_groups)
+
+            #subdivide the number of images according to the speed of each group
+            ranges = divide_workloads(times, args.num_images - args.start_index)
+            ranges = [[start + args.start_index, stop + args.start_index] for start, stop in ranges]
+        print(ranges)
+
+        self.manifest["workers"] = [self.new_worker(i, start, stop) for i, (start, stop) in enumerate(ranges)]
+
+    def resume_workers(self):
+        # Marks the unfinished workers as pending, they'll be resumed from their checkpoints
+        workers = self.manifest["workers"]
+        if self.work_queue is None:
+            for worker in workers:
+                state = load_checkpoint_state(worker["checkpoint"])
+                if state is not None and state["img_index"] >= worker["range"][1]:
+                    worker["status"] = DONE
+                else:
+                    worker["status"] = PENDING
+            return
+
+        if self.is_complete():
+            return
+
+        #resume one worker for every gpu group available, the chunks of the others go back to the queue
+        for i, worker in enumerate(workers):
+            if i < len(self.gpu_groups):
+                worker["status"] = PENDING
+            else:
+                self.work_queue.release_worker(worker["worker_id"])
+        for i in range(len(workers), len(self.gpu_groups)):
+            workers.append(self.new_worker(i, self.args.start_index, self.args.num_images))
+
+    def get_worker_argv(self, worker: dict, devices: list) -> list:
+        args = self.args
+        #workers which already ran in this run (before it was interrupted or before a restart) have devices,
+        #the checkpoints of other runs left in the output directory are replaced instead of being resumed
+        if worker["devices"] is not None and os.path.exists(os.path.join(worker["checkpoint"], BASE_FILENAME)):
+            #arguments given after '--resume' override the ones in the checkpoint
+            worker_argv = ["--resume", worker["checkpoint"]]
+        else:
+            worker_argv = self.manifest["argv"].copy()
+        return change_args(
+            args=worker_argv,
+            resume=worker["checkpoint"] if worker_argv[0] == "--resume" else None,
+            start_index=worker["range"][0],
+            num_images=worker["range"][1],
+            use_multiple_gpus=0,
+            gpu_groups=None,
+            work_queue=self.work_queue.path if self.work_queue is not None else None,
+            worker_id=worker["worker_id"],
+            shard_id=worker["shard_id"],
+            **get_group_args(devices)
+        )
+
+    def start_worker(self, worker: dict, devices: list):
+        worker_argv = self.get_worker_argv(worker, devices)
+        print(f"Starting worker {worker['worker_id']} on devices {devices}")
+        self.processes[worker["worker_id"]] = start_process(
+            worker_argv, get_heartbeat_path(self.args, worker["shard_id"]),
+            preexec_fn=get_pinning(devices) #cpu workers only use their own cores
+        )
+        worker["devices"] = devices
+        worker["status"] = RUNNING
+        self.save_manifest()
+
+    def finish_worker(self, worker: dict, return_code: int):
+        worker["return_code"] = return_code
+        if self.stopping:
+            worker["status"] = INTERRUPTED
+        elif return_code == EXIT_RESTART and worker.get("restarts", 0) < self.args.max_restarts:
+            #hung or over the memory limit, it resumes from its checkpoint and takes back its chunks
+            worker["restarts"] = worker.get("restarts", 0) + 1
+            worker["status"] = PENDING
+            print(f"Restarting worker {worker['worker_id']} ({worker['restarts']} of {self.args.max_restarts})")
+        elif return_code != 0:
+            worker["status"] = FAILED
+            print(f"Worker {worker['worker_id']} exited with code {return_code}")
+            if self.work_queue is not None: #give its chunks to the workers still running
+                self.work_queue.release_worker(worker["worker_id"])
+        elif self.work_queue is None:
+            state = load_checkpoint_state(worker["checkpoint"])
+            worker["status"] = DONE if state is not None and state["img_index"] >= worker["range"][1] else INTERRUPTED
+        else:
+            worker["status"] = DONE
+        self.save_manifest()
+
+    def stop(self, sig, frm):
+        #forwards the signal to every worker, they stop after the current image and save a checkpoint
+        print("Stopping all the workers, the run can be resumed with: " + f"--resume {self.manifest_path}")
+        self.stopping = True
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.send_signal(sig)
+
+    def run(self):
+        # Runs the pending workers, when there are more workers than gpu groups (e.g. resuming a static run
+        # on fewer groups) a worker is started as soon as a group is free
+        workers = {worker["worker_id"] : worker for worker in self.manifest["workers"]}
+        pending = [worker for worker in self.manifest["workers"] if worker["status"] == PENDING]
+        free_groups = list(self.gpu_groups)
+        running = {} #worker_id -> devices
+
+        while len(running) > 0 or (len(pending) > 0 and not self.stopping):
+            while len(pending) > 0 and len(free_groups) > 0 and not self.stopping:
+                worker = pending.pop(0)
+                devices = free_groups.pop(0)
+                self.start_worker(worker, devices)
+                running[worker["worker_id"]] = devices
+
+            for worker_id in list(running):
+                return_code = self.processes[worker_id].poll()
+                if return_code is None:
+                    hung_index = get_hung_image(
+                        get_heartbeat_path(self.args, workers[worker_id]["shard_id"]), self.args.image_timeout
+                    )
+                    if hung_index is None or self.stopping:
+                        continue
+                    return_code = kill_hung_process(
+                        self.processes[worker_id], hung_index, get_quarantine_path(self.args)
+                    )
+                free_groups.append(running.pop(worker_id))
+                self.finish_worker(workers[worker_id], return_code)
+                if workers[worker_id]["status"] == PENDING: #restarted
+                    pending.append(workers[worker_id])
+            time.sleep(1)
+
+        if self.work_queue is not None:
+            print("Work queue:", self.work_queue.get_summary())
+
+        if self.is_complete():
+            self.manifest["status"] = DONE
+            self.save_manifest()
+            self.merge_annotations()
+        else:
+            self.manifest["status"] = INTERRUPTED
+            self.save_manifest()
+            print(f"The run is not complete, resume it with: --resume {self.manifest_path}")
+
+    def is_complete(self) -> bool:
+        #returns true if every image has been rendered
+        if self.work_queue is not None:
+            summary = self.work_queue.get_summary()
+            return summary["chunks"]["pending"] + summary["chunks"]["leased"] == 0
+        return all(worker["status"] == DONE for worker in self.manifest["workers"])
+
+    def merge_annotations(self):
+        #every worker wrote its own annotations shard, merge them into the annotations of the split
+        args = self.args
+        split_dir = os.path.join(args.output_dir, args.split)
+        annotations_path = os.path.join(split_dir, get_split_filename(args.split, "annotations.json", args.filename_prefix))
+        shard_stats = merge_shards(
+            find_shards(split_dir, args.split, args.filename_prefix),
+            annotations_path,
+            self.work_queue.path if self.work_queue is not None else None
+        )
+        print("Annotation shards:", shard_stats)
+        print(f"Merged annotations saved in: {annotations_path}")
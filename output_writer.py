@@ -0,0 +1,131 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os, threading, queue, time
+import cv2
+import numpy as np
+
+class OutputWriterPool:
+    # Encodes and writes images on background threads so the next scene can be built and rendered while
+    # the outputs of the previous one are still being written.
+    # The queue is bounded, when it's full submit() blocks until a writer frees a slot (backpressure), so
+    # pending images can't pile up in memory if the disk is slower than the renderer.
+    # NOTE: cv2.imwrite releases the GIL while encoding, so threads are enough to write in parallel.
+
+    def __init__(self, num_threads: int = 2, queue_size: int = 8, png_compression: int = 3):
+        # Args:
+        # - num_threads (int): number of writer threads, if 0 images are written synchronously
+        # - queue_size (int): maximum number of images waiting to be written
+        # - png_compression (int): PNG compression level from 0 (fastest) to 9 (smallest)
+        self.png_compression = png_compression
+        self.queue = queue.Queue(maxsize=max(queue_size, 1))
+        self.lock = threading.Lock()
+        self.error = None
+        self.stats = {
+            "submitted" : 0,
+            "written" : 0,
+            "bytes" : 0,
+            "write_time" : 0,
+            "blocked_time" : 0, #time spent waiting for a free slot in the queue
+            "max_queue_depth" : 0
+        }
+
+        self.threads = []
+        for i in range(num_threads):
+            thread = threading.Thread(target=self.worker, name=f"OutputWriter_{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def get_params(self, path: str) -> list:
+        if path.lower().endswith(".png"):
+            return [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+        return []
+
+    def write(self, path: str, image: np.ndarray, params: list = None):
+        start_time = time.time()
+        if params is None:
+            params = self.get_params(path)
+        if not cv2.imwrite(path, image, params):
+            raise Exception(f"Could not write image: {path}")
+        with self.lock:
+            self.stats["written"] += 1
+            self.stats["bytes"] += os.path.getsize(path)
+            self.stats["write_time"] += time.time() - start_time
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.write(*item)
+            except Exception as e:
+                with self.lock:
+                    if self.error is None:
+                        self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check_error(self):
+        # Raises the first error which happened on a writer thread
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, path: str, image: np.ndarray, params: list = None):
+        # Queues an image to be written, blocks if the queue is full
+        # NOTE: The image must not be modified after being submitted
+        # Args:
+        # - path (str): path of the file to write, the format is chosen from its extension
+        # - image (np.ndarray): image to write
+        # - params (list): OpenCV encoding parameters, if None the default ones of the format are used
+        self.check_error()
+        self.stats["submitted"] += 1
+        if len(self.threads) == 0:
+            self.write(path, image, params)
+            return
+
+        start_time = time.time()
+        self.queue.put((path, image, params))
+        with self.lock:
+            self.stats["blocked_time"] += time.time() - start_time
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self.queue.qsize())
+
+    def flush(self):
+        # Waits until every queued image has been written
+        self.queue.join()
+        self.check_error()
+
+    def close(self):
+        # Writes every queued image and stops the writer threads, the threads are stopped even if an image
+        # could not be written
+        try:
+            self.flush()
+        finally:
+            for _ in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+        stats["queue_depth"] = self.queue.qsize()
+        return stats
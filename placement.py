@@ -0,0 +1,122 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import random
+from math import ceil, floor
+import numpy as np
+
+class PlacementEngine:
+    # Places shapes in the working area respecting their minimum distances.
+    # Placed shapes are stored in NumPy arrays and indexed by a uniform grid on the xy plane, candidate
+    # positions are drawn in batches and checked all at once against the shapes in the nearby cells.
+
+    def __init__(self, area_size: float, padding: float, batch_size=32, max_attempts=200, cells_per_side=8, rng=None):
+        # Args:
+        # - area_size (float): size of the working area
+        # - padding (float): minimum distance between the positions and the area boundaries
+        # - batch_size (int): number of candidates drawn at once
+        # - max_attempts (int): maximum number of candidates drawn for a shape before giving up
+        # - cells_per_side (int): number of grid cells along each side of the working area
+        # - rng (np.random.Generator): random generator, if None one is seeded from the random module
+        self.low = padding - area_size / 2
+        self.high = area_size / 2 - padding
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.cell_size = max(area_size / cells_per_side, 1e-6)
+        self.rng = rng if rng is not None else np.random.default_rng(random.getrandbits(64))
+        self.reset()
+
+    def reset(self):
+        # Removes all the placed shapes, must be called at the start of every scene
+        self.positions = np.empty((0, 3), dtype=np.float64)
+        self.radii = np.empty(0, dtype=np.float64)
+        self.grid = {} #(x cell, y cell) -> list of indices of the shapes in it
+        self.max_radius = 0
+        self.stats = {
+            "placed" : 0,
+            "failed" : 0,
+            "attempts" : 0,
+            "batches" : 0
+        }
+
+    def get_cell(self, position) -> tuple:
+        return (floor(position[0] / self.cell_size), floor(position[1] / self.cell_size))
+
+    def add(self, position, radius: float):
+        # Adds a shape placed elsewhere, e.g. when rebuilding a scene
+        index = len(self.radii)
+        self.positions = np.vstack([self.positions, np.asarray(position, dtype=np.float64).reshape(1, 3)])
+        self.radii = np.append(self.radii, radius)
+        self.grid.setdefault(self.get_cell(position), []).append(index)
+        self.max_radius = max(self.max_radius, radius)
+
+    def get_neighbours(self, candidates: np.ndarray, radius: float) -> np.ndarray:
+        # Returns the indices of the placed shapes which could be closer than allowed to any candidate
+        if len(self.radii) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        reach = ceil((radius + self.max_radius) / self.cell_size)
+        cells = set()
+        for cell in {self.get_cell(c) for c in candidates}:
+            for dx in range(-reach, reach + 1):
+                for dy in range(-reach, reach + 1):
+                    cells.add((cell[0] + dx, cell[1] + dy))
+
+        indices = [i for cell in cells for i in self.grid.get(cell, [])]
+        return np.array(sorted(indices), dtype=np.int64)
+
+    def check_candidates(self, candidates: np.ndarray, radius: float) -> np.ndarray:
+        # Returns a boolean array, true for every candidate respecting the minimum distances
+        neighbours = self.get_neighbours(candidates, radius)
+        if len(neighbours) == 0:
+            return np.ones(len(candidates), dtype=bool)
+
+        distances = np.linalg.norm(candidates[:, None, :] - self.positions[None, neighbours, :], axis=2)
+        return np.all(distances >= self.radii[neighbours][None, :] + radius, axis=1)
+
+    def place(self, radius: float, z=None):
+        # Returns a valid position for a shape and adds it to the placed ones, None if no position was found
+        # Args:
+        # - radius (float): minimum distance of the shape, scaled like the shape
+        # - z (float): fixed height of the shape (e.g. when it lies on the plane), random if None
+        attempts = 0
+        while attempts < self.max_attempts:
+            size = min(self.batch_size, self.max_attempts - attempts)
+            candidates = self.rng.uniform(self.low, self.high, size=(size, 3))
+            if z is not None:
+                candidates[:, 2] = z
+
+            self.stats["batches"] += 1
+            valid = np.flatnonzero(self.check_candidates(candidates, radius))
+            if len(valid) > 0:
+                attempts += int(valid[0]) + 1
+                self.stats["attempts"] += attempts
+                self.stats["placed"] += 1
+                position = candidates[valid[0]]
+                self.add(position, radius)
+                return [float(k) for k in position]
+
+            attempts += size
+
+        self.stats["attempts"] += attempts
+        self.stats["failed"] += 1
+        return None
+
+    def get_stats(self) -> dict:
+        return dict(self.stats)
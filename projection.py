@@ -0,0 +1,87 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+import bpy #type: ignore
+
+def get_render_size(scene=None) -> tuple:
+    # Returns the size in pixels of the rendered images, taking resolution_percentage into account
+    if scene is None:
+        scene = bpy.context.scene
+    render = scene.render
+    scale = render.resolution_percentage / 100
+    return int(render.resolution_x * scale), int(render.resolution_y * scale)
+
+def get_object_matrix(obj) -> np.ndarray:
+    # Returns the 4x4 world matrix of an object
+    # NOTE: matrix_world is only refreshed when the depsgraph is evaluated, for objects without
+    #       a parent matrix_basis is equivalent and always reflects the last changes.
+    if obj.parent is None:
+        return np.array(obj.matrix_basis, dtype=np.float64)
+    return np.array(obj.matrix_world, dtype=np.float64)
+
+def get_view_projection_matrix(camera_obj, scene=None) -> np.ndarray:
+    # Returns the 4x4 matrix transforming world coordinates into clip coordinates of the camera
+    if scene is None:
+        scene = bpy.context.scene
+    width, height = get_render_size(scene)
+    projection = camera_obj.calc_matrix_camera(
+        bpy.context.evaluated_depsgraph_get(),
+        x=width,
+        y=height,
+        scale_x=scene.render.pixel_aspect_x,
+        scale_y=scene.render.pixel_aspect_y
+    )
+    return np.array(projection, dtype=np.float64) @ np.linalg.inv(get_object_matrix(camera_obj))
+
+def get_mesh_coordinates(mesh) -> np.ndarray:
+    # Returns an (N, 3) array with the local coordinates of every vertex of a mesh
+    coords = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", coords)
+    return coords.reshape(-1, 3)
+
+def project_points(points: np.ndarray, matrix: np.ndarray, view_projection: np.ndarray, render_size: tuple) -> np.ndarray:
+    # Projects points to pixel coordinates, origin is the top left corner of the image
+    # Args:
+    # - points (np.ndarray): (N, 3) array of points in local coordinates
+    # - matrix (np.ndarray): 4x4 matrix transforming the points to world coordinates
+    # - view_projection (np.ndarray): 4x4 view projection matrix of the camera
+    # - render_size (tuple): width and height of the rendered image
+    homogeneous = np.empty((len(points), 4), dtype=np.float64)
+    homogeneous[:, :3] = points
+    homogeneous[:, 3] = 1
+
+    clip = homogeneous @ (view_projection @ matrix).T
+    ndc = clip[:, :2] / clip[:, 3:4]
+
+    pixels = np.empty_like(ndc)
+    pixels[:, 0] = (ndc[:, 0] + 1) / 2 * render_size[0]
+    pixels[:, 1] = (1 - ndc[:, 1]) / 2 * render_size[1] #y axis points down in images
+    return pixels
+
+def get_points_bounding_box(pixels: np.ndarray) -> list:
+    # Returns the COCO bounding box [x, y, width, height] enclosing the projected points
+    lowest = np.rint(pixels.min(axis=0)).astype(int)
+    highest = np.rint(pixels.max(axis=0)).astype(int)
+    return [
+        int(lowest[0]),
+        int(lowest[1]),
+        int(highest[0] - lowest[0]),
+        int(highest[1] - lowest[1])
+    ]
@@ -0,0 +1,196 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+import bpy #type: ignore
+from SSHAPE_Dataset_generator.projection import get_render_size, get_object_matrix, get_view_projection_matrix
+
+MAX_CANDIDATES = 1 << 22 #maximum number of (triangle, pixel) pairs tested at once, bounds the memory used
+
+def get_mesh_triangles(mesh) -> tuple:
+    # Returns the local coordinates of the vertices, (N, 3), and the vertex indices of the triangles, (M, 3),
+    # of a mesh
+    mesh.calc_loop_triangles()
+    coords = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", coords)
+    triangles = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get("vertices", triangles)
+    return coords.reshape(-1, 3), triangles.reshape(-1, 3)
+
+def rasterize_triangles(screen: np.ndarray, inv_depth: np.ndarray, ids: np.ndarray, render_size: tuple) -> tuple:
+    # Z-buffers triangles already projected to the image, vectorized over the triangles: every triangle is
+    # tested against all the pixels of its bounding box at once.
+    # Returns the depth buffer (inf where no triangle is visible) and the id buffer (0 where no triangle
+    # is visible).
+    # Args:
+    # - screen (np.ndarray): (T, 3, 2) pixel coordinates of the vertices of every triangle
+    # - inv_depth (np.ndarray): (T, 3) inverse of the depth of every vertex, interpolated linearly in the
+    #                           image (perspective correct depth)
+    # - ids (np.ndarray): (T,) id of the object of every triangle, > 0
+    # - render_size (tuple): width and height of the image
+    width, height = render_size
+    depth_buffer = np.full(width * height, np.inf, dtype=np.float32)
+    id_buffer = np.zeros(width * height, dtype=np.int32)
+
+    a, b, c = screen[:, 0], screen[:, 1], screen[:, 2]
+    area = (b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0])
+
+    #pixels whose center (x + 0.5, y + 0.5) can be inside the triangle
+    x0 = np.clip(np.ceil(screen[:, :, 0].min(axis=1) - 0.5), 0, width).astype(np.int64)
+    x1 = np.clip(np.floor(screen[:, :, 0].max(axis=1) - 0.5), -1, width - 1).astype(np.int64)
+    y0 = np.clip(np.ceil(screen[:, :, 1].min(axis=1) - 0.5), 0, height).astype(np.int64)
+    y1 = np.clip(np.floor(screen[:, :, 1].max(axis=1) - 0.5), -1, height - 1).astype(np.int64)
+    nx = x1 - x0 + 1
+    ny = y1 - y0 + 1
+
+    keep = (nx > 0) & (ny > 0) & (area != 0) #outside of the image or degenerate
+    a, b, c, area, inv_depth, ids = a[keep], b[keep], c[keep], area[keep], inv_depth[keep], ids[keep]
+    x0, y0, nx, ny = x0[keep], y0[keep], nx[keep], ny[keep]
+    candidates = nx * ny
+    if len(candidates) == 0:
+        return depth_buffer.reshape(height, width), id_buffer.reshape(height, width)
+
+    #split the triangles in chunks of at most MAX_CANDIDATES pairs (a bigger triangle gets its own chunk)
+    ends = np.cumsum(candidates)
+    start = 0
+    while start < len(candidates):
+        done = ends[start - 1] if start > 0 else 0
+        stop = max(int(np.searchsorted(ends, done + MAX_CANDIDATES, side="right")), start + 1)
+        chunk = np.arange(start, stop)
+        start = stop
+
+        tri = np.repeat(chunk, candidates[chunk])
+        offset = np.arange(len(tri)) - np.repeat(np.cumsum(candidates[chunk]) - candidates[chunk], candidates[chunk])
+        px = x0[tri] + offset % nx[tri]
+        py = y0[tri] + offset // nx[tri]
+        cx = px + 0.5
+        cy = py + 0.5
+
+        #barycentric coordinates, dividing by the signed area makes them positive inside for both windings
+        ta, tb, tc = a[tri], b[tri], c[tri]
+        wa = ((tc[:, 0] - tb[:, 0]) * (cy - tb[:, 1]) - (tc[:, 1] - tb[:, 1]) * (cx - tb[:, 0])) / area[tri]
+        wb = ((ta[:, 0] - tc[:, 0]) * (cy - tc[:, 1]) - (ta[:, 1] - tc[:, 1]) * (cx - tc[:, 0])) / area[tri]
+        wc = 1 - wa - wb
+        inside = (wa >= 0) & (wb >= 0) & (wc >= 0)
+
+        tri, wa, wb, wc = tri[inside], wa[inside], wb[inside], wc[inside]
+        pixel = py[inside] * width + px[inside]
+        depth = (1 / (wa * inv_depth[tri, 0] + wb * inv_depth[tri, 1] + wc * inv_depth[tri, 2])).astype(np.float32)
+
+        #z-buffer, the fragments left with the depth of their pixel are the visible ones
+        np.minimum.at(depth_buffer, pixel, depth)
+        visible = depth == depth_buffer[pixel]
+        id_buffer[pixel[visible]] = ids[tri[visible]]
+
+    return depth_buffer.reshape(height, width), id_buffer.reshape(height, width)
+
+def get_visible_bounding_boxes(id_buffer: np.ndarray, count: int) -> list:
+    # Returns the COCO bounding box [x, y, width, height] of the visible pixels of every id from 1 to
+    # 'count', None for ids without visible pixels
+    ys, xs = np.nonzero(id_buffer)
+    ids = id_buffer[ys, xs]
+    lowest_x = np.full(count + 1, np.iinfo(np.int64).max)
+    lowest_y = np.full(count + 1, np.iinfo(np.int64).max)
+    highest_x = np.full(count + 1, -1)
+    highest_y = np.full(count + 1, -1)
+    np.minimum.at(lowest_x, ids, xs)
+    np.minimum.at(lowest_y, ids, ys)
+    np.maximum.at(highest_x, ids, xs)
+    np.maximum.at(highest_y, ids, ys)
+
+    boxes = []
+    for i in range(1, count + 1):
+        if highest_x[i] < 0:
+            boxes.append(None)
+        else:
+            boxes.append([
+                int(lowest_x[i]),
+                int(lowest_y[i]),
+                int(highest_x[i] - lowest_x[i] + 1),
+                int(highest_y[i] - lowest_y[i] + 1)
+            ])
+    return boxes
+
+class RasterGroundTruth:
+    # Creates instance masks, depth and tight bounding boxes without rendering: the triangles of every
+    # visible mesh are projected with the camera matrices and z-buffered in NumPy.
+    # NOTE: Triangles with a vertex closer to the camera than its clip start are skipped instead of clipped,
+    #       with the default camera distance this only happens to shapes in front of the camera.
+
+    def __init__(self, camera_obj, scene=None):
+        self.camera_obj = camera_obj
+        self.scene = bpy.context.scene if scene is None else scene
+
+    def get_objects(self) -> list:
+        # Returns the meshes which would be rendered
+        return [
+            obj for obj in self.scene.objects
+            if obj.type == "MESH" and not obj.hide_render and obj.data is not None and len(obj.data.polygons) > 0
+        ]
+
+    def render(self, objects=None, scale: float = 1) -> dict:
+        # Returns the ground truth of the current scene, same format as bpycv.render_data:
+        # 'inst' (instance id of every pixel, 0 for background) and 'depth' (in meters, 0 for background),
+        # plus 'objects' (the rasterized objects), 'boxes' (visible bounding box of every object) and
+        # 'pixels' (number of visible pixels of every object)
+        # Args:
+        # - objects (list): objects to rasterize, if None every mesh which would be rendered
+        # - scale (float): scale of the image compared to the render resolution, e.g. 0.25 for a quick check
+        if objects is None:
+            objects = self.get_objects()
+        width, height = get_render_size(self.scene)
+        render_size = (max(int(width * scale), 1), max(int(height * scale), 1))
+        view_projection = get_view_projection_matrix(self.camera_obj, self.scene)
+        near = self.camera_obj.data.clip_start
+
+        screen, inv_depth, ids = [], [], []
+        for i, obj in enumerate(objects):
+            coords, triangles = get_mesh_triangles(obj.data)
+            homogeneous = np.empty((len(coords), 4), dtype=np.float64)
+            homogeneous[:, :3] = coords
+            homogeneous[:, 3] = 1
+            clip = homogeneous @ (view_projection @ get_object_matrix(obj)).T
+            clip_w = clip[:, 3] #depth along the view direction
+
+            triangles = triangles[(clip_w[triangles] > near).all(axis=1)]
+            pixels = np.empty((len(clip), 2), dtype=np.float64)
+            with np.errstate(divide="ignore", invalid="ignore"): #vertices behind the camera are not used
+                pixels[:, 0] = (clip[:, 0] / clip_w + 1) / 2 * render_size[0]
+                pixels[:, 1] = (1 - clip[:, 1] / clip_w) / 2 * render_size[1]
+                screen.append(pixels[triangles])
+                inv_depth.append(1 / clip_w[triangles])
+            ids.append(np.full(len(triangles), i + 1, dtype=np.int32))
+
+        if len(objects) == 0:
+            depth_buffer = np.full((render_size[1], render_size[0]), np.inf, dtype=np.float32)
+            id_buffer = np.zeros((render_size[1], render_size[0]), dtype=np.int32)
+        else:
+            depth_buffer, id_buffer = rasterize_triangles(
+                np.concatenate(screen), np.concatenate(inv_depth), np.concatenate(ids), render_size
+            )
+
+        inst_ids = np.array([0] + [obj.get("inst_id", 0) for obj in objects], dtype=np.int32)
+        depth_buffer[np.isinf(depth_buffer)] = 0
+        return {
+            "inst" : inst_ids[id_buffer],
+            "depth" : depth_buffer,
+            "objects" : objects,
+            "boxes" : get_visible_bounding_boxes(id_buffer, len(objects)),
+            "pixels" : np.bincount(id_buffer.ravel(), minlength=len(objects) + 1)[1:]
+        }
@@ -19,17 +19,41 @@ If not, see <https://www.gnu.org/licenses/>.
 
 try: #tqdm is not built in, if not installed it will be skipped
     from tqdm import tqdm 
+    has_tqdm = True
 except ImportError:
     tqdm = lambda k: k
+    has_tqdm = False
 
 from datetime import datetime
+import time
 from math import sin, cos, radians, degrees, sqrt
-import random, os, json
+import random, os, json, tempfile
 from random import randint
 from SSHAPE_Dataset_generator.errors import *
 from SSHAPE_Dataset_generator.utils import *
 from SSHAPE_Dataset_generator.categories import create_categories_list, get_category_name
-from SSHAPE_Dataset_generator.configure_gpus import set_render_args
+from SSHAPE_Dataset_generator.configure_gpus import set_render_args, load_render_profile
+from SSHAPE_Dataset_generator.asset_cache import AssetCache
+from SSHAPE_Dataset_generator.scene_pool import ScenePool
+from SSHAPE_Dataset_generator.geometry_cache import GeometryCache, choose_resting_face, get_transformed_ground_offset
+from SSHAPE_Dataset_generator.placement import PlacementEngine
+from SSHAPE_Dataset_generator.scene_plan import (sample_camera_position, sample_lights_positions, sample_appearance,
+                                                 sample_scale, sample_rotation, sample_flips, get_signed_scale,
+                                                 ScenePlanReader)
+from SSHAPE_Dataset_generator.memory_utils import get_datablock_counts, get_process_rss, purge_orphans
+from SSHAPE_Dataset_generator.run_log import RunLog
+from SSHAPE_Dataset_generator.annotation_writer import StreamingAnnotationWriter, assemble_annotations
+from SSHAPE_Dataset_generator.checkpoint import CheckpointWriter
+from SSHAPE_Dataset_generator.scheduler import WorkQueue
+from SSHAPE_Dataset_generator.output_writer import OutputWriterPool
+from SSHAPE_Dataset_generator.telemetry import Telemetry, PrometheusTextfile
+from SSHAPE_Dataset_generator.ground_truth import PassesGroundTruth
+from SSHAPE_Dataset_generator.rasterizer import RasterGroundTruth
+from SSHAPE_Dataset_generator.supervisor import retry, Quarantine, ImageHeartbeat, EXIT_RESTART, get_quarantine_path
+from SSHAPE_Dataset_generator.image_formats import (get_filename, get_cv2_params, get_segmentation_params,
+                                                    encode_depth, set_blender_format, check_format)
+from SSHAPE_Dataset_generator.projection import (get_render_size, get_object_matrix, get_view_projection_matrix,
+                                                 get_mesh_coordinates, project_points, get_points_bounding_box)
 from icecream import ic
 import numpy as np
 
@@ -39,35 +63,25 @@ from bpy import context #type: ignore
 from mathutils import Vector, Color #type: ignore
 import bpycv, cv2
 
-#Shapes with random_rotation.snap set to auto will have the normal of a random face aligned with this vector
-#NOTE: Right now changing this vector is not properly supported
-AUTO_ROTATION_VECT = mathutils.Vector((0, 0, -1))
+# Arguments which change the state kept by the renderer between jobs (see 'DatasetRenderer.reset'),
+# a job which changes any of them needs a new renderer
+WARM_ARGS = [
+    "base_scene", "materials_dir", "objects_dir", "decoys_dir", "area_size", "use_asset_cache", "pooled_scene",
+    "use_geometry_cache", "geometry_cache_dir", "ground_truth_method", "use_devices", "render_profile",
+    "render_profiles_file", "images_width", "images_height", "device_type", "cpu_threads", "cpu_cores",
+    "render_engine", "preview_scale", "render_rgb"
+]
 
 class DatasetRenderer:
     def __init__(self, args, rules, checkpoint=None):
         self.args = args
         self.rules = rules
-        self.annotations = checkpoint["annotations"] if checkpoint else None 
-        self.state = checkpoint["state"] if checkpoint else None #Stores rendering progression
-        self.run = True
-
-        if checkpoint:
-            self.annotations = checkpoint["annotations"]
-            self.state = checkpoint["state"]
-        else:
-            self.annotations = {
-                "info" : self.create_info(),
-                "licenses" : self.get_licenses(),
-                "images" : [],
-                "annotations" : [],
-                "scenes" : [],
-                "categories" : create_categories_list(self.rules)
-            }
-            self.state = {
-                "img_index" : self.args.start_index,
-                "shape_index" : 0
-            }
-
+        self.asset_cache = AssetCache() if args.use_asset_cache == 1 or args.pooled_scene == 1 else None
+        self.scene_pool = ScenePool(self.asset_cache) if args.pooled_scene == 1 else None
+        self.geometry_cache = None
+        if args.use_geometry_cache == 1:
+            self.geometry_cache = GeometryCache(args.geometry_cache_dir, self.asset_cache or AssetCache())
+            self.geometry_cache.build(self.rules, args.objects_dir, args.decoys_dir)
 
         #INITIALIZE SCENE
         scene = bpy.context.scene
@@ -82,6 +96,7 @@ class DatasetRenderer:
 
         scene.collection.objects.link(self.camera_obj)
         scene.camera = self.camera_obj
+        self.view_projection = None
         
         render_args = bpy.context.scene.render
         """
@@ -105,23 +120,137 @@ class DatasetRenderer:
         bpy.context.scene.cycles.transparent_min_bounces = 6
         bpy.context.scene.cycles.transparent_max_bounces = 8
         """
-        set_render_args(self.args.use_devices)
-        print("Rendering with devices:", self.args.use_devices)
+        self.render_profile = load_render_profile(args.render_profile, args.render_profiles_file, args.device_type)
+        set_render_args(
+            self.args.use_devices, self.render_profile, (args.images_width, args.images_height), args.cpu_threads,
+            args.render_engine, 100 if args.render_engine == "CYCLES" else args.preview_scale
+        )
+        print("Rendering with devices:", self.args.use_devices, "- profile:", args.render_profile,
+              "- engine:", args.render_engine)
+
+        self.passes_ground_truth = None
+        if args.ground_truth_method == "passes":
+            if args.render_engine != "CYCLES": #the object index pass is only available in cycles
+                raise Exception("'passes' ground truth method requires the CYCLES render engine")
+            self.passes_ground_truth = PassesGroundTruth()
+        self.raster_ground_truth = None
+        if args.ground_truth_method == "raster":
+            self.raster_ground_truth = RasterGroundTruth(self.camera_obj)
+        if args.render_rgb == 0 and args.ground_truth_method != "raster": #the other methods need the render
+            raise Exception("'render_rgb 0' requires the 'raster' ground truth method")
+        #checks every scene before rendering it (see 'check_scene')
+        self.prepass = self.raster_ground_truth or RasterGroundTruth(self.camera_obj)
+        self.prepass_path = os.path.join(tempfile.gettempdir(), f"sshape_prepass_{os.getpid()}.png")
 
         #add primitive plane  
         self.primitive_plane = bpy.ops.mesh.primitive_plane_add(size=args.area_size)
 
         #load materials
         self.load_materials()
-        self.create_directory_tree()
 
-        #
-        render_scale = render_args.resolution_percentage / 100
-        self.render_size = (
-            int(render_args.resolution_x * render_scale),
-            int(render_args.resolution_y * render_scale)
+        self.run_log = None
+        self.annotation_writer = None
+        self.reset(args, checkpoint)
+
+    def is_compatible(self, args, rules) -> bool:
+        #returns true if a job with these arguments and rules can be rendered by calling 'reset'
+        if rules.get_dict() != self.rules.get_dict():
+            return False
+        return all(getattr(args, arg) == getattr(self.args, arg) for arg in WARM_ARGS)
+
+    def reset(self, args, checkpoint=None):
+        # Prepares the renderer for a new job, keeping the base scene, the loaded materials and the caches
+        # Args:
+        # - args: arguments of the job, must be compatible (see 'is_compatible')
+        # - checkpoint: checkpoint to resume, None to start a new job
+        self.args = args
+        self.run = True
+        self.exit_code = 0 #EXIT_RESTART if the process must be restarted
+        self.render_size = get_render_size()
+        self.placement = PlacementEngine(
+            args.area_size,
+            args.padding,
+            batch_size=args.placement_batch_size,
+            max_attempts=args.max_placement_attempts
         )
 
+        if checkpoint:
+            self.annotations = checkpoint["annotations"]
+            self.state = checkpoint["state"]
+        else:
+            self.annotations = {
+                "info" : self.create_info(),
+                "licenses" : self.get_licenses(),
+                "images" : [],
+                "annotations" : [],
+                "scenes" : [],
+                "categories" : create_categories_list(self.rules)
+            }
+            self.state = {
+                "img_index" : self.args.start_index,
+                "shape_index" : 0
+            }
+        self.state.setdefault("rejections", { #scenes discarded by the pre-pass
+            "scenes" : 0,
+            "rejected" : 0,
+            "too_few_pixels" : 0,
+            "exposure" : 0,
+            "kept_after_max_retries" : 0,
+            "prepass_time" : 0
+        })
+
+        self.set_output_format()
+        self.create_directory_tree()
+        #only workers of a multi gpu run with the dynamic scheduler get a work queue
+        self.work_queue = WorkQueue(args.work_queue) if args.work_queue is not None else None
+        #indexed once, every chunk of images seeks to its first record
+        self.scene_plan = ScenePlanReader(args.scene_plan) if args.scene_plan else None
+        if self.run_log is not None: self.run_log.close() #left open by the previous job
+        if self.annotation_writer is not None: self.annotation_writer.close()
+        self.run_log = RunLog(self.get_output_path("run_log.jsonl")) if args.create_run_log == 1 else None
+        if args.create_segmentations == 1: check_format(args.segmentation_format)
+        if args.create_depth == 1: check_format(args.depth_format)
+        self.output_writer = OutputWriterPool(args.writer_threads, args.writer_queue_size, args.png_compression)
+        self.annotation_writer = None
+        if args.stream_annotations == 1:
+            stream_path = self.get_output_path("annotations.jsonl")
+            stream_offset = self.state.get("stream_offset", None)
+            if checkpoint is None and os.path.exists(stream_path): #left by a previous run
+                os.remove(stream_path)
+            elif stream_offset is not None and os.path.exists(stream_path):
+                #drop images written after the checkpoint, they will be rendered again
+                os.truncate(stream_path, stream_offset)
+
+            self.annotation_writer = StreamingAnnotationWriter(
+                stream_path,
+                {key : self.annotations[key] for key in ["info", "licenses", "categories"]}
+            )
+
+        self.quarantine = Quarantine(get_quarantine_path(args))
+        #the parent process kills this one if an image hangs, the image is quarantined and skipped after the restart
+        self.heartbeat = ImageHeartbeat(args.heartbeat_file)
+
+        self.checkpoint_writer = CheckpointWriter(self.get_output_path("checkpoint"))
+        if checkpoint is not None and checkpoint.get("checkpoint_dir", None) == os.path.abspath(self.checkpoint_writer.directory):
+            self.checkpoint_writer.resume(checkpoint["next_seq"])
+        else:
+            self.checkpoint_writer.reset({
+                "state" : dict(self.state),
+                "args" : vars(self.args),
+                "rules" : self.rules.get_dict(),
+                "annotations" : self.annotations
+            })
+        self.checkpointed = {key : len(self.annotations[key]) for key in ["images", "annotations", "scenes"]}
+        self.last_checkpoint_time = time.time()
+        self.images_since_checkpoint = 0
+
+        textfile = None
+        if args.metrics_textfile is not None:
+            textfile = PrometheusTextfile(args.metrics_textfile, {
+                "split" : args.split, "shard" : args.shard_id, "engine" : args.render_engine
+            })
+        self.telemetry = Telemetry(textfile, print_every=0 if has_tqdm else args.progress_every)
+
     def create_directory_tree(self):
         #setup output directory tree
         os.makedirs(self.args.output_dir, exist_ok=True)
@@ -131,12 +260,51 @@ class DatasetRenderer:
             os.makedirs(os.path.join(self.args.output_dir, self.args.split, "segmentation"), exist_ok=True)
             os.makedirs(os.path.join(self.args.output_dir, self.args.split, "depth"), exist_ok=True)
 
-    def save_annotations(self):
+    def get_output_path(self, suffix):
+        #returns the path of a split level output file, e.g. '{prefix}_{split}_annotations.json', or
+        #'{prefix}_{split}_shard{shard_id}_annotations.json' if the renderer writes a shard of the split
         prefix = self.args.filename_prefix
-        filename = f"{prefix + '_' if prefix is not None else ''}{self.args.split}_annotations.json"
-        with open(os.path.join(self.args.output_dir, self.args.split, filename), "w") as f:
+        filename = get_split_filename(self.args.split, suffix, prefix, self.args.shard_id)
+        return os.path.join(self.args.output_dir, self.args.split, filename)
+
+    def save_annotations(self):
+        if self.annotation_writer is not None: #annotations are already on disk
+            assemble_annotations(self.annotation_writer.path, self.get_output_path("annotations.json"))
+            return
+
+        with open(self.get_output_path("annotations.json"), "w") as f:
             json.dump(self.annotations, f)
 
+    def get_image_ranges(self):
+        #yields the ranges [start, stop) of images to render, with the dynamic scheduler every range is a
+        #chunk taken from the work queue, which is marked as done once all its images are rendered
+        if self.work_queue is None:
+            yield self.state["img_index"], self.args.num_images
+            return
+
+        while self.run:
+            chunk = self.work_queue.claim(self.args.worker_id)
+            if chunk is None: #all the images are done
+                return
+            start, stop = chunk
+            if start <= self.state["img_index"] < stop: #chunk interrupted before a restart
+                start = self.state["img_index"]
+            yield start, stop
+            self.save_checkpoint() #the images of the chunk must be saved before it's marked as done
+            self.work_queue.complete(self.args.worker_id, *chunk)
+
+    def iter_images(self):
+        #yields the index of every image to render and its record in the scene plan (None if there's no plan)
+        for start, stop in self.get_image_ranges():
+            plan = self.scene_plan.iter_records(start, stop) if self.scene_plan is not None else None
+            for img_index in range(start, stop):
+                plan_record = None
+                if plan is not None:
+                    plan_record = next(plan, None)
+                    if plan_record is None or plan_record["image_id"] != img_index:
+                        raise Exception(f"The scene plan has no record for image {img_index}")
+                yield img_index, plan_record
+
     def render(self):
         #tarts rendering
         args = self.args
@@ -144,83 +312,157 @@ class DatasetRenderer:
         # --------------------------- RENDERING LOOP ---------------------------
 
         print(f"Starting from img_index: {self.state['img_index']}")
-        for img_index in tqdm(range(self.state["img_index"], args.num_images)):
+        for img_index, plan_record in tqdm(self.iter_images()):
             self.state["img_index"] = img_index
             if not self.run: break
+            if img_index in self.quarantine: #failed or hung before
+                self.state["img_index"] = img_index + 1
+                continue
+            self.heartbeat.start(img_index)
             prefix = args.filename_prefix #prefix for files
-            img_filename = f"{prefix + '_' if prefix is not None else ''}{img_index:010d}.png" #TODO: add support for other file formats
-
-            #image metadata
-            image_info = {
-                "id" : img_index,
-                "file_name" : img_filename,
-                "height" : args.images_height,
-                "width" : args.images_width,
-                "date_captured" : datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "license" : -1
-            }
-
-            #scene metadata
-            scene = {
-                "camera_position" : self.get_camera_position(),
-                "lights" : self.get_lights_positions(),
-                "objects" : [],
-                "decoys" : []
-            }
-
-            self.annotations["scenes"].append(scene)
-            self.annotations["images"].append(image_info)
-
-            self.populate_scene()
+            img_basename = f"{prefix + '_' if prefix is not None else ''}{img_index:010d}"
+            img_filename = get_filename(img_basename, args.image_format)
+            rollback = self.get_rollback_point()
+            image_info, scene = self.build_checked_scene(img_index, img_filename, plan_record)
 
             render_args = bpy.context.scene.render #set path for rendering
             render_args.filepath = os.path.abspath(
                 os.path.join(args.output_dir, args.split, "images", img_filename)
             )
 
+            failed = False
             if not args.test_mode:
-                while True:
-                    try:
-                        set_render_args(self.args.use_devices)
-                        bpy.ops.render.render(write_still=True)
-                        if args.create_segmentations == 1 or args.create_depth == 1:
-                            gnd_truth = bpycv.render_data(render_image=False)
-                            if args.create_segmentations == 1:
-                                segmentation_path = os.path.join(args.output_dir, args.split, "segmentation", img_filename)
-                                cv2.imwrite(segmentation_path, np.uint8(gnd_truth["inst"]))
-                            if args.create_depth == 1:
-                                depth_path = os.path.join(args.output_dir, args.split, "depth", img_filename)
-                                cv2.imwrite(depth_path, np.uint16(gnd_truth["depth"] * 1000)) #save depth in mm
-
-                        break
-                    except Exception as e:
-                        print(e)
-                        
-                self.clear_scene()
+                try:
+                    retry(lambda: self.render_image(img_basename), args.render_retries, args.retry_backoff,
+                          f"Image {img_index}")
+                except RenderFailedError as e: #skip the image, its annotations are removed
+                    self.quarantine.add(img_index, str(e))
+                    self.rollback(rollback)
+                    failed = True
+
+                with self.telemetry.stage("cleanup"):
+                    self.clear_scene()
+
+                    purged = 0
+                    if args.purge_every > 0 and (img_index + 1) % args.purge_every == 0:
+                        purged = purge_orphans()
+
+            with self.telemetry.stage("write"):
+                if self.annotation_writer is not None and not failed: #write the annotations of the image and drop them from memory
+                    self.annotation_writer.write_image(image_info, self.annotations["annotations"], scene)
+                    for key in ["images", "annotations", "scenes"]:
+                        self.annotations[key] = []
+                        self.checkpointed[key] = 0
+
+                self.state["img_index"] = img_index + 1
+                self.images_since_checkpoint += 1
+                if self.work_queue is not None: self.work_queue.heartbeat(args.worker_id)
+                if self.should_checkpoint():
+                    self.save_checkpoint()
+
+            rss = get_process_rss()
+            metrics = self.telemetry.finish_image( #remaining images are unknown with the dynamic scheduler
+                args.num_images - img_index - 1 if self.work_queue is None else None, rss
+            )
+            if self.run_log is not None and not args.test_mode:
+                self.run_log.log({
+                    "image_id" : img_index,
+                    "time" : datetime.now().isoformat(),
+                    "rss" : rss,
+                    "datablocks" : get_datablock_counts(),
+                    "purged" : purged,
+                    "writer" : self.output_writer.get_stats(),
+                    **metrics
+                })
+            self.heartbeat.stop()
 
+            if args.max_rss_mb > 0 and rss > args.max_rss_mb * 2 ** 20:
+                print(f"Memory used ({rss / 2 ** 20:.0f} MB) is over --max_rss_mb, the process will be restarted")
+                self.exit_code = EXIT_RESTART
+                self.run = False
+
+        self.output_writer.close()
+        rejections = self.get_rejection_summary()
+        if self.run_log is not None: self.run_log.log({"rejections" : rejections})
         self.save_annotations()
-        if not self.run: self.save_checkpoint()
+        checkpoint_path = self.save_checkpoint()
+        if not self.run: print(f"Checkpoint saved in: {checkpoint_path}")
+        if self.asset_cache is not None: self.asset_cache.print_stats()
+        print(f"Throughput ({self.args.render_engine}, {self.render_size[0]}x{self.render_size[1]}): " +
+              f"{self.telemetry.get_images_per_sec():.2f} images/s")
+        print(f"Scenes rejected by the pre-pass: {rejections['rejected']} of {rejections['scenes']} - " +
+              f"render time saved: {rejections['render_time_saved']:.1f}s")
+        print("Time per stage:", ", ".join(f"{stage}: {share:.1%}" for stage, share in self.telemetry.get_summary().items()))
+
+    def render_image(self, img_basename):
+        # Renders the current scene and writes its segmentation and depth
+        args = self.args
+        if args.render_rgb == 1:
+            with self.telemetry.stage("render"):
+                bpy.ops.render.render(write_still=True)
+        if args.create_segmentations == 1 or args.create_depth == 1 or self.raster_ground_truth:
+            with self.telemetry.stage("ground_truth"):
+                if self.raster_ground_truth is not None:
+                    gnd_truth = self.raster_ground_truth.render()
+                    self.set_visible_bounding_boxes(gnd_truth)
+                elif self.passes_ground_truth is not None: #taken from the passes of the render above
+                    gnd_truth = self.passes_ground_truth.read()
+                else:
+                    gnd_truth = bpycv.render_data(render_image=False)
+            with self.telemetry.stage("write"):
+                if args.create_segmentations == 1:
+                    segmentation_path = os.path.join(
+                        args.output_dir, args.split, "segmentation",
+                        get_filename(img_basename, args.segmentation_format)
+                    )
+                    self.output_writer.submit(
+                        segmentation_path, np.uint8(gnd_truth["inst"]),
+                        get_segmentation_params(args.segmentation_format, args.png_compression)
+                    )
+                if args.create_depth == 1:
+                    depth_path = os.path.join(
+                        args.output_dir, args.split, "depth", get_filename(img_basename, args.depth_format)
+                    )
+                    self.output_writer.submit( #depth in mm for png, in meters for exr
+                        depth_path, encode_depth(gnd_truth["depth"], args.depth_format),
+                        get_cv2_params(args.depth_format, args.png_compression)
+                    )
 
     def stop(self, sig, frm):
         #Args are signal and frame from the signal library, not important
         print("Interrupting rendering process and creating a checkpoint file.")
         self.run = False
 
-    def save_checkpoint(self):
-        checkpoint_path = os.path.join(
-            self.args.output_dir,
-            f"checkpoint_{datetime.now().isoformat().split('.')[0].replace(':','-')}.json"
+    def set_output_format(self):
+        #sets format, compression and quality of the images written by blender
+        set_blender_format(
+            bpy.context.scene.render.image_settings,
+            self.args.image_format, self.args.png_compression, self.args.image_quality
         )
 
-        checkpoint = {
-            "state" : self.state,
-            "args" : vars(self.args),
-            "rules" : self.rules.get_dict(),
-            "annotations" : self.annotations
-        }
+    def should_checkpoint(self):
+        #returns true if enough images or time have passed since the last checkpoint
+        if self.args.checkpoint_every > 0 and self.images_since_checkpoint >= self.args.checkpoint_every:
+            return True
+        if self.args.checkpoint_interval > 0 and time.time() - self.last_checkpoint_time >= self.args.checkpoint_interval:
+            return True
+        return False
 
-        with open(checkpoint_path, "w") as f:
-            json.dump(checkpoint, f)
+    def save_checkpoint(self):
+        #saves the images, annotations and scenes added since the last checkpoint and the current state
+        self.output_writer.flush() #images in the checkpoint must be on disk
+        if self.annotation_writer is not None:
+            self.state["stream_offset"] = self.annotation_writer.tell()
+
+        checkpoint_path = self.checkpoint_writer.write_delta(
+            dict(self.state),
+            **{key : self.annotations[key][self.checkpointed[key]:] for key in ["images", "annotations", "scenes"]}
+        )
+
+        self.checkpointed = {key : len(self.annotations[key]) for key in ["images", "annotations", "scenes"]}
+        self.last_checkpoint_time = time.time()
+        self.images_since_checkpoint = 0
+        return self.checkpoint_writer.directory
 
     def create_info(self):
         return {
@@ -228,25 +470,23 @@ class DatasetRenderer:
             "url" : "https://github.com/M4tt3/SSHAPE_Dataset_generator", 
             "version" : "pre-release",
             "contibutor" : "Matteo Bicchi",
-            "date_created" : datetime.now().isoformat().split("T")[0]
+            "date_created" : datetime.now().isoformat().split("T")[0],
+            "render_profile" : {"name" : self.args.render_profile, **self.render_profile},
+            "render_engine" : self.args.render_engine,
+            "render_size" : list(self.render_size)
         }
 
     def get_licenses(self):
         return []   #TODO
 
-    def get_camera_position(self) -> mathutils.Vector:
-        # Generate random pitch and yaw values for the camera, move the camera
-        # to that position at a fixed distance from the origin, point the camera
+    def get_camera_position(self, plan_record=None) -> list:
+        # Generate random pitch and yaw values for the camera (or take them from the scene plan), move
+        # the camera to that position at a fixed distance from the origin, point the camera
         # towards the origin and returns camera x, y, z position
-
-        pitch = randint(self.args.min_camera_pitch, self.args.max_camera_pitch)
-        yaw = randint(self.args.min_camera_yaw, self.args.max_camera_yaw)
-
-        pos = [
-            self.args.camera_distance * sin(radians(yaw)),
-            self.args.camera_distance * cos(radians(yaw)),
-            self.args.camera_distance * sin(radians(pitch))
-        ]
+        if plan_record is not None:
+            pos = plan_record["camera_position"]
+        else:
+            pos = sample_camera_position(self.args, random)
 
         #move camera into position and focus it on the origin
         self.camera_obj.location = pos
@@ -254,37 +494,46 @@ class DatasetRenderer:
         rot_quat = self.camera_obj.location.to_track_quat('Z', 'Y')
         self.camera_obj.rotation_euler = rot_quat.to_euler()
         self.camera_obj.location = rot_quat @ mathutils.Vector((0.0, 0.0, self.args.camera_distance))
+        self.view_projection = None #computed again when needed
 
         return pos
 
-    def get_lights_positions(self):
-        # Chooses a random number of lights, moves them at a random position at
-        # a fixed distance from the origin, and returns an array of their x, y, z
+    def get_lights_positions(self, plan_record=None):
+        # Chooses a random number of lights (or takes them from the scene plan), moves them at a random
+        # position at a fixed distance from the origin, and returns an array of their x, y, z
         # positions
+        if plan_record is not None:
+            pos = plan_record["lights"]
+        else:
+            pos = sample_lights_positions(self.args, random)
 
-        lights_number = randint(self.args.min_num_lights, self.args.max_num_lights)
-        pos = []
-
-        for i in range(lights_number):
-            pos.append([
-                self.args.lights_distance * sin(radians(randint(0, 360))) * self.args.lights_jitter,
-                self.args.lights_distance * cos(radians(randint(0, 360))) * self.args.lights_jitter,
-                self.args.lights_distance * (1 - sin(radians(randint(0, 180))) * self.args.lights_jitter)
-            ])
-
+        for i in range(len(pos)):
             #place light
-            light_data = bpy.data.lights.new(name=f"Light_{i}_data", type='POINT')
-            light_data.energy = self.args.lights_intensity
+            if self.scene_pool is not None:
+                light_object = self.scene_pool.acquire_light(self.args.lights_intensity)
+            else:
+                light_data = bpy.data.lights.new(name=f"Light_{i}_data", type='POINT')
+                light_data.energy = self.args.lights_intensity
 
-            light_object = bpy.data.objects.new(name=f"Light_{i}", object_data=light_data)
-            bpy.context.collection.objects.link(light_object)
+                light_object = bpy.data.objects.new(name=f"Light_{i}", object_data=light_data)
+                bpy.context.collection.objects.link(light_object)
 
-            light_object.location = pos[-1]
+            light_object.location = pos[i]
 
         return pos
     
+    def release_job(self):
+        # Removes the shapes and lights left in the scene and stops the output writers, so that the next job
+        # of a warm worker starts from the base scene (shapes are left after an error or in test mode)
+        self.clear_scene()
+        self.output_writer.close()
+
     def clear_scene(self):
         #removes all placed shapes and lights
+        if self.scene_pool is not None: #keep them hidden for the next image
+            self.scene_pool.release_all()
+            return
+
         for obj in context.scene.objects:
             if obj.name.startswith("OBJECT_") or obj.type == "LIGHT":
                 obj.select_set(True)
@@ -331,15 +580,148 @@ class DatasetRenderer:
             mat.name = f"{mat_rule['name']}"
         else:
             group_node.inputs["Color"].default_value = [*color_from_hex(col_rule["hex"]), col_rule["opacity"]]
+            mat.diffuse_color = (*color_from_hex(col_rule["hex"]), col_rule["opacity"]) #used by workbench previews
             mat.name = f"{mat_rule['name']}_{col_rule['name']}"
 
+        mat.use_fake_user = True #materials are unused until applied, this prevents them from being purged
+
         mat.node_tree.links.new(
             group_node.outputs["Shader"],
             output_node.inputs["Surface"]
         )
 
+    def build_scene(self, img_index, img_filename, plan_record=None):
+        # Places camera, lights and shapes of an image, returns the image and scene metadata
+        # Args:
+        # - img_index : index of the image
+        # - img_filename : name of the image file
+        # - plan_record : record of the scene plan, if None the scene is created randomly
+        args = self.args
+
+        #image metadata
+        image_info = {
+            "id" : img_index,
+            "file_name" : img_filename,
+            "height" : self.render_size[1], #smaller than the requested size in previews
+            "width" : self.render_size[0],
+            "date_captured" : datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "license" : -1
+        }
+
+        #scene metadata
+        scene = {
+            "camera_position" : self.get_camera_position(plan_record),
+            "lights" : self.get_lights_positions(plan_record),
+            "objects" : [],
+            "decoys" : []
+        }
+
+        self.annotations["scenes"].append(scene)
+        self.annotations["images"].append(image_info)
+        self.image_annotations = {} #object name -> annotation, for the bounding boxes of the raster ground truth
+        self.image_objects = [] #names of the objects (not decoys), checked by the pre-pass
+
+        if plan_record is not None:
+            self.build_planned_scene(plan_record)
+        else:
+            self.populate_scene()
+
+        return image_info, scene
+
+    def build_checked_scene(self, img_index, img_filename, plan_record=None):
+        # Builds the scene of an image like 'build_scene' and checks it with a cheap pre-pass, scenes failing
+        # the checks are removed (with their annotations) and built again before the expensive render.
+        # After 'max_scene_retries' failed attempts the last scene is kept.
+        # NOTE: Scenes of a scene plan are fixed, they are never built again
+        args = self.args
+        stats = self.state["rejections"]
+
+        for attempt in range(args.max_scene_retries + 1):
+            rollback = self.get_rollback_point()
+            with self.telemetry.stage("populate"):
+                image_info, scene = self.build_scene(img_index, img_filename, plan_record)
+            stats["scenes"] += 1
+            if plan_record is not None:
+                return image_info, scene
+
+            with self.telemetry.stage("prepass"):
+                start_time = time.time()
+                reason = self.check_scene()
+                stats["prepass_time"] += time.time() - start_time
+            if reason is None:
+                return image_info, scene
+            if attempt == args.max_scene_retries:
+                stats["kept_after_max_retries"] += 1
+                scene["prepass_failed"] = reason
+                return image_info, scene
+
+            stats["rejected"] += 1
+            stats[reason] += 1
+            with self.telemetry.stage("cleanup"):
+                self.clear_scene()
+                self.rollback(rollback)
+
+    def get_rollback_point(self) -> dict:
+        # Returns what is needed to remove the next scene from the annotations (see 'rollback')
+        return {
+            "lengths" : {key : len(self.annotations[key]) for key in ["images", "annotations", "scenes"]},
+            "shape_index" : self.state["shape_index"]
+        }
+
+    def rollback(self, point: dict):
+        # Removes the images, scenes and annotations added after a rollback point
+        for key, length in point["lengths"].items():
+            del self.annotations[key][length:]
+        self.state["shape_index"] = point["shape_index"]
+
+    def check_scene(self):
+        # Returns why the current scene should be discarded ('too_few_pixels' or 'exposure'), None if it's fine
+        args = self.args
+        if args.min_pixels_per_object > 0 and len(self.image_objects) > 0:
+            #objects hidden, occluded or out of view, counted on a low resolution rasterization
+            gnd_truth = self.prepass.render(scale=args.prepass_scale)
+            pixels = {obj.name : count for obj, count in zip(gnd_truth["objects"], gnd_truth["pixels"])}
+            min_pixels = args.min_pixels_per_object * args.prepass_scale ** 2
+            if any(pixels.get(name, 0) < min_pixels for name in self.image_objects):
+                return "too_few_pixels"
+
+        if args.check_exposure == 1 and args.render_rgb == 1 and not args.test_mode:
+            exposure = self.get_prepass_exposure()
+            if not args.min_exposure <= exposure <= args.max_exposure:
+                return "exposure"
+
+        return None
+
+    def get_prepass_exposure(self) -> float:
+        # Renders the scene at low resolution and low samples, returns its mean brightness (0-1)
+        render_args = bpy.context.scene.render
+        cycles = bpy.context.scene.cycles
+        settings = (render_args.resolution_percentage, cycles.samples, cycles.use_denoising)
+
+        render_args.resolution_percentage = max(int(settings[0] * self.args.prepass_scale), 1)
+        cycles.samples = self.args.prepass_samples
+        cycles.use_denoising = False
+        try:
+            bpy.ops.render.render(write_still=False)
+            bpy.data.images["Render Result"].save_render(self.prepass_path)
+        finally:
+            render_args.resolution_percentage, cycles.samples, cycles.use_denoising = settings
+
+        image = cv2.imread(self.prepass_path, cv2.IMREAD_GRAYSCALE)
+        return float(image.mean()) / 255
+
+    def get_rejection_summary(self) -> dict:
+        # Returns the pre-pass statistics and the render time saved by not rendering the rejected scenes,
+        # estimated from the average render time of the images
+        stats = dict(self.state["rejections"])
+        images = self.telemetry.images
+        render_time = self.telemetry.stage_totals["render"] / images if images > 0 else 0
+        stats["render_time_saved"] = stats["rejected"] * render_time - stats["prepass_time"]
+        return stats
+
     def populate_scene(self):
         #Places a random number of objects and decoys in random places, adds their position to annotations
+        self.placement.reset()
 
         num_objects = randint(self.args.min_num_objects, self.args.max_num_objects) #random amount of objects
         obj_index = self.state["shape_index"]
@@ -352,6 +734,17 @@ class DatasetRenderer:
             self.place_shapes(decoy_index, num_decoys, decoys=True)
             self.state["shape_index"] += num_decoys
 
+        self.annotations["scenes"][-1]["placement_stats"] = self.placement.get_stats()
+
+    def build_planned_scene(self, plan_record):
+        #Builds the objects and decoys of a scene plan, adds their position to annotations
+        for group in ["objects", "decoys"]:
+            for shape_plan in plan_record[group]:
+                self.build_planned_shape(self.state["shape_index"], shape_plan, decoys=(group == "decoys"))
+                self.state["shape_index"] += 1
+
+        self.annotations["scenes"][-1]["placement_stats"] = plan_record.get("placement_stats", None)
+
     def place_shapes(self, start_index: int, num_shapes: int, decoys: bool):
         # Places a random number of shapes in random places and applies random scale,
         # rotation, flip, material and color
@@ -362,35 +755,18 @@ class DatasetRenderer:
 
         group = "decoys" if decoys else "objects" #either 'decoys' or 'object' depending on what shapes are being added
         for obj_index in range(start_index, start_index + num_shapes):
-            shape_rule = random.choice(list(self.rules[group])) #random shape
+            shape_rule = random.choice(self.rules[group].get_all()) #random shape
             
             mat_name, col_name = self.choose_random_appearance(shape_rule)
             mat_rule = self.rules.materials[mat_name]
             col_rule = self.rules.colors[col_name]
 
-
-            object_annotations = {
-                "id" : obj_index,
-                "shape" : {
-                    "id" : shape_rule["id"],
-                    "name" : shape_rule["name"],
-                    "file" : shape_rule["file"],
-                    "min_distance" : shape_rule["min_distance"]
-                },
-                "material" : {
-                    "id" : mat_rule["id"],
-                    "name" : mat_rule["name"],
-                    "file" : mat_rule["file"]
-                } if mat_rule is not None else None,
-                "color" : {
-                    "id" : col_rule["id"],
-                    "name" : col_rule["name"],
-                    "hex" : col_rule["hex"]
-                } if col_rule is not None else None,
-            }
+            object_annotations = self.create_object_annotations(obj_index, shape_rule, mat_rule, col_rule)
 
             #add object to scene
-            obj_blender = self.add_shape(self.args.decoys_dir if decoys else self.args.objects_dir, object_annotations)
+            shape_dir = self.args.decoys_dir if decoys else self.args.objects_dir
+            geometry = self.geometry_cache.get(shape_dir, shape_rule) if self.geometry_cache is not None else None
+            obj_blender = self.add_shape(shape_dir, object_annotations)
 
             random_scale = [1, 1, 1]
             #perform random scale if needed
@@ -401,69 +777,132 @@ class DatasetRenderer:
             rotate(obj_blender, shape_rule["fixed_rotation"])
             random_rotation = [0, 0, 0]
             if shape_rule["random_rotation"] != "none":
-                random_rotation = self.random_rotate(obj_blender, shape_rule)
+                random_rotation = self.random_rotate(obj_blender, shape_rule, geometry)
 
             #apply random flips
             if shape_rule["flip"] != "none":
-                self.random_flip(shape_rule["flip"])
+                self.random_flip(obj_blender, shape_rule["flip"])
 
             object_annotations["scale"] = random_scale
             object_annotations["rotation"] = [random_rotation[i] + shape_rule["fixed_rotation"][i] for i in range(3)] #sum random and fixed rotation
 
-            bpy.context.view_layer.objects.active = obj_blender
-            bpy.ops.object.transform_apply(rotation=True, scale=True)
-
             #position the shape randomly
-            pos = self.try_shape_placement(obj_blender, shape_rule, object_annotations)
-            if pos is not None:
-                object_annotations["position"] = pos
+            pos = self.try_shape_placement(obj_blender, shape_rule, object_annotations, geometry)
+            if pos is None:
+                self.remove_shape(obj_blender)
+                continue
+            object_annotations["position"] = pos
+
+            self.finish_shape(obj_blender, object_annotations, mat_rule, col_rule, geometry, decoys)
 
-            #apply material and color
-            if mat_rule is not None:
+    def build_planned_shape(self, obj_index: int, shape_plan: dict, decoys: bool):
+        # Adds a shape to the scene exactly as described by its scene plan record
+        group = "decoys" if decoys else "objects"
+        shape_rule = self.rules[group][shape_plan["shape"]]
+        mat_rule = self.rules.materials[shape_plan["material"]]
+        col_rule = self.rules.colors[shape_plan["color"]]
+
+        object_annotations = self.create_object_annotations(obj_index, shape_rule, mat_rule, col_rule)
+
+        shape_dir = self.args.decoys_dir if decoys else self.args.objects_dir
+        geometry = self.geometry_cache.get(shape_dir, shape_rule) if self.geometry_cache is not None else None
+        obj_blender = self.add_shape(shape_dir, object_annotations)
+
+        obj_blender.scale = get_signed_scale(shape_plan["scale"], shape_plan["flip"])
+        rotate(obj_blender, shape_plan["applied_rotation"])
+        obj_blender.location = shape_plan["position"]
+
+        object_annotations["scale"] = shape_plan["scale"]
+        object_annotations["rotation"] = shape_plan["rotation"]
+        object_annotations["position"] = shape_plan["position"]
+
+        self.finish_shape(obj_blender, object_annotations, mat_rule, col_rule, geometry, decoys)
+
+    def create_object_annotations(self, obj_index, shape_rule, mat_rule, col_rule) -> dict:
+        return {
+            "id" : obj_index,
+            "shape" : {
+                "id" : shape_rule["id"],
+                "name" : shape_rule["name"],
+                "file" : shape_rule["file"],
+                "min_distance" : shape_rule["min_distance"]
+            },
+            "material" : {
+                "id" : mat_rule["id"],
+                "name" : mat_rule["name"],
+                "file" : mat_rule["file"]
+            } if mat_rule is not None else None,
+            "color" : {
+                "id" : col_rule["id"],
+                "name" : col_rule["name"],
+                "hex" : col_rule["hex"]
+            } if col_rule is not None else None,
+        }
+
+    def finish_shape(self, obj_blender, object_annotations, mat_rule, col_rule, geometry, decoys):
+        # Applies material and color to a placed shape and adds its annotations
+        group = "decoys" if decoys else "objects"
+
+        #apply material and color
+        if mat_rule is not None:
+            with self.telemetry.stage("material"):
                 if col_rule is None:
-                    material_blender = bpy.data.materials[f"{mat_name}"]
+                    material_blender = bpy.data.materials[f"{mat_rule['name']}"]
                 else:
-                    material_blender = bpy.data.materials[f"{mat_name}_{col_name}"]
+                    material_blender = bpy.data.materials[f"{mat_rule['name']}_{col_rule['name']}"]
             
-                obj_blender.data.materials.append(material_blender)
-
-            #get annotations for training
-            if not decoys and self.args.create_bounding_boxes == 1:
-                #bbox
-                bbox = self.get_bounding_box(obj_blender)
-                category_id = obj_blender["inst_id"]
-
-                self.annotations["annotations"].append({
-                    "id" : obj_index,
-                    "category_id" : category_id,
-                    "iscrowd" : 0,
-                    "image_id" : self.annotations["images"][-1]["id"],
-                    "bbox" : bbox
-                })
+                if len(obj_blender.material_slots) == 0:
+                    obj_blender.data.materials.append(None)
+                for slot in obj_blender.material_slots: #linked to the object, the mesh may be shared
+                    slot.link = "OBJECT"
+                    slot.material = material_blender
+
+        #get annotations for training
+        if not decoys and self.args.create_bounding_boxes == 1:
+            #bbox
+            with self.telemetry.stage("bbox"):
+                bbox = self.get_bounding_box(obj_blender, geometry["hull"] if geometry is not None else None)
+            category_id = obj_blender["inst_id"]
+
+            annotation = {
+                "id" : object_annotations["id"],
+                "category_id" : category_id,
+                "iscrowd" : 0,
+                "image_id" : self.annotations["images"][-1]["id"],
+                "bbox" : bbox
+            }
+            self.annotations["annotations"].append(annotation)
+            self.image_annotations[obj_blender.name] = annotation
 
-            self.annotations["scenes"][-1][group].append(object_annotations)
+        self.annotations["scenes"][-1][group].append(object_annotations)
+        if not decoys:
+            self.image_objects.append(obj_blender.name)
 
     def choose_random_appearance(self, shape_rule):
-        # Returns random material and color rules
-        allowed_mats = self.rules.get_shape_allowed_materials(shape_rule["name"])
-        if len(allowed_mats) > 0:
-            mat_name = random.choice(allowed_mats)
-            allowed_colors = self.rules.get_composite_allowed_colors(shape_rule["name"], mat_name)
-            if len(allowed_colors) > 0:
-                return mat_name, random.choice(allowed_colors)
-            else:
-                return mat_name, None
-        else:
-            return None, None
+        # Returns random material and color names
+        return sample_appearance(self.rules, shape_rule, random)
         
     def add_shape(self, shape_dir, object_annotation):
         #add a shape to the scene
         name = object_annotation["shape"]["name"]
-        filename = os.path.join(shape_dir, object_annotation["shape"]["file"], "Object", name)
-        bpy.ops.wm.append(filename=filename)
+        obj_name = f"OBJECT_{name}_{object_annotation['id']}"
 
-        blender_obj = bpy.data.objects[name]
-        blender_obj.name = f"OBJECT_{name}_{object_annotation['id']}"
+        with self.telemetry.stage("asset_append"):
+            if self.asset_cache is not None:
+                if self.scene_pool is not None:
+                    blender_obj = self.scene_pool.acquire_shape(shape_dir, object_annotation["shape"], obj_name)
+                else:
+                    blender_obj = self.asset_cache.instantiate(shape_dir, object_annotation["shape"], obj_name)
+                #select only the new shape, like 'wm.append' does, transformations are applied to selected objects
+                for obj in bpy.context.selected_objects:
+                    obj.select_set(False)
+                blender_obj.select_set(True)
+            else:
+                filename = os.path.join(shape_dir, object_annotation["shape"]["file"], "Object", name)
+                bpy.ops.wm.append(filename=filename)
+
+                blender_obj = bpy.data.objects[name]
+                blender_obj.name = obj_name
 
 
         #assign instance id
@@ -481,6 +920,7 @@ class DatasetRenderer:
                 )
             )
             blender_obj["inst_id"] = cat_id
+            blender_obj.pass_index = cat_id #used for the object index pass
         except ValueError:
             pass
 
@@ -488,150 +928,80 @@ class DatasetRenderer:
     
     def random_scale(self, obj, shape):
         #Scales currently active object according to provided rule
-        scaling_factors = []
-
-        get_factor = lambda: randrange_float(shape["scaling"]["min"], shape["scaling"]["max"], shape["scaling"]["step"])
-
-        if shape["scaling"]["consistent"] == "all":
-            fac = get_factor()
-            scaling_factors = [fac for k in range(3)]
-        elif shape["scaling"]["consistent"] == "none":
-            scaling_factors = [get_factor() for k in range(3)]
-        elif shape["scaling"]["consistent"] in ["xy", "xz", "yz"]:
-            fac1, fac2 = get_factor(), get_factor()
-            if shape["scaling"]["consistent"] == "xy":
-                scaling_factors = [fac1, fac1, fac2]
-            elif shape["scaling"]["consistent"] == "yz":
-                scaling_factors = [fac1, fac2, fac2]
-            else:
-                scaling_factors = [fac1, fac2, fac1]
-        else:
-            raise InvalidValueError("shape.scaling.consistent", shape["scaling"]["consistent"])
-        
+        scaling_factors = sample_scale(shape, random)
         obj.scale = scaling_factors
         return scaling_factors
 
-    def random_rotate(self, obj, shape_rule):
-        rotation = [0, 0, 0]
-        get_random_angle = lambda axis: random.randrange(
-            start=shape_rule["random_rotation"]["min_bounds"][axis],
-            stop=shape_rule["random_rotation"]["max_bounds"][axis],
-            step=shape_rule["random_rotation"]["snap"][axis],
-        )
-        
-        if shape_rule["random_rotation"]["auto_snap_face"]:
-            #Auto rotate so that the normal of a random face is aligned to AUTO_ROTATION_VECT
-            for attempt in range(16):
-                normal = random.choice(obj.data.polygons).normal #normal of a random face
-                angle = normal.angle(AUTO_ROTATION_VECT) #angle between normal and AUTO_ROTATION_VECT
-                axis = normal.cross(AUTO_ROTATION_VECT) #axis perpendicular to normal and AUTO_ROTATION_VECT
-                matrix = mathutils.Matrix.Rotation(angle, 3, axis)
-                rotation_radians = matrix.to_euler()
-                valid = True
-                for axis in range(3):
-                    if (degrees(rotation_radians[axis]) <= shape_rule["random_rotation"]["max_bounds"][axis]
-                    and degrees(rotation_radians[axis]) >= shape_rule["random_rotation"]["min_bounds"][axis]):
-                        rotation[axis] = degrees(rotation_radians[axis])
-                    else:
-                        valid=False
-                        break
-                if valid:
-                    break
-            
-            #Add z rotation if needed
-            if shape_rule["random_rotation"]["snap"][2] != 0:
-                rotation[2] = get_random_angle(2)
-
+    def random_rotate(self, obj, shape_rule, geometry=None):
+        if geometry is not None: #normal of a random resting face, weighted by area
+            get_normal = lambda: Vector(choose_resting_face(geometry, random)["normal"])
         else:
-            for axis in range(3):
-                angle = get_random_angle(axis) if shape_rule["random_rotation"]["snap"][axis] > 0 else 0
-                rotation[axis] = angle
+            get_normal = lambda: random.choice(obj.data.polygons).normal #normal of a random face
 
+        rotation = sample_rotation(shape_rule, random, get_normal)
         rotate(obj, rotation)
         return rotation
     
-    def random_flip(self, flip_rule):
-        #mirrors currently active object based on the flip settings it receives
-        flips = (False, False, False)
-        for flip_axis, flip_mode in flip_rule.items():
-            if flip_mode == "random":
-                flip_mode = bool(random.getrandbits(1)) #random bool
-            
-            idx = ["yz", "xz", "xy"].index(flip_axis)
-            flips[idx] = flip_mode
-
-        bpy.ops.transform.mirror(constraint_axis=flips)
-
-    def try_shape_placement(self, obj, shape_rule, obj_annotations, max_attempts=50):
-        for attempt in range(max_attempts):
-            get_random_pos = lambda: random.uniform(self.args.padding - self.args.area_size / 2, self.args.area_size / 2 - self.args.padding)
-            pos = [get_random_pos() for i in range(3)]
-            if shape_rule["snap_to_plane"] == True:
-                origin = mathutils.Vector((0,0,0))
-                dir = mathutils.Vector((0,0,-1))
-                hit, point, face, index = obj.ray_cast(origin, dir)
-                pos[2] = point.length
-                    
-            if self.check_min_distance(pos, obj_annotations):
-                obj.location = pos
-                return pos
-        
-        print(f"Unable to place shape {obj_annotations['id']} after {max_attempts} attempts, the shape will" + 
-              "be removed.\nThis warning is probably a result of too many shapes, too high 'min_distance' or a too" +
+    def random_flip(self, obj, flip_rule):
+        #mirrors the object based on the flip settings it receives
+        flips = sample_flips(flip_rule, random)
+        obj.scale = get_signed_scale(obj.scale, flips)
+
+    def try_shape_placement(self, obj, shape_rule, obj_annotations, geometry=None):
+        #finds a position respecting the 'min_distance' rule from all the other shapes of the scene
+        #NOTE: Rotation, scale and flips stay in the object transform, the mesh is shared with the
+        #      template of the shape and is never modified
+        z = None
+        if shape_rule["snap_to_plane"] == True and geometry is not None:
+            z = get_transformed_ground_offset(geometry, np.array(obj.matrix_basis.to_3x3()))
+        elif shape_rule["snap_to_plane"] == True:
+            #the mesh isn't rotated and scaled, cast the ray in its local space
+            transform = obj.matrix_basis.to_3x3()
+            origin = mathutils.Vector((0,0,0))
+            dir = (transform.inverted() @ mathutils.Vector((0,0,-1))).normalized()
+            hit, point, face, index = obj.ray_cast(origin, dir)
+            z = -(transform @ point).z
+
+        #minimum distance scaled to the max scaling along an axis of the object
+        radius = obj_annotations["shape"]["min_distance"] * max(*obj_annotations["scale"])
+        pos = self.placement.place(radius, z)
+        if pos is not None:
+            obj.location = pos
+            return pos
+
+        print(f"Unable to place shape {obj_annotations['id']} after {self.placement.max_attempts} attempts, the shape will " + 
+              "be removed.\nThis warning is probably a result of too many shapes, too high 'min_distance' or a too " +
               "low area size.\nIf this error pops up more than once you should probably modify those values.")
         return None
+
+    def remove_shape(self, obj):
+        #removes a shape which could not be placed from the scene
+        if self.scene_pool is not None: #it will be reused in the next image
+            obj.hide_render = True
+        else:
+            bpy.data.objects.remove(obj, do_unlink=True)
     
     def get_segmentation(self):
         pass
-    
-    def check_min_distance(self, pos, obj_annotations):
-        #returns true if the object respects the 'min_distance' rule from all the other shapes of the last scene
-        for other_object in self.annotations["scenes"][-1]["objects"] + self.annotations["scenes"][-1]["decoys"]:
-            distance = get_distance(Vector(other_object["position"]), Vector(pos)) #distance between two shapes
 
-            #minimum distances scaled to the max scaling along an axis of each object
-            min_distance_1 = other_object["shape"]["min_distance"] * max(*other_object["scale"])
-            min_distance_2 = obj_annotations["shape"]["min_distance"] * max(*obj_annotations["scale"])
-
-            if distance < min_distance_1 + min_distance_2:
-                return False
-            
-        return True
+    def set_visible_bounding_boxes(self, gnd_truth):
+        # Replaces the projected bounding boxes of the current image with the boxes of the visible pixels
+        # of every object, objects hidden by other ones keep the projected box
+        for obj, box in zip(gnd_truth["objects"], gnd_truth["boxes"]):
+            annotation = self.image_annotations.get(obj.name, None)
+            if annotation is not None and box is not None:
+                annotation["bbox"] = box
     
-    def get_bounding_box(self, object):
-        corners_locations = [vert.co for vert in object.data.vertices]
-        lowest_values = [None , None]
-        highest_values = [None, None]
-        for corner in corners_locations:
-            #get position of corner in 2d camera view
-            c_2d = bpy_extras.object_utils.world_to_camera_view(bpy.context.scene, self.camera_obj, corner + object.location)
-            #transform to pixel coordinates
-            render = bpy.context.scene.render
-            c_2d = [
-                round(c_2d.x * render.resolution_x),
-                self.args.images_height - round(c_2d.y * render.resolution_y) #for some reason y is flipped
-            ]
-
-            if lowest_values[0] is None: #if no value has been assigned yet
-                lowest_values = c_2d.copy()
-                highest_values = c_2d.copy()
-                continue
-
-            if lowest_values[0] > c_2d[0]:
-                lowest_values[0] = c_2d[0]
-            elif highest_values[0] < c_2d[0]:
-                highest_values[0] = c_2d[0]
-
-            if lowest_values[1] > c_2d[1]:
-                lowest_values[1] = c_2d[1]
-            elif highest_values[1] < c_2d[1]:
-                highest_values[1] = c_2d[1]
-
-        return [
-            lowest_values[0],
-            lowest_values[1],
-            highest_values[0] - lowest_values[0],
-            highest_values[1] - lowest_values[1]
-        ]
-
-        
+    def get_bounding_box(self, object, points=None):
+        #projects all the vertices of the object (or the given points, e.g. its convex hull) in the camera
+        #view at once and returns the box enclosing them
+        if self.view_projection is None: #the camera only moves between images
+            self.view_projection = get_view_projection_matrix(self.camera_obj)
+
+        pixels = project_points(
+            get_mesh_coordinates(object.data) if points is None else points,
+            get_object_matrix(object),
+            self.view_projection,
+            get_render_size()
+        )
+        return get_points_bounding_box(pixels)
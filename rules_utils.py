@@ -36,6 +36,7 @@ class Rules:
         self.colors = RulesSection(rules, "colors", defaults)
         self.materials = RulesSection(rules, "materials", defaults)
         self.categories = rules["categories"]
+        self.compile()
 
     def get_dict(self):
         return {
@@ -60,66 +61,96 @@ class Rules:
             raise Exception(f"Could not find shape matching this identification: {identifier}")
         
         return rule
+
+    def compile(self):
+        # Precomputes the materials allowed by every shape and the colors allowed by every material and every
+        # shape-material pair, so that lookups and random appearances don't scan the rules again
+        self.material_colors__ = {} #material name -> allowed colors
+        for material_rule in self.materials:
+            if material_rule["name"] not in self.material_colors__:
+                allowed_colors = self.get_allowed(material_rule["allowed_colors"], self.colors)
+                self.material_colors__[material_rule["name"]] = allowed_colors
+
+        self.shape_materials__ = {} #shape name -> allowed materials
+        self.shape_colors__ = {} #shape name -> allowed colors
+        self.composite_colors__ = {} #shape name -> material name -> colors allowed by both
+        for shape_rule in list(self.objects) + list(self.decoys): #objects first, like 'get_shape'
+            name = shape_rule["name"]
+            if name in self.shape_materials__:
+                continue
+            self.shape_materials__[name] = self.get_allowed(shape_rule["allowed_materials"], self.materials)
+            self.shape_colors__[name] = self.get_allowed(shape_rule["allowed_colors"], self.colors)
+            for material_name in self.shape_materials__[name]:
+                if material_name not in self.material_colors__:
+                    raise UndefinedMaterialError(material_name)
+            self.composite_colors__[name] = {
+                material_name : tuple(intersect(self.shape_colors__[name], self.material_colors__[material_name]))
+                for material_name in self.shape_materials__[name]
+            }
+
+    def get_allowed(self, allowed, section) -> tuple[str, ...]:
+        # Returns the names allowed by an 'allowed_colors' or 'allowed_materials' value
+        if allowed == "none":
+            return ()
+        elif allowed == "all":
+            return section.get_names()
+        else:
+            return tuple(allowed)
+
+    def get_shape_name(self, shape_identifier: Identifier) -> str:
+        if isinstance(shape_identifier, str) and shape_identifier in self.shape_materials__:
+            return shape_identifier
+        return self.get_shape(shape_identifier)["name"]
+
+    def get_material_name(self, material_identifier: Identifier) -> str:
+        if isinstance(material_identifier, str) and material_identifier in self.material_colors__:
+            return material_identifier
+        material_rule = self.materials[material_identifier]
+        if material_rule is None:
+            raise Exception(f"Could not find material matching this identification: {material_identifier}")
+        return material_rule["name"]
     
-    def get_composite_allowed_colors(self, shape_identifier: Identifier, material_identifier: Identifier) -> list[str]:
-        # Returns the list of colors allowed both by a shape and a given material
+    def get_composite_allowed_colors(self, shape_identifier: Identifier, material_identifier: Identifier) -> tuple[str, ...]:
+        # Returns the colors allowed both by a shape and a given material
         # Args:
         # - shape_identifier (str | int): id or name of the shape
         # - material_identifier (str | int): id or name of the material
-        shape_allowed_colors = self.get_shape_allowed_colors(shape_identifier)
+        shape_name = self.get_shape_name(shape_identifier)
 
         if material_identifier is not None:
-            material_allowed_colors = self.get_material_allowed_colors(material_identifier)
-            return intersect(shape_allowed_colors, material_allowed_colors)
+            material_name = self.get_material_name(material_identifier)
+            composite_colors = self.composite_colors__[shape_name]
+            if material_name not in composite_colors: #material not allowed by the shape
+                composite_colors[material_name] = tuple(
+                    intersect(self.shape_colors__[shape_name], self.material_colors__[material_name])
+                )
+            return composite_colors[material_name]
     
-        return shape_allowed_colors
+        return self.shape_colors__[shape_name]
     
-    def get_shape_allowed_colors(self, shape_identifier: Identifier) -> list[str]:
-        # Returns the list of colors allowed by the shape
+    def get_shape_allowed_colors(self, shape_identifier: Identifier) -> tuple[str, ...]:
+        # Returns the colors allowed by the shape
         # Args:
         # - shape_identifier (str | int): id or name of the shape
-        shape_rule = self.get_shape(shape_identifier)
-        
-        allowed_colors = shape_rule["allowed_colors"]
-        if allowed_colors == "none":
-            return []
-        elif allowed_colors == "all":
-            return self.colors.get_values_list("name")
-        else:
-            return allowed_colors
+        return self.shape_colors__[self.get_shape_name(shape_identifier)]
         
-    def get_material_allowed_colors(self, material_identifier: Identifier) -> list[str]:
-        # Returns the list of colors allowed by the material
+    def get_material_allowed_colors(self, material_identifier: Identifier) -> tuple[str, ...]:
+        # Returns the colors allowed by the material
         # Args:
         # - material_identifier (str | int): id or name of the material
-        material_rule = self.materials[material_identifier]
+        return self.material_colors__[self.get_material_name(material_identifier)]
 
-        if material_rule is None:
-            raise Exception(f"Could not find material matching this identification: {material_identifier}")
-        
-        allowed_colors = material_rule["allowed_colors"]
-        if allowed_colors == "none":
-            return []
-        elif allowed_colors == "all":
-            return self.colors.get_values_list("name")
-        else:
-            return allowed_colors
-
-    def get_shape_allowed_materials(self, shape_identifier: Identifier) -> list[str]:
-        # Returns the list of materials allowed by the shape
+    def get_shape_allowed_materials(self, shape_identifier: Identifier) -> tuple[str, ...]:
+        # Returns the materials allowed by the shape
         # Args:
         # - shape_identifier (str | int): id or name of the shape
+        return self.shape_materials__[self.get_shape_name(shape_identifier)]
 
-        shape_rule = self.get_shape(shape_identifier)
-        shape_rule = self.get_shape(shape_identifier)
-        
-        allowed_materials = shape_rule["allowed_materials"]
-        if allowed_materials == "none":
-            return []
-        elif allowed_materials == "all":
-            return self.materials.get_values_list("name")
-        else:
-            return allowed_materials
+    def get_appearance_table(self, shape_identifier: Identifier) -> tuple:
+        # Returns the materials allowed by a shape and, for each of them, the colors allowed by both, random
+        # appearances are drawn from it in constant time (see 'scene_plan.sample_appearance')
+        shape_name = self.get_shape_name(shape_identifier)
+        return self.shape_materials__[shape_name], self.composite_colors__[shape_name]
 
 class RulesSection:
     def __init__(self, rules, section_name, defaults):
@@ -127,6 +158,19 @@ class RulesSection:
         self.section__ = rules[section_name]
         check_rule(self.section__, defaults, section_name, rules.get("macros", {}))
         self.rules__ = rules
+        self.compile()
+
+    def compile(self):
+        # Indexes the rules by id and by name, the first rule wins if a value is repeated (like 'search')
+        self.all__ = tuple(self.section__)
+        self.by_id__ = {}
+        self.by_name__ = {}
+        for rule in self.section__:
+            if "id" in rule:
+                self.by_id__.setdefault(rule["id"], rule)
+            if "name" in rule:
+                self.by_name__.setdefault(rule["name"], rule)
+        self.names__ = tuple(self.by_name__)
 
     def __getitem__(self, identifier : Identifier | None) -> dict:
         if identifier is None:
@@ -137,49 +181,37 @@ class RulesSection:
             return self.get_by_name(identifier)
         
     def __iter__(self):
-        self.iteration_counter__ = -1
-        return self
-    
-    def __next__(self) -> dict:
-        self.iteration_counter__ += 1
-        if self.iteration_counter__ < len(self.section__):
-            return self.section__[self.iteration_counter__]
-        else:
-            raise StopIteration
+        return iter(self.all__)
         
     def __len__(self) -> int:
         return len(self.section__)
 
+    def get_all(self) -> tuple[dict, ...]:
+        # Returns all the rules of the section, e.g. to choose a random one
+        return self.all__
+
+    def get_names(self) -> tuple[str, ...]:
+        # Returns the names of all the rules of the section
+        return self.names__
+
     def get_by_name(self, name: str | list[str]) -> dict:
         # Returns rule with corresponding name.
         # If a list is passed it returns a list of all the rules with the corresponding name.
-        rule = []
         if isinstance(name, list):
-            for n in name:
-                rule.append(self.search(name=n))
-        else:
-            rule = self.search(name=name)
-
-        return rule
+            return [self.by_name__.get(n, None) for n in name]
+        return self.by_name__.get(name, None)
     
     def get_by_id(self, id: int | list[int]) -> dict:
         # Returns rule with corresponding id.
         # If a list is passed it returns a list of all the rules with the corresponding id.
-        rule = []
         if isinstance(id, list):
-            for i in id:
-                rule.append(self.search(id=i))
-        else:
-            rule = self.search(id=id)
-
-        return rule
+            return [self.by_id__.get(i, None) for i in id]
+        return self.by_id__.get(id, None)
 
     def search(self, **kwargs) -> dict:
         # Returns rule matching all given attributes.
         for rule_element in self.section__:
-            for kw, val in kwargs.items():
-                if rule_element[kw] != val:
-                    break
+            if all(rule_element.get(kw, None) == val for kw, val in kwargs.items()):
                 return rule_element
         return None
     
@@ -0,0 +1,425 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+
+-------------------------------------------------------------------------------------------------------------------
+
+Scene planning
+
+Makes all the random choices of the scenes (shapes, appearances, transformations, camera and lights)
+outside of blender and writes them to a scene plan file, one JSON record per line and per image.
+The plan can then be rendered with 'create_dataset.py' by passing it with '--scene_plan'.
+
+Usage (from the directory containing SSHAPE_Dataset_generator, 'mathutils' and 'numpy' must be installed):
+
+    python -m SSHAPE_Dataset_generator.scene_plan -- --config {PATH TO CONFIG} --scene_plan {OUTPUT FILE}
+
+Shapes using 'auto_snap_face' or 'snap_to_plane' need their geometry, build the geometry cache first with:
+
+    blender -b --python geometry_cache.py -- --config {PATH TO CONFIG}
+"""
+
+from SSHAPE_Dataset_generator.utils import setup_argparser, extract_args, randrange_float
+from SSHAPE_Dataset_generator.rules_utils import Rules
+from SSHAPE_Dataset_generator.placement import PlacementEngine
+from SSHAPE_Dataset_generator.geometry_cache import GeometryCache, choose_resting_face, get_transformed_ground_offset
+from SSHAPE_Dataset_generator.errors import *
+from math import sin, cos, radians, degrees
+from multiprocessing import Pool
+import hashlib, json, os, pathlib, random
+from mathutils import Vector, Euler, Matrix #type: ignore
+import numpy as np
+
+#Shapes with random_rotation.snap set to auto will have the normal of a random face aligned with this vector
+#NOTE: Right now changing this vector is not properly supported
+AUTO_ROTATION_VECT = Vector((0, 0, -1))
+
+#Planes of the 'flip' rule, in the order of the axis they mirror
+FLIP_PLANES = ["yz", "xz", "xy"]
+
+# --------------------------- SAMPLING ---------------------------
+# Shared by the planner and by the renderer when scenes are created inside blender.
+# 'rng' can be the random module or a random.Random instance.
+
+def sample_camera_position(args, rng) -> list:
+    # Returns a random camera position at a fixed distance from the origin
+    pitch = rng.randint(args.min_camera_pitch, args.max_camera_pitch)
+    yaw = rng.randint(args.min_camera_yaw, args.max_camera_yaw)
+
+    return [
+        args.camera_distance * sin(radians(yaw)),
+        args.camera_distance * cos(radians(yaw)),
+        args.camera_distance * sin(radians(pitch))
+    ]
+
+def sample_lights_positions(args, rng) -> list:
+    # Returns the positions of a random number of lights at a fixed distance from the origin
+    lights_number = rng.randint(args.min_num_lights, args.max_num_lights)
+    pos = []
+
+    for i in range(lights_number):
+        pos.append([
+            args.lights_distance * sin(radians(rng.randint(0, 360))) * args.lights_jitter,
+            args.lights_distance * cos(radians(rng.randint(0, 360))) * args.lights_jitter,
+            args.lights_distance * (1 - sin(radians(rng.randint(0, 180))) * args.lights_jitter)
+        ])
+
+    return pos
+
+def sample_appearance(rules: Rules, shape_rule: dict, rng) -> tuple:
+    # Returns random material and color names allowed for the shape (None if not allowed)
+    allowed_mats, composite_colors = rules.get_appearance_table(shape_rule["name"])
+    if len(allowed_mats) > 0:
+        mat_name = rng.choice(allowed_mats)
+        allowed_colors = composite_colors[mat_name]
+        if len(allowed_colors) > 0:
+            return mat_name, rng.choice(allowed_colors)
+        else:
+            return mat_name, None
+    else:
+        return None, None
+
+def sample_scale(shape_rule: dict, rng) -> list:
+    # Returns random scaling factors along each axis according to the 'scaling' rule of the shape
+    scaling = shape_rule["scaling"]
+    get_factor = lambda: randrange_float(scaling["min"], scaling["max"], scaling["step"], rng)
+
+    consistent = shape_rule["scaling"]["consistent"]
+    if consistent == "all":
+        fac = get_factor()
+        return [fac for k in range(3)]
+    elif consistent == "none":
+        return [get_factor() for k in range(3)]
+    elif consistent in ["xy", "xz", "yz"]:
+        fac1, fac2 = get_factor(), get_factor()
+        if consistent == "xy":
+            return [fac1, fac1, fac2]
+        elif consistent == "yz":
+            return [fac1, fac2, fac2]
+        else:
+            return [fac1, fac2, fac1]
+    else:
+        raise InvalidValueError("shape.scaling.consistent", consistent)
+
+def sample_rotation(shape_rule: dict, rng, get_normal) -> list:
+    # Returns a random rotation (in degrees) according to the 'random_rotation' rule of the shape
+    # Args:
+    # - get_normal: function returning the normal of a random face of the shape, used with 'auto_snap_face'
+    rotation = [0, 0, 0]
+    get_random_angle = lambda axis: rng.randrange(
+        shape_rule["random_rotation"]["min_bounds"][axis],
+        shape_rule["random_rotation"]["max_bounds"][axis],
+        shape_rule["random_rotation"]["snap"][axis],
+    )
+
+    if shape_rule["random_rotation"]["auto_snap_face"]:
+        #Auto rotate so that the normal of a random face is aligned to AUTO_ROTATION_VECT
+        for attempt in range(16):
+            normal = get_normal()
+            angle = normal.angle(AUTO_ROTATION_VECT) #angle between normal and AUTO_ROTATION_VECT
+            axis = normal.cross(AUTO_ROTATION_VECT) #axis perpendicular to normal and AUTO_ROTATION_VECT
+            matrix = Matrix.Rotation(angle, 3, axis)
+            rotation_radians = matrix.to_euler()
+            valid = True
+            for axis in range(3):
+                if (degrees(rotation_radians[axis]) <= shape_rule["random_rotation"]["max_bounds"][axis]
+                and degrees(rotation_radians[axis]) >= shape_rule["random_rotation"]["min_bounds"][axis]):
+                    rotation[axis] = degrees(rotation_radians[axis])
+                else:
+                    valid=False
+                    break
+            if valid:
+                break
+
+        #Add z rotation if needed
+        if shape_rule["random_rotation"]["snap"][2] != 0:
+            rotation[2] = get_random_angle(2)
+
+    else:
+        for axis in range(3):
+            angle = get_random_angle(axis) if shape_rule["random_rotation"]["snap"][axis] > 0 else 0
+            rotation[axis] = angle
+
+    return rotation
+
+def sample_flips(flip_rule: dict, rng) -> list:
+    # Returns for each axis whether the shape is mirrored along it
+    flips = [False, False, False]
+    for flip_axis, flip_mode in flip_rule.items():
+        if flip_mode == "random":
+            flip_mode = bool(rng.getrandbits(1)) #random bool
+        flips[FLIP_PLANES.index(flip_axis)] = bool(flip_mode)
+    return flips
+
+def get_signed_scale(scale: list, flips: list) -> list:
+    # Returns the scale of a shape with flipped axis mirrored
+    return [-scale[i] if flips[i] else scale[i] for i in range(3)]
+
+def get_transform_matrix(rotation: list, scale: list) -> np.ndarray:
+    # Returns the 3x3 matrix of an object with the given rotation (in degrees) and scale,
+    # same as matrix_basis.to_3x3() in blender
+    euler = Euler([radians(angle) for angle in rotation])
+    return np.array(euler.to_matrix() @ Matrix.Diagonal(scale))
+
+# --------------------------- PLANNING ---------------------------
+
+class ScenePlanner:
+    # Creates scene plan records, each record describes everything needed to build one scene
+
+    def __init__(self, args, rules: Rules, geometry_cache: GeometryCache = None):
+        self.args = args
+        self.rules = rules
+        self.geometry_cache = geometry_cache
+
+    def plan_image(self, img_index: int, seed: int) -> dict:
+        # Returns the plan of a scene, the same seed always gives the same plan
+        args = self.args
+        rng = random.Random(seed)
+        placement = PlacementEngine(
+            args.area_size,
+            args.padding,
+            batch_size=args.placement_batch_size,
+            max_attempts=args.max_placement_attempts,
+            rng=np.random.default_rng(seed)
+        )
+
+        record = {
+            "image_id" : img_index,
+            "seed" : seed,
+            "camera_position" : sample_camera_position(args, rng),
+            "lights" : sample_lights_positions(args, rng),
+            "objects" : [],
+            "decoys" : []
+        }
+
+        num_objects = rng.randint(args.min_num_objects, args.max_num_objects)
+        self.plan_shapes(record, "objects", num_objects, rng, placement)
+        if len(self.rules["decoys"]) > 0:
+            num_decoys = rng.randint(args.min_num_decoys, args.max_num_decoys)
+            self.plan_shapes(record, "decoys", num_decoys, rng, placement)
+
+        record["placement_stats"] = placement.get_stats()
+        return record
+
+    def plan_shapes(self, record: dict, group: str, num_shapes: int, rng, placement: PlacementEngine):
+        for i in range(num_shapes):
+            shape_plan = self.plan_shape(group, rng, placement)
+            if shape_plan is not None: #shapes which could not be placed are left out
+                record[group].append(shape_plan)
+
+    def plan_shape(self, group: str, rng, placement: PlacementEngine) -> dict:
+        shape_rule = rng.choice(self.rules[group].get_all())
+        mat_name, col_name = sample_appearance(self.rules, shape_rule, rng)
+
+        geometry = None
+        if shape_rule["snap_to_plane"] == True or (shape_rule["random_rotation"] != "none"
+                                                   and shape_rule["random_rotation"]["auto_snap_face"]):
+            geometry = self.get_geometry(group, shape_rule)
+
+        scale = sample_scale(shape_rule, rng) if shape_rule["scaling"] != "none" else [1, 1, 1]
+
+        #the random rotation replaces the fixed one, like in the renderer
+        random_rotation = [0, 0, 0]
+        applied_rotation = list(shape_rule["fixed_rotation"])
+        if shape_rule["random_rotation"] != "none":
+            get_normal = lambda: Vector(choose_resting_face(geometry, rng)["normal"])
+            random_rotation = sample_rotation(shape_rule, rng, get_normal)
+            applied_rotation = random_rotation
+
+        flips = sample_flips(shape_rule["flip"], rng) if shape_rule["flip"] != "none" else [False, False, False]
+
+        z = None
+        if shape_rule["snap_to_plane"] == True:
+            transform = get_transform_matrix(applied_rotation, get_signed_scale(scale, flips))
+            z = get_transformed_ground_offset(geometry, transform)
+
+        position = placement.place(shape_rule["min_distance"] * max(*scale), z)
+        if position is None:
+            return None
+
+        return {
+            "shape" : shape_rule["id"],
+            "material" : mat_name,
+            "color" : col_name,
+            "scale" : scale,
+            "rotation" : [random_rotation[i] + shape_rule["fixed_rotation"][i] for i in range(3)],
+            "applied_rotation" : applied_rotation,
+            "flip" : flips,
+            "position" : position
+        }
+
+    def get_geometry(self, group: str, shape_rule: dict) -> dict:
+        if self.geometry_cache is None:
+            raise Exception(f"Shape '{shape_rule['name']}' needs its geometry to be planned but no geometry cache is available")
+        shape_dir = self.args.decoys_dir if group == "decoys" else self.args.objects_dir
+        return self.geometry_cache.get(shape_dir, shape_rule)
+
+def validate_record(record: dict, args, rules: Rules) -> list:
+    # Returns a list of the problems found in a plan record, empty if the record is valid
+    errors = []
+    low, high = args.padding - args.area_size / 2, args.area_size / 2 - args.padding
+    if not args.min_num_lights <= len(record["lights"]) <= args.max_num_lights:
+        errors.append(f"invalid number of lights: {len(record['lights'])}")
+    if len(record["objects"]) > args.max_num_objects:
+        errors.append(f"too many objects: {len(record['objects'])}")
+    if len(record["decoys"]) > args.max_num_decoys:
+        errors.append(f"too many decoys: {len(record['decoys'])}")
+
+    placed = []
+    for group in ["objects", "decoys"]:
+        for shape_plan in record[group]:
+            shape_rule = rules[group][shape_plan["shape"]]
+            if shape_rule is None:
+                errors.append(f"undefined shape: {shape_plan['shape']}")
+                continue
+            if shape_plan["material"] is not None and shape_plan["material"] not in rules.get_shape_allowed_materials(shape_rule["name"]):
+                errors.append(f"material '{shape_plan['material']}' not allowed for shape '{shape_rule['name']}'")
+            elif shape_plan["color"] is not None and shape_plan["color"] not in rules.get_composite_allowed_colors(shape_rule["name"], shape_plan["material"]):
+                errors.append(f"color '{shape_plan['color']}' not allowed for shape '{shape_rule['name']}'")
+            if not all(low <= shape_plan["position"][axis] <= high for axis in range(2)):
+                errors.append(f"shape '{shape_rule['name']}' placed outside of the working area")
+            placed.append((np.array(shape_plan["position"]), shape_rule["min_distance"] * max(*shape_plan["scale"])))
+
+    for i in range(len(placed)):
+        for j in range(i + 1, len(placed)):
+            if np.linalg.norm(placed[i][0] - placed[j][0]) < placed[i][1] + placed[j][1] - 1e-9:
+                errors.append(f"shapes {i} and {j} are closer than their minimum distance")
+
+    return errors
+
+def get_record_key(record: dict) -> str:
+    # Returns a key identifying the content of a scene, two scenes with the same key are identical
+    content = {k : v for k, v in record.items() if k not in ["image_id", "seed", "placement_stats"]}
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+def get_image_seed(base_seed: int, img_index: int, attempt=0) -> int:
+    # Returns the seed of an image, it only depends on the base seed and the image index
+    return random.Random(f"{base_seed}:{img_index}:{attempt}").getrandbits(63)
+
+RECORD_PREFIX = b'{"image_id":' #records are written with their image_id first (see 'write_plan')
+
+def get_line_image_id(line: bytes) -> int:
+    # Returns the image_id of a plan record without parsing the whole record
+    if line.startswith(RECORD_PREFIX):
+        return int(line[len(RECORD_PREFIX):line.index(b",")])
+    return json.loads(line)["image_id"]
+
+class ScenePlanReader:
+    # Reads the records of a scene plan by image index.
+    # The byte offset of every record is indexed once when the reader is created, reading a range of images
+    # (e.g. a chunk of the work queue) seeks to its first record instead of parsing the plan from the start.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offsets = {} #image_id -> byte offset of its record
+        with open(path, "rb") as f:
+            offset = 0
+            for line in f:
+                if line.strip() != b"":
+                    self.offsets[get_line_image_id(line)] = offset
+                offset += len(line)
+
+    def iter_records(self, start_index: int, stop_index: int):
+        # Yields the records with image_id in [start_index, stop_index)
+        if start_index not in self.offsets:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.offsets[start_index])
+            for line in f:
+                if line.strip() == b"":
+                    continue
+                record = json.loads(line)
+                if record["image_id"] >= stop_index:
+                    return
+                yield record
+
+# --------------------------- COMMAND LINE ---------------------------
+
+worker_planner__ = None
+
+def init_worker(args_dict: dict, rules_dict: dict):
+    global worker_planner__
+    args = setup_argparser().parse_args([])
+    vars(args).update(args_dict)
+    rules = Rules(rules_dict)
+    worker_planner__ = ScenePlanner(args, rules, GeometryCache(args.geometry_cache_dir))
+
+def plan_chunk(job: tuple) -> list:
+    start, stop, base_seed = job
+    return [worker_planner__.plan_image(i, get_image_seed(base_seed, i)) for i in range(start, stop)]
+
+MAX_PLAN_ATTEMPTS = 10 #times an invalid or duplicate scene is planned again
+
+def write_plan(args, rules: Rules, base_seed: int, workers: int, chunk_size=64) -> dict:
+    # Plans all the images from args.start_index to args.num_images in parallel and writes them to
+    # args.scene_plan, invalid and duplicate scenes are planned again with a different seed.
+    # Returns the stats of the planning.
+    planner = ScenePlanner(args, rules, GeometryCache(args.geometry_cache_dir))
+    stats = {"planned" : 0, "invalid" : 0, "duplicates" : 0, "failed_shapes" : 0}
+    keys = set()
+
+    jobs = [
+        (start, min(start + chunk_size, args.num_images), base_seed)
+        for start in range(args.start_index, args.num_images, chunk_size)
+    ]
+
+    tmp_path = f"{args.scene_plan}.tmp"
+    with Pool(workers, initializer=init_worker, initargs=(vars(args), rules.get_dict())) as pool, open(tmp_path, "w") as f:
+        for records in pool.imap(plan_chunk, jobs):
+            for record in records:
+                attempt = 0
+                while True: #every record is validated, including the last one planned again
+                    errors = validate_record(record, args, rules)
+                    key = get_record_key(record)
+                    if len(errors) == 0 and key not in keys:
+                        break
+                    if len(errors) > 0:
+                        stats["invalid"] += 1
+                        print(f"Invalid scene {record['image_id']}: {', '.join(errors)}")
+                    else:
+                        stats["duplicates"] += 1
+                    attempt += 1
+                    if attempt > MAX_PLAN_ATTEMPTS: #the renderer needs a record for every image, it can't be skipped
+                        raise Exception(f"Could not plan a valid and unique scene for image {record['image_id']} " +
+                                        f"after {MAX_PLAN_ATTEMPTS} attempts, check the rules and the arguments")
+                    record = planner.plan_image(record["image_id"], get_image_seed(base_seed, record["image_id"], attempt))
+
+                keys.add(key)
+                stats["planned"] += 1
+                stats["failed_shapes"] += record["placement_stats"]["failed"]
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    os.replace(tmp_path, args.scene_plan)
+    return stats
+
+if __name__ == "__main__":
+    os.chdir(pathlib.Path(__file__).parent.resolve())
+    parser = setup_argparser()
+    argv = extract_args()
+    args = parser.parse_args(argv)
+    if args.config is not None:
+        with open(args.config, "r") as f:
+            parser.set_defaults(**json.load(f))
+            args = parser.parse_args(argv)
+
+    assert args.scene_plan is not None, "'scene_plan' argument is not optional"
+    with open(args.rules, "r") as f:
+        rules = Rules(json.load(f))
+
+    base_seed = args.plan_seed if args.plan_seed is not None else random.getrandbits(32)
+    stats = write_plan(args, rules, base_seed, args.plan_workers)
+    print(f"Scene plan written to {args.scene_plan} (seed: {base_seed})\n{stats}")
@@ -0,0 +1,102 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import bpy #type: ignore
+from SSHAPE_Dataset_generator.asset_cache import AssetCache
+
+class ScenePool:
+    # Keeps the shapes and lights of previous images in the scene and reuses them instead of
+    # deleting and creating new ones for every image.
+    # Members which are not used in the current image are hidden from rendering.
+
+    def __init__(self, asset_cache: AssetCache):
+        self.asset_cache = asset_cache
+        self.shapes = {} #(shape_dir, name) -> list of pooled objects
+        self.shapes_in_use = {} #(shape_dir, name) -> number of objects used in the current image
+        self.lights = []
+        self.lights_in_use = 0
+
+    def acquire_shape(self, shape_dir: str, shape_rule: dict, obj_name: str):
+        # Returns a shape ready to be transformed, reusing a hidden pool member if available
+        # Args:
+        # - shape_dir (str): directory in which the shape file is stored
+        # - shape_rule (dict): rule of the shape
+        # - obj_name (str): name to give to the object
+        key = (os.path.abspath(shape_dir), shape_rule["name"])
+        members = self.shapes.setdefault(key, [])
+        index = self.shapes_in_use.get(key, 0)
+        self.shapes_in_use[key] = index + 1
+
+        if index == len(members):
+            obj = self.asset_cache.instantiate(shape_dir, shape_rule, obj_name)
+            members.append(obj)
+            return obj
+
+        obj = members[index]
+        self.reset_shape(obj)
+        obj.name = obj_name
+
+        return obj
+
+    def reset_shape(self, obj):
+        # Brings a pool member back to the state of its template
+        # NOTE: Pool members keep the mesh of their template, transformations and materials are only
+        #       set on the object, so nothing has to be copied and the geometry doesn't change between images
+        for slot in obj.material_slots:
+            slot.material = None
+
+        obj.location = (0, 0, 0)
+        obj.rotation_euler = (0, 0, 0)
+        obj.scale = (1, 1, 1)
+        if "inst_id" in obj:
+            del obj["inst_id"]
+        obj.pass_index = 0
+
+        obj.hide_render = False
+
+    def acquire_light(self, energy: float):
+        # Returns a point light ready to be placed, reusing a hidden pool member if available
+        # Args:
+        # - energy (float): intensity of the light
+        if self.lights_in_use == len(self.lights):
+            i = len(self.lights)
+            light_data = bpy.data.lights.new(name=f"Light_{i}_data", type='POINT')
+            light_object = bpy.data.objects.new(name=f"Light_{i}", object_data=light_data)
+            bpy.context.collection.objects.link(light_object)
+            self.lights.append(light_object)
+
+        light_object = self.lights[self.lights_in_use]
+        light_object.data.energy = energy
+        light_object.hide_render = False
+        self.lights_in_use += 1
+
+        return light_object
+
+    def release_all(self):
+        # Hides every shape and light used in the current image, they will be reused in the next one
+        for key, in_use in self.shapes_in_use.items():
+            for i, obj in enumerate(self.shapes[key][:in_use]):
+                obj.hide_render = True
+                obj.name = f"POOL_{key[1]}_{i}"
+        self.shapes_in_use = {}
+
+        for light_object in self.lights[:self.lights_in_use]:
+            light_object.hide_render = True
+        self.lights_in_use = 0
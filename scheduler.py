@@ -0,0 +1,163 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import fcntl, json, os, time
+from contextlib import contextmanager
+from SSHAPE_Dataset_generator.checkpoint import write_json_atomic
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+
+class WorkQueue:
+    # Queue of image index chunks shared by the rendering processes of a multi gpu run.
+    # Every worker takes the next pending chunk when it finishes the previous one, so faster gpu groups
+    # render more images. The queue is a JSON file protected by a file lock, each chunk covers
+    # [start, stop) and chunks cover all the images without gaps or overlaps.
+    # A leased chunk whose worker hasn't sent a heartbeat for 'lease_timeout' seconds is considered lost
+    # (e.g. the process crashed) and is given to the next worker asking for work. Heartbeats are only
+    # written every 'heartbeat_interval' seconds, so workers don't lock and rewrite the queue for every image.
+
+    def __init__(self, path: str, lease_timeout: float = 600, poll_interval: float = 5, heartbeat_interval: float = None):
+        # Args:
+        # - path (str): path of the queue file
+        # - lease_timeout (float): seconds without heartbeats after which a chunk is given to another worker
+        # - poll_interval (float): seconds to wait before asking again for work when every chunk left is leased
+        # - heartbeat_interval (float): minimum seconds between two heartbeats of this process, a quarter
+        #   of 'lease_timeout' if None
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval if heartbeat_interval is not None else lease_timeout / 4
+        self.last_heartbeat = None #time of the last heartbeat written by this process
+
+    @contextmanager
+    def locked(self):
+        # Gives exclusive access to the queue, yields the queue dict which is saved on exit
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self.path, "r") as f:
+                    queue = json.load(f)
+                yield queue
+                write_json_atomic(self.path, queue)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def create(self, start: int, stop: int, chunk_size: int):
+        # Creates the queue with all the images in [start, stop), replacing the queue of a previous run
+        # NOTE: Only new runs create the queue, resumed runs keep using the existing one
+        # Args:
+        # - start (int): first image index
+        # - stop (int): image index after the last one
+        # - chunk_size (int): number of images in every chunk
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        chunks = [
+            {"start" : i, "stop" : min(i + chunk_size, stop), "status" : PENDING, "worker" : None, "heartbeat" : None}
+            for i in range(start, stop, chunk_size)
+        ]
+        write_json_atomic(self.path, {"start" : start, "stop" : stop, "chunks" : chunks, "recovered" : 0})
+
+    def try_claim(self, worker_id: str):
+        # Returns the chunk to render as (start, stop), None if there is no chunk available at the moment
+        # and False if every chunk is done
+        now = time.time()
+        with self.locked() as queue:
+            chunks = queue["chunks"]
+
+            for chunk in chunks: #chunks leased by this worker before a restart
+                if chunk["status"] == LEASED and chunk["worker"] == worker_id:
+                    chunk["heartbeat"] = now
+                    self.last_heartbeat = now
+                    return chunk["start"], chunk["stop"]
+
+            for chunk in chunks: #chunks of dead workers
+                if chunk["status"] == LEASED and now - chunk["heartbeat"] > self.lease_timeout:
+                    print(f"Chunk [{chunk['start']}, {chunk['stop']}) of worker {chunk['worker']} expired")
+                    chunk["status"] = PENDING
+                    queue["recovered"] += 1
+
+            for chunk in chunks:
+                if chunk["status"] == PENDING:
+                    chunk["status"] = LEASED
+                    chunk["worker"] = worker_id
+                    chunk["heartbeat"] = now
+                    self.last_heartbeat = now
+                    return chunk["start"], chunk["stop"]
+
+            if all(chunk["status"] == DONE for chunk in chunks):
+                return False
+            return None
+
+    def claim(self, worker_id: str):
+        # Returns the next chunk to render as (start, stop), waits if every chunk left is leased by other
+        # workers (it may expire), returns None when every chunk is done
+        while True:
+            chunk = self.try_claim(worker_id)
+            if chunk is False:
+                return None
+            if chunk is not None:
+                return chunk
+            time.sleep(self.poll_interval)
+
+    def heartbeat(self, worker_id: str):
+        # Renews the leases of a worker, does nothing if the last heartbeat is more recent than 'heartbeat_interval'
+        now = time.time()
+        if self.last_heartbeat is not None and now - self.last_heartbeat < self.heartbeat_interval:
+            return
+        self.last_heartbeat = now
+        with self.locked() as queue:
+            for chunk in queue["chunks"]:
+                if chunk["status"] == LEASED and chunk["worker"] == worker_id:
+                    chunk["heartbeat"] = now
+
+    def complete(self, worker_id: str, start: int, stop: int):
+        # Marks a chunk as done
+        with self.locked() as queue:
+            for chunk in queue["chunks"]:
+                if chunk["start"] == start and chunk["stop"] == stop:
+                    if chunk["status"] == DONE:
+                        print(f"Chunk [{start}, {stop}) was already completed by worker {chunk['worker']}")
+                    else:
+                        chunk["status"] = DONE
+                        chunk["worker"] = worker_id
+                        chunk["heartbeat"] = time.time()
+                    return
+        raise Exception(f"Chunk [{start}, {stop}) is not in the work queue")
+
+    def release_worker(self, worker_id: str):
+        # Makes the chunks leased by a worker available to the others (e.g. when the worker is stopped)
+        with self.locked() as queue:
+            for chunk in queue["chunks"]:
+                if chunk["status"] == LEASED and chunk["worker"] == worker_id:
+                    chunk["status"] = PENDING
+                    chunk["worker"] = None
+
+    def get_summary(self) -> dict:
+        # Returns the number of chunks in every status, the number of images rendered by every worker
+        # and the number of chunks recovered from dead workers
+        with self.locked() as queue:
+            summary = {"chunks" : {PENDING : 0, LEASED : 0, DONE : 0}, "images" : {}, "recovered" : queue["recovered"]}
+            for chunk in queue["chunks"]:
+                summary["chunks"][chunk["status"]] += 1
+                if chunk["status"] == DONE:
+                    images = summary["images"]
+                    images[chunk["worker"]] = images.get(chunk["worker"], 0) + chunk["stop"] - chunk["start"]
+        return summary
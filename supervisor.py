@@ -0,0 +1,216 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import fcntl, json, os, signal, subprocess, time
+from contextlib import contextmanager
+from SSHAPE_Dataset_generator.checkpoint import write_json_atomic, BASE_FILENAME
+from SSHAPE_Dataset_generator.utils import change_args, get_split_filename, get_cores_pinning
+from SSHAPE_Dataset_generator.errors import RenderFailedError
+
+EXIT_RESTART = 75 #exit code of a worker which must be restarted (memory limit), it resumes from its checkpoint
+
+def retry(func, retries: int = 3, backoff: float = 2, description: str = "render"):
+    # Calls a function until it succeeds, at most 'retries' more times after the first failure, waiting
+    # 'backoff' seconds before the first retry and doubling the wait after every other failure.
+    # Returns the result of the function, raises RenderFailedError if every attempt failed
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            print(f"{description} failed (attempt {attempt + 1} of {retries + 1}): {e}")
+            if attempt == retries:
+                raise RenderFailedError(description, retries + 1, e) from e
+            time.sleep(backoff * 2 ** attempt)
+
+class Quarantine:
+    # Indices of the images which kept failing or hung the renderer, they are skipped so the run moves on.
+    # The list is a JSON file protected by a file lock, it can be shared by all the workers of a multi
+    # gpu run.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.indices = set()
+        self.mtime = None
+
+    @contextmanager
+    def locked(self):
+        # Gives exclusive access to the list, yields the list of failed images which is saved on exit
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                failed = []
+                if os.path.exists(self.path):
+                    with open(self.path, "r") as f:
+                        failed = json.load(f)["failed"]
+                yield failed
+                write_json_atomic(self.path, {"failed" : failed})
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def add(self, index: int, reason: str):
+        print(f"Image {index} quarantined: {reason}")
+        with self.locked() as failed:
+            failed.append({"index" : index, "reason" : reason, "time" : time.time()})
+        self.indices.add(index)
+
+    def get_indices(self) -> set:
+        # Returns the indices in the list, reading the file again only if it changed
+        if not os.path.exists(self.path):
+            return self.indices
+        mtime = os.path.getmtime(self.path)
+        if mtime != self.mtime:
+            with open(self.path, "r") as f:
+                self.indices = {record["index"] for record in json.load(f)["failed"]}
+            self.mtime = mtime
+        return self.indices
+
+    def __contains__(self, index: int) -> bool:
+        return index in self.get_indices()
+
+class ImageHeartbeat:
+    # File written by a rendering process when it starts and when it finishes every image, the parent process
+    # kills the rendering process if an image takes too long (see 'get_hung_image').
+    # NOTE: Hangs can't be detected by a thread of the rendering process, bpy.ops.render.render holds the
+    #       GIL for the whole render so no other python thread runs until it returns.
+
+    def __init__(self, path: str = None):
+        # Args:
+        # - path (str): heartbeat file, if None nothing is written (e.g. process without a parent)
+        self.path = path
+
+    def start(self, index: int):
+        self.write(index)
+
+    def stop(self):
+        self.write(None)
+
+    def write(self, index):
+        if self.path is not None:
+            write_json_atomic(self.path, {"index" : index, "time" : time.time()})
+
+def get_hung_image(heartbeat_path: str, timeout: float):
+    # Returns the index of the image a process has been rendering for more than 'timeout' seconds, None if
+    # it isn't hung (or 'timeout' is 0)
+    if timeout <= 0 or not os.path.exists(heartbeat_path):
+        return None
+    try:
+        with open(heartbeat_path, "r") as f:
+            heartbeat = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if heartbeat["index"] is not None and time.time() - heartbeat["time"] > timeout:
+        return heartbeat["index"]
+    return None
+
+def get_quarantine_path(args) -> str:
+    # Returns the quarantine file of a rendering, by default shared by all the shards of the split
+    if args.quarantine is not None:
+        return args.quarantine
+    return os.path.abspath(os.path.join(
+        args.output_dir, args.split, get_split_filename(args.split, "quarantine.json", args.filename_prefix)
+    ))
+
+def get_heartbeat_path(args, shard_id=None) -> str:
+    # Returns the heartbeat file of a rendering process
+    return os.path.abspath(os.path.join(
+        args.output_dir, args.split, get_split_filename(args.split, "heartbeat.json", args.filename_prefix, shard_id)
+    ))
+
+def start_process(argv: list, heartbeat_path: str, **kwargs):
+    # Starts a rendering process writing its heartbeat to 'heartbeat_path'
+    if os.path.exists(heartbeat_path): #left by the previous process, it could look hung
+        os.remove(heartbeat_path)
+    argv = change_args(argv.copy(), heartbeat_file=heartbeat_path)
+    return subprocess.Popen(["blender", "-b", "--python", "create_dataset.py", "--"] + argv, **kwargs)
+
+def kill_hung_process(process, index: int, quarantine_path: str) -> int:
+    # Kills a process stuck on an image and quarantines the image, returns EXIT_RESTART so the process is
+    # started again like after a memory restart
+    print(f"Image {index} is taking too long, restarting the rendering process")
+    process.kill()
+    process.wait()
+    Quarantine(quarantine_path).add(index, "hang")
+    return EXIT_RESTART
+
+def run_supervised(argv: list, args, checkpoint_dir: str) -> int:
+    # Runs a rendering process and starts it again from its checkpoint every time it hangs on an image (it's
+    # killed) or exits asking for a restart (memory limit), at most 'max_restarts' times.
+    # Returns the exit code of the last process.
+    # Args:
+    # - argv (list): arguments of create_dataset.py
+    # - args: parsed arguments of the rendering
+    # - checkpoint_dir (str): checkpoint directory of the rendering
+    max_restarts = args.max_restarts
+    heartbeat_path = get_heartbeat_path(args, args.shard_id)
+    process = None
+    stopping = False
+
+    def stop(sig, frm):
+        #forwards the signal, the process stops after the current image and saves a checkpoint
+        nonlocal stopping
+        stopping = True
+        if process is not None and process.poll() is None:
+            process.send_signal(sig)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    restarts = 0
+    while True:
+        #the first process only resumes if '--resume' was given, checkpoints of older runs are replaced
+        if restarts > 0 and os.path.exists(os.path.join(checkpoint_dir, BASE_FILENAME)):
+            #arguments given after '--resume' override the ones in the checkpoint
+            argv = change_args(argv.copy(), resume=checkpoint_dir)
+        process = start_process(argv, heartbeat_path, preexec_fn=get_cores_pinning(args.cpu_cores))
+        while True:
+            return_code = process.poll()
+            if return_code is not None:
+                break
+            hung_index = get_hung_image(heartbeat_path, args.image_timeout)
+            if hung_index is not None and not stopping:
+                return_code = kill_hung_process(process, hung_index, get_quarantine_path(args))
+                break
+            time.sleep(1)
+        if return_code != EXIT_RESTART or stopping:
+            return return_code
+        if restarts == max_restarts:
+            print(f"The rendering process was restarted {restarts} times, giving up")
+            return return_code
+        restarts += 1
+        print(f"Restarting the rendering process ({restarts} of {max_restarts})")
+
+def run_pinned(argv: list, cpu_cores: str) -> int:
+    # Runs the rendering in a child process pinned to 'cpu_cores' from its start and returns its exit code
+    # NOTE: Blender starts its threads before running create_dataset.py and they keep the affinity the
+    #       process had at that point, sched_setaffinity on the running process would only pin new threads.
+    # Args:
+    # - argv (list): arguments of create_dataset.py
+    # - cpu_cores (str): cores to pin the process to, e.g. '0-7'
+    process = subprocess.Popen(["blender", "-b", "--python", "create_dataset.py", "--"] + argv,
+                               preexec_fn=get_cores_pinning(cpu_cores))
+
+    def stop(sig, frm):
+        #forwards the signal, the process stops after the current image and saves a checkpoint
+        if process.poll() is None:
+            process.send_signal(sig)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    return process.wait()
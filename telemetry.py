@@ -0,0 +1,143 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os, time
+from collections import deque
+from contextlib import contextmanager
+
+# Stages of every image, in the order they happen
+STAGES = ["populate", "asset_append", "material", "bbox", "prepass", "render", "ground_truth", "write", "cleanup"]
+
+class StageTimer:
+    # Measures the time spent in every stage of the current image.
+    # Stages can be nested (e.g. 'asset_append' inside 'populate'), the time of a nested stage is only
+    # counted in the nested stage, so the times of all the stages add up to the time of the image.
+
+    def __init__(self):
+        self.stages = {}
+        self.stack = [] #[name, time spent in nested stages]
+
+    @contextmanager
+    def stage(self, name: str):
+        self.stack.append([name, 0])
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            _, nested_time = self.stack.pop()
+            self.stages[name] = self.stages.get(name, 0) + elapsed - nested_time
+            if len(self.stack) > 0:
+                self.stack[-1][1] += elapsed
+
+    def pop(self) -> dict:
+        # Returns the time of every stage of the current image and starts a new one
+        stages, self.stages = self.stages, {}
+        return stages
+
+class Throughput:
+    # Rolling images per second over the last 'window' images
+
+    def __init__(self, window: int = 50):
+        self.times = deque(maxlen=window + 1)
+        self.times.append(time.time())
+
+    def update(self) -> float:
+        # Counts a new image and returns the current images per second
+        self.times.append(time.time())
+        elapsed = self.times[-1] - self.times[0]
+        return (len(self.times) - 1) / elapsed if elapsed > 0 else 0
+
+class PrometheusTextfile:
+    # Writes metrics in the Prometheus text format, to be exported by the textfile collector of node_exporter.
+    # The file is replaced atomically so the collector never reads a partial file.
+
+    def __init__(self, path: str, labels: dict):
+        self.path = path
+        self.labels = ",".join(f'{key}="{value}"' for key, value in labels.items() if value is not None)
+
+    def format(self, name: str, value, extra_labels: str = "") -> str:
+        labels = ",".join(label for label in [self.labels, extra_labels] if label != "")
+        return f"{name}{{{labels}}} {value}\n"
+
+    def write(self, images: int, images_per_sec: float, eta, stage_totals: dict, rss):
+        lines = [
+            "# TYPE sshape_images_total counter\n",
+            self.format("sshape_images_total", images),
+            "# TYPE sshape_images_per_second gauge\n",
+            self.format("sshape_images_per_second", images_per_sec),
+            "# TYPE sshape_stage_seconds_total counter\n",
+        ]
+        lines += [self.format("sshape_stage_seconds_total", total, f'stage="{stage}"') for stage, total in stage_totals.items()]
+        if eta is not None:
+            lines += ["# TYPE sshape_eta_seconds gauge\n", self.format("sshape_eta_seconds", eta)]
+        if rss is not None:
+            lines += ["# TYPE sshape_rss_bytes gauge\n", self.format("sshape_rss_bytes", rss)]
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(lines)
+        os.replace(tmp_path, self.path)
+
+class Telemetry:
+    # Collects the stage times of every image, the images per second and the ETA of the rendering
+
+    def __init__(self, textfile: PrometheusTextfile = None, print_every: int = 0):
+        # Args:
+        # - textfile (PrometheusTextfile): if set the metrics are written to it after every image
+        # - print_every (int): if > 0 a progress line is printed every N images (used when tqdm is missing)
+        self.timer = StageTimer()
+        self.throughput = Throughput()
+        self.textfile = textfile
+        self.print_every = print_every
+        self.images = 0
+        self.stage_totals = {stage : 0 for stage in STAGES}
+
+    def stage(self, name: str):
+        return self.timer.stage(name)
+
+    def finish_image(self, remaining, rss=None) -> dict:
+        # Ends the current image, returns its metrics
+        # Args:
+        # - remaining (int): images left to render, None if unknown (e.g. dynamic scheduler)
+        # - rss (int): memory used by the process in bytes
+        stages = self.timer.pop()
+        for stage, stage_time in stages.items():
+            self.stage_totals[stage] = self.stage_totals.get(stage, 0) + stage_time
+        self.images += 1
+        images_per_sec = self.throughput.update()
+        eta = remaining / images_per_sec if remaining is not None and images_per_sec > 0 else None
+
+        if self.textfile is not None:
+            self.textfile.write(self.images, images_per_sec, eta, self.stage_totals, rss)
+        if self.print_every > 0 and self.images % self.print_every == 0:
+            eta_str = time.strftime("%H:%M:%S", time.gmtime(eta)) if eta is not None else "unknown"
+            print(f"{self.images} images - {images_per_sec:.2f} images/s - ETA: {eta_str}")
+
+        return {"stages" : stages, "images_per_sec" : images_per_sec, "eta" : eta}
+
+    def get_images_per_sec(self) -> float:
+        # Returns the average throughput of the whole run
+        total = sum(self.stage_totals.values())
+        return self.images / total if total > 0 else 0
+
+    def get_summary(self) -> dict:
+        # Returns the share of the total time spent in every stage
+        total = sum(self.stage_totals.values())
+        return {stage : stage_time / total if total > 0 else 0 for stage, stage_time in self.stage_totals.items()}
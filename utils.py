@@ -17,7 +17,7 @@ You should have received a copy of the GNU General Public License along with SSH
 If not, see <https://www.gnu.org/licenses/>.
 """
 
-import argparse, sys, random
+import argparse, sys, random, os, json
 from SSHAPE_Dataset_generator.errors import *
 from math import radians
 import mathutils #type:ignore
@@ -42,14 +42,40 @@ def setup_argparser():
                     help="Height (in pixels) of every image.")
     ap.add_argument("--use_gpu", default=1, type=int,
                     help="Whether or not to use gpu fo rendering (1 for yes, 0 for no).")
-    #ap.add_argument("--image_format", default="jpg",
-    #                help="Saving format for images, must be supported bu OpenCV")
+    ap.add_argument("--render_profile", default="default",
+                    help="Render profile (device type, samples, adaptive sampling, denoiser, bounces, tile size, " +
+                    "persistent data) to use, see 'render_profiles.json'.")
+    ap.add_argument("--render_profiles_file", default="./render_profiles.json",
+                    help="JSON file with the render profiles.")
+    ap.add_argument("--render_engine", default="CYCLES", choices=["CYCLES", "BLENDER_EEVEE", "BLENDER_WORKBENCH"],
+                    help="Engine used to render the images, EEVEE and Workbench are much faster than Cycles and " +
+                    "are meant for previews of the layouts, see --preview_scale.")
+    ap.add_argument("--preview_scale", default=50, type=int,
+                    help="Resolution percentage used when rendering with EEVEE or Workbench, annotations refer " +
+                    "to the reduced resolution.")
+    ap.add_argument("--image_format", default="png", choices=["png", "jpg", "webp"],
+                    help="Saving format for images.")
+    ap.add_argument("--image_quality", default=95, type=int,
+                    help="Quality (1-100) of jpg and webp images.")
+    ap.add_argument("--segmentation_format", default="png", choices=["png", "webp"],
+                    help="Saving format for segmentations, webp segmentations are lossless.")
+    ap.add_argument("--depth_format", default="png", choices=["png", "exr"],
+                    help="Saving format for depth maps: 'png' stores millimeters as 16 bit integers, 'exr' " +
+                    "stores meters as half floats.")
     ap.add_argument("--create_segmentations", default=1, type=int,
                     help="Whether or not to create segmentation ground truth data (1 for yes, 0 for no).")
     ap.add_argument("--create_depth", default=1, type=int,
                     help="Whether or not to create depth ground truth data (1 for yes, 0 for no).")
     ap.add_argument("--create_bounding_boxes", default=1, type=int,
                     help="Whether or not to create bounding boxes ground truth data (1 for yes, 0 for no).")
+    ap.add_argument("--ground_truth_method", default="bpycv", choices=["bpycv", "passes", "raster"],
+                    help="How segmentations and depth are created: 'bpycv' renders every image a second time " +
+                    "with bpycv, 'passes' reads them from the object index and depth passes of the main render, " +
+                    "'raster' rasterizes the meshes in NumPy without rendering and also makes bounding boxes " +
+                    "tight around the visible pixels of every object.")
+    ap.add_argument("--render_rgb", default=1, type=int,
+                    help="Whether or not to render the RGB images (1 for yes, 0 for no), 0 creates only " +
+                    "annotations, segmentations and depth and requires '--ground_truth_method raster'.")
     # --------------- INPUT OPTIONS ---------------
     ap.add_argument("--materials_dir", default="./materials",
                     help="Directory in which materials are stored (in .blend format)")
@@ -63,7 +89,7 @@ def setup_argparser():
                     help="Base blender scene, objects coordinates are relative to its origin, the working" + 
                     "area is centerd on the origin on x and y starts on z=0.")
     ap.add_argument("--resume", default=None,
-                    help="Path of the checkpoint file to resume a paused rendering.")
+                    help="Path of the checkpoint file or checkpoint directory to resume a paused rendering.")
     ap.add_argument("--config", default=None,
                     help="Config file (JSON) to use instead of command line arguments")
     # --------------- SETTINGS ---------------
@@ -96,7 +122,22 @@ def setup_argparser():
                          "object and the plane boundaries.")
     ap.add_argument("--min_pixels_per_object", default=200, type=int,
                     help="Minimum pixels visible for every object, if this condition is not met the " +
-                         "scene is discarded and recreated.")
+                         "scene is discarded and recreated (0 to disable the check). Pixels are counted " +
+                         "on a low resolution rasterization of the scene, see --prepass_scale.")
+    ap.add_argument("--prepass_scale", default=0.25, type=float,
+                    help="Scale of the resolution of the pre-pass checking every scene before rendering it.")
+    ap.add_argument("--max_scene_retries", default=5, type=int,
+                    help="Maximum number of times a scene failing the pre-pass is recreated, after that the " +
+                    "last scene is rendered anyway.")
+    ap.add_argument("--check_exposure", default=0, type=int,
+                    help="Whether or not to render the pre-pass at low resolution and low samples and discard " +
+                    "scenes whose mean brightness is outside --min_exposure and --max_exposure (1 for yes, 0 for no).")
+    ap.add_argument("--prepass_samples", default=4, type=int,
+                    help="Samples of the pre-pass render used to check exposure.")
+    ap.add_argument("--min_exposure", default=0.1, type=float,
+                    help="Minimum mean brightness (0-1) of the images.")
+    ap.add_argument("--max_exposure", default=0.9, type=float,
+                    help="Maximum mean brightness (0-1) of the images.")
     ap.add_argument("--lights_jitter", default=0.4, type=float,
                     help="Max amount of random movement from the default position of each light.")
     ap.add_argument("--lights_distance", default=3, type=float,
@@ -106,6 +147,83 @@ def setup_argparser():
     ap.add_argument("--test_mode", default=0, type=int,
                     help="Sets testing mode (1 for yes, 0 for no), see docs 'Testing mode'.")
     ap.add_argument("--start_index", default=0, type=int)
+
+    # --------------- PERFORMANCE ---------------
+
+    ap.add_argument("--use_asset_cache", default=1, type=int,
+                    help="Whether or not to load every shape file only once and create new shapes by copying " +
+                    "it from memory (1 for yes, 0 for no).")
+    ap.add_argument("--pooled_scene", default=0, type=int,
+                    help="Whether or not to keep shapes and lights in the scene between images and reuse them " +
+                    "instead of deleting and creating new ones (1 for yes, 0 for no).")
+    ap.add_argument("--use_geometry_cache", default=1, type=int,
+                    help="Whether or not to precompute the geometry of every shape (convex hull, resting faces, " +
+                    "ground offset) and use it instead of the full mesh (1 for yes, 0 for no).")
+    ap.add_argument("--geometry_cache_dir", default="./geometry_cache",
+                    help="Directory in which the precomputed geometry of the shapes is stored.")
+    ap.add_argument("--placement_batch_size", default=32, type=int,
+                    help="Number of candidate positions checked at once when placing a shape.")
+    ap.add_argument("--max_placement_attempts", default=200, type=int,
+                    help="Maximum number of candidate positions checked before a shape is removed from the scene.")
+    ap.add_argument("--scene_plan", default=None,
+                    help="Scene plan file (see 'scene_plan.py'), if set the scenes are built from the plan " +
+                    "instead of being created randomly.")
+    ap.add_argument("--plan_seed", default=None, type=int,
+                    help="Seed used when creating a scene plan, if unset a random one is used.")
+    ap.add_argument("--plan_workers", default=os.cpu_count(), type=int,
+                    help="Number of processes used to create a scene plan.")
+    ap.add_argument("--stream_annotations", default=0, type=int,
+                    help="Whether or not to write the annotations of every image to a JSON lines file as soon as " +
+                    "it's rendered instead of keeping them in memory, the COCO annotations file is assembled from " +
+                    "it at the end (1 for yes, 0 for no).")
+    ap.add_argument("--checkpoint_every", default=100, type=int,
+                    help="Save a checkpoint every N images (0 to disable).")
+    ap.add_argument("--checkpoint_interval", default=300, type=float,
+                    help="Save a checkpoint if more than this many seconds have passed since the last one " +
+                    "(0 to disable).")
+    ap.add_argument("--writer_threads", default=2, type=int,
+                    help="Number of threads writing segmentations and depth maps in the background while the " +
+                    "next image is rendered (0 to write them synchronously).")
+    ap.add_argument("--writer_queue_size", default=8, type=int,
+                    help="Maximum number of images waiting to be written, when full the renderer waits.")
+    ap.add_argument("--png_compression", default=3, type=int, choices=range(10),
+                    help="PNG compression level from 0 (fastest, biggest files) to 9 (slowest, smallest files), " +
+                    "see 'python image_formats.py' to compare formats.")
+    ap.add_argument("--render_retries", default=3, type=int,
+                    help="Number of times the rendering of an image is retried after an error, after that the " +
+                    "image is skipped and added to the quarantine list.")
+    ap.add_argument("--retry_backoff", default=2, type=float,
+                    help="Seconds to wait before retrying a failed image, doubled after every failure.")
+    ap.add_argument("--image_timeout", default=0, type=float,
+                    help="Seconds after which an image is considered hung: the parent process (--supervise or " +
+                    "multi gpu run) kills the rendering process, adds the image to the quarantine list and starts " +
+                    "the process again (0 disables the check).")
+    ap.add_argument("--heartbeat_file", default=None,
+                    help="File in which the index of the image being rendered is written, set automatically " +
+                    "by the parent process to detect hangs.")
+    ap.add_argument("--max_rss_mb", default=0, type=int,
+                    help="Memory (in MB) over which the process saves a checkpoint and exits to be restarted, " +
+                    "see --supervise (0 disables the check).")
+    ap.add_argument("--quarantine", default=None,
+                    help="JSON file listing the images which failed or hung, they are skipped. By default it's " +
+                    "written next to the annotations and shared by all the workers of the split.")
+    ap.add_argument("--supervise", default=0, type=int,
+                    help="Whether or not to run the rendering in a child process which is restarted from its " +
+                    "checkpoint after a hang or when it goes over --max_rss_mb (1 for yes, 0 for no). Workers " +
+                    "of multi gpu runs are always restarted.")
+    ap.add_argument("--max_restarts", default=10, type=int,
+                    help="Maximum number of restarts of a rendering process.")
+    ap.add_argument("--purge_every", default=1, type=int,
+                    help="Remove unused meshes, lights, materials and images from memory every N images " +
+                    "(0 to disable).")
+    ap.add_argument("--create_run_log", default=1, type=int,
+                    help="Whether or not to log memory usage, datablock counts, time of every stage and images " +
+                    "per second of every image in the run log (1 for yes, 0 for no).")
+    ap.add_argument("--metrics_textfile", default=None,
+                    help="If set the rendering metrics (images, images per second, ETA, time of every stage) " +
+                    "are written to this file in the Prometheus text format after every image.")
+    ap.add_argument("--progress_every", default=10, type=int,
+                    help="Print a progress line every N images if tqdm is not installed (0 to disable).")
     
     # --------------- MULTI GPU ---------------
 
@@ -113,16 +231,163 @@ def setup_argparser():
                     help="Which devices to use for rendering, separate each one with a space." + 
                     "Incompatible with --use_multiple_gpus.")
 
+    ap.add_argument("--device_type", default=None, choices=["CPU", "CUDA", "OPTIX", "HIP", "METAL", "ONEAPI"],
+                    help="Overrides the device type of the render profile, 'CPU' renders on the cpu.")
+    ap.add_argument("--cpu_threads", default=0, type=int,
+                    help="Number of threads used to render on the cpu (0 to use all the available ones).")
+    ap.add_argument("--cpu_cores", default=None,
+                    help="CPU cores the process is pinned to, e.g. '0-7' or '0,2,4,6'. With --cpu_workers the " +
+                    "cores which are split among the cpu workers.")
+    ap.add_argument("--cpu_workers", default=0, type=int,
+                    help="Number of cpu workers added to the gpu groups of a multi gpu run, the available cores " +
+                    "are split among them and every worker is pinned to its own cores.")
     ap.add_argument("--use_multiple_gpus", default=0, type=int,
                     help="Wether or not to divide the rendering across multiple gpus (enable "+
                     "with 1, disable with 0.")
 
     ap.add_argument("--gpu_groups", default=None, nargs="+",
                     help="IDs of devices across which the rendering must be divided, see docs" +
-                    "'Multi gpu rendering' for more info.")
+                    "'Multi gpu rendering' for more info. A group like 'cpu:0-7' renders on the cpu cores 0-7.")
+    ap.add_argument("--scheduler", default="dynamic", choices=["static", "dynamic"],
+                    help="How images are divided between gpu groups: 'static' gives every group a fixed range " +
+                    "based on a benchmark, 'dynamic' gives small chunks of images to each group as soon as it " +
+                    "finishes the previous one.")
+    ap.add_argument("--calibration_scenes", default=0, type=int,
+                    help="Number of scenes sampled from the rules and the arguments used to measure the speed of " +
+                    "each gpu group with the static scheduler, if 0 the files in 'benchmark_files' are used.")
+    ap.add_argument("--calibration_samples", default=8, type=int,
+                    help="Number of samples used to render the calibration scenes.")
+    ap.add_argument("--calibration_cache", default="./calibration_cache.json",
+                    help="File in which the speed of each gpu group is saved, a group is calibrated again only " +
+                    "if its devices, the blender version, the render settings or the calibration scenes change.")
+    ap.add_argument("--chunk_size", default=16, type=int,
+                    help="Number of images in every chunk of the dynamic scheduler.")
+    ap.add_argument("--work_queue", default=None,
+                    help="Work queue file used by the dynamic scheduler, set automatically for each gpu group.")
+    ap.add_argument("--worker_id", default=None,
+                    help="ID of the gpu group in a multi gpu run, set automatically for each gpu group.")
+    ap.add_argument("--shard_id", default=None,
+                    help="If set annotations, checkpoints and logs are written to separate shard files of the " +
+                    "split, set automatically for each gpu group, see 'merge_annotations.py'.")
     
     return ap
 
+def parse_core_list(cores):
+    #returns the list of cpu cores in a string like '0-3,8,10-11'
+    core_list = []
+    for part in str(cores).split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            core_list += list(range(int(first), int(last) + 1))
+        elif part.strip() != "":
+            core_list.append(int(part))
+    return core_list
+
+def format_core_list(cores):
+    #inverse of 'parse_core_list', consecutive cores are written as ranges
+    cores = sorted(cores)
+    parts = []
+    start = prev = cores[0]
+    for core in cores[1:] + [None]:
+        if core is not None and core == prev + 1:
+            prev = core
+            continue
+        parts.append(f"{start}-{prev}" if start != prev else f"{start}")
+        start = prev = core
+    return ",".join(parts)
+
+def is_cpu_group(group):
+    #cpu device groups are written as 'cpu:{CORES}', e.g. 'cpu:0-7'
+    return len(group) == 1 and group[0].startswith("cpu:")
+
+def get_device_groups(args):
+    #returns the device groups of a multi gpu run: the gpu groups and cpu groups in 'gpu_groups' and
+    #'cpu_workers' cpu groups splitting the cores not used by the other cpu groups
+    groups = [[g] if g.startswith("cpu:") else g.split(",") for g in (args.gpu_groups or [])]
+
+    if args.cpu_workers > 0:
+        used_cores = [core for group in groups if is_cpu_group(group) for core in parse_core_list(group[0][4:])]
+        cores = parse_core_list(args.cpu_cores) if args.cpu_cores is not None else sorted(os.sched_getaffinity(0))
+        cores = [core for core in cores if core not in used_cores]
+        if len(cores) < args.cpu_workers:
+            raise Exception(f"Can't split {len(cores)} cpu cores across {args.cpu_workers} cpu workers")
+        for i in range(args.cpu_workers):
+            worker_cores = cores[i * len(cores) // args.cpu_workers:(i + 1) * len(cores) // args.cpu_workers]
+            groups.append([f"cpu:{format_core_list(worker_cores)}"])
+
+    return groups
+
+def get_group_args(group):
+    #returns the arguments of a worker rendering with a device group
+    if is_cpu_group(group):
+        cores = parse_core_list(group[0][4:])
+        return {
+            "use_devices" : ["CPU"],
+            "device_type" : "CPU",
+            "cpu_cores" : format_core_list(cores),
+            "cpu_threads" : len(cores),
+            "cpu_workers" : 0
+        }
+    return {"use_devices" : group, "device_type" : None, "cpu_cores" : None, "cpu_workers" : 0}
+
+def get_pinning(group):
+    #returns a function pinning a new process to the cores of a cpu group (to be used as 'preexec_fn' of
+    #subprocess.Popen), None for gpu groups
+    if not is_cpu_group(group):
+        return None
+    return get_cores_pinning(group[0][4:])
+
+def get_cores_pinning(cpu_cores):
+    #returns a function pinning a new process to the cores in a string like '0-3,8' (to be used as 'preexec_fn'
+    #of subprocess.Popen), None if cpu_cores is None
+    if cpu_cores is None:
+        return None
+    cores = parse_core_list(cpu_cores)
+    return lambda: os.sched_setaffinity(0, cores)
+
+def is_pinned(cpu_cores):
+    #returns true if the process only runs on the cores in a string like '0-3,8' (always true if cpu_cores is None)
+    return cpu_cores is None or os.sched_getaffinity(0) <= set(parse_core_list(cpu_cores))
+
+def get_split_filename(split, suffix, prefix=None, shard_id=None):
+    #returns the name of a split level output file, e.g. '{prefix}_{split}_shard{shard_id}_annotations.json'
+    shard = f"_shard{shard_id}" if shard_id is not None else ""
+    return f"{prefix + '_' if prefix is not None else ''}{split}{shard}_{suffix}"
+
+def load_run_arguments(parser, argv):
+    # Parses the arguments of a rendering run, applying the configuration file or the checkpoint to resume
+    # Returns (args, rules, checkpoint), checkpoint is None if the run is not resumed
+    from SSHAPE_Dataset_generator.rules_utils import Rules
+    from SSHAPE_Dataset_generator.checkpoint import load_checkpoint
+
+    args = parser.parse_args(argv)
+
+    checkpoint = None
+    rules = None
+
+    if args.resume is not None:
+        checkpoint = load_checkpoint(args.resume)
+        parser.set_defaults(**checkpoint["args"])
+        args = parser.parse_args(argv) #arguments on the command line override the ones of the checkpoint
+        rules = Rules(checkpoint["rules"])
+    elif args.config is not None:
+        #override default values of parser with arguments from configuration file
+        with open(args.config, "r") as f:
+            parser.set_defaults(**json.load(f))
+            args = parser.parse_args(argv)
+
+    assert args.rules is not None, "'rules' argument is not optional"
+    if rules is None:
+        with open(args.rules, "r") as f:
+            rules = Rules(json.load(f))
+
+    assert args.base_scene is not None, "'base_scene' argument is not optional"
+
+    if args.test_mode == 1:
+        args.num_images = 1 #in testing mode only one image will be shown
+
+    return args, rules, checkpoint
+
 def extract_args(input_argv=None):
     """
     Pull out command-line arguments after "--". Blender ignores command-line flags
@@ -137,6 +402,12 @@ def extract_args(input_argv=None):
         output_argv = input_argv[(idx + 1):]
     return output_argv
 
+def get_arg_values(value):
+    #returns the command line values of an argument, lists are passed as multiple values (nargs="+")
+    if isinstance(value, (list, tuple)):
+        return [str(v) for v in value]
+    return [str(value)]
+
 def change_args(args, **kwargs):
     for (arg_name, new_value) in kwargs.items():
         arg_name = f"--{arg_name}"
@@ -150,12 +421,11 @@ def change_args(args, **kwargs):
             else:
                 for arg_end in range(arg_i + 1, len(args) + 1):
                     if arg_end == len(args) or args[arg_end].startswith("--"):
-                        args[arg_i + 1] = str(new_value)
-                        if arg_i + 2 < arg_end:
-                            del args[arg_i + 2:arg_end]
+                        args[arg_i + 1:arg_end] = get_arg_values(new_value)
                         break
         except ValueError:
-            args += [arg_name, str(new_value)]
+            if new_value is not None:
+                args += [arg_name] + get_arg_values(new_value)
 
     return args
 
@@ -177,7 +447,7 @@ def divide_workloads(times, num_images):
             lower_limit,
             upper_limit
         ])
-        lower_limit = upper_limit + 1
+        lower_limit = upper_limit #ranges are [start, stop)
 
     ranges[-1][1] = num_images
     return ranges
@@ -241,19 +511,21 @@ def check_rule(rule, defaults, rule_name, macros):
         in_use_uniques.append(element_uniques)
 
 def intersect(list1, list2):
-    return list(set(list1) & set(list2))
+    #keeps the order of list1, so random choices on the result are reproducible
+    set2 = set(list2)
+    return [k for k in list1 if k in set2]
 
 def rotate(obj, angle):
     #rotates blender object, rotation is absolute and expressed in degrees
     obj.rotation_euler = (radians(angle[0]), radians(angle[1]), radians(angle[2]))
     
-def randrange_float(min, max, step):
+def randrange_float(min, max, step, rng=random):
     #similar to random.randrange() but works with floating point values
     range = [min]
     while range[-1] < max:
         range.append(range[-1] + step)
     
-    return random.choice(range)
+    return rng.choice(range)
 
 def get_random_scaling_factors(amount, min, max, step, max_delta=None):
     factors = []
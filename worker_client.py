@@ -0,0 +1,71 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json, socket
+
+def send_request(socket_path: str, request: dict, timeout: float = None) -> dict:
+    # Sends a request to a worker daemon (see 'worker_daemon.py') and waits for its response
+    # Args:
+    # - socket_path (str): path of the Unix socket of the daemon
+    # - request (dict): request to send
+    # - timeout (float): maximum number of seconds to wait, None to wait until the job is done
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path)
+        with client.makefile("rw") as stream:
+            stream.write(json.dumps(request) + "\n")
+            stream.flush()
+            line = stream.readline()
+    if line == "":
+        raise Exception("The worker daemon closed the connection without responding")
+    return json.loads(line)
+
+def render(socket_path: str, argv: list, timeout: float = None) -> dict:
+    # Renders a job, argv are the same arguments of 'create_dataset.py'
+    return send_request(socket_path, {"command" : "render", "args" : argv}, timeout)
+
+if __name__ == "__main__":
+    #Sends a job to a worker daemon
+    #Usage: python worker_client.py --socket {SOCKET PATH} [--status | --shutdown] -- {ARGUMENTS}
+    import argparse, sys
+
+    argv = sys.argv[1:]
+    job_argv = []
+    if "--" in argv:
+        job_argv = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--socket", default="/tmp/sshape_worker.sock",
+                    help="Path of the Unix socket of the worker daemon.")
+    ap.add_argument("--status", action="store_true",
+                    help="Print the status of the daemon.")
+    ap.add_argument("--shutdown", action="store_true",
+                    help="Stop the daemon.")
+    args = ap.parse_args(argv)
+
+    if args.status:
+        response = send_request(args.socket, {"command" : "status"})
+    elif args.shutdown:
+        response = send_request(args.socket, {"command" : "shutdown"})
+    else:
+        response = render(args.socket, job_argv)
+    print(json.dumps(response, indent=4))
+    if response["status"] == "error":
+        sys.exit(1)
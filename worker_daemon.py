@@ -0,0 +1,152 @@
+"""
+Copyright 2024-present, Matteo Bicchi
+All rights reserved
+
+
+This file is part of SSHAPE_Dataset_generator.
+
+SSHAPE_Dataset_generator is free software: you can redistribute it and/or modify it under the terms of the 
+GNU General Public License as published by the Free Software Foundation, either version 3 of the 
+License, or any later version.
+
+SSHAPE_Dataset_generator is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General 
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along with SSHAPE_Dataset_generator. 
+If not, see <https://www.gnu.org/licenses/>.
+
+-------------------------------------------------------------------------------------------------------------------
+
+Worker daemon
+
+Keeps one blender process running and renders the jobs sent to it through a Unix socket, the base scene,
+the materials and the shape caches are loaded only once and reused by every following job with compatible
+arguments (see 'render.WARM_ARGS'), a job with different ones reloads them.
+
+Usage:
+
+    blender -b --python worker_daemon.py -- --socket {SOCKET PATH}
+    python worker_client.py --socket {SOCKET PATH} -- --config {PATH TO CONFIG} --split val --num_images 100
+
+Protocol: the client sends one JSON line and receives one JSON line when the job is done
+- {"args" : [...]}: renders a job, 'args' are the same command line arguments of 'create_dataset.py'
+                     (e.g. a different split, start index or number of images)
+- {"command" : "status"}: returns the number of jobs done and whether the renderer is loaded
+- {"command" : "shutdown"}: stops the daemon
+"""
+
+from SSHAPE_Dataset_generator.utils import setup_argparser, extract_args, load_run_arguments
+from SSHAPE_Dataset_generator.render import DatasetRenderer
+import bpy #type:ignore
+from bpy import context #type:ignore
+import os, pathlib, json, socket, signal, sys, time, argparse
+
+class WorkerDaemon:
+    # Renders the jobs received on a Unix socket, one at a time, keeping the renderer between jobs
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self.renderer = None
+        self.jobs_done = 0
+        self.run = True
+
+    def stop(self, sig, frm):
+        #stops the current job (its checkpoint is saved) and the daemon
+        print("Stopping worker daemon.")
+        self.run = False
+        if self.renderer is not None:
+            self.renderer.stop(sig, frm)
+
+    def render_job(self, argv: list) -> dict:
+        # Renders a job, reusing the current renderer if possible
+        # Args:
+        # - argv (list): command line arguments of the job
+        start_time = time.time()
+        args, rules, checkpoint = load_run_arguments(setup_argparser(), argv)
+        if args.use_multiple_gpus == 1:
+            raise Exception("Multi gpu jobs are not supported, start one daemon for each gpu group")
+
+        warm = self.renderer is not None and self.renderer.is_compatible(args, rules)
+        if warm:
+            self.renderer.reset(args, checkpoint)
+        else:
+            self.renderer = None
+            bpy.ops.wm.open_mainfile(filepath=args.base_scene)
+            window = context.window_manager.windows[0]
+            with context.temp_override(window=window):
+                self.renderer = DatasetRenderer(args, rules, checkpoint=checkpoint)
+        setup_time = time.time() - start_time
+
+        window = context.window_manager.windows[0]
+        with context.temp_override(window=window):
+            try:
+                self.renderer.render()
+            finally:
+                self.renderer.release_job()
+        self.jobs_done += 1
+
+        return {
+            "status" : "done" if self.renderer.run else "interrupted",
+            "warm" : warm,
+            "setup_time" : setup_time,
+            "time" : time.time() - start_time
+        }
+
+    def handle(self, request: dict) -> dict:
+        command = request.get("command", "render")
+        if command == "status":
+            return {"status" : "ok", "jobs_done" : self.jobs_done, "loaded" : self.renderer is not None}
+        if command == "shutdown":
+            self.run = False
+            return {"status" : "ok"}
+        if command == "render":
+            return self.render_job(request["args"])
+        raise Exception(f"Unknown command: {command}")
+
+    def serve(self):
+        # Serves one client at a time until the daemon is stopped
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(1)
+        server.settimeout(1) #to check if the daemon has been stopped
+        print(f"Worker daemon listening on: {self.socket_path}")
+
+        try:
+            while self.run:
+                try:
+                    connection, _ = server.accept()
+                except socket.timeout:
+                    continue
+
+                with connection, connection.makefile("rw") as stream:
+                    try:
+                        response = self.handle(json.loads(stream.readline()))
+                    except Exception as e:
+                        print(e)
+                        response = {"status" : "error", "error" : str(e)}
+                    try:
+                        stream.write(json.dumps(response) + "\n")
+                        stream.flush()
+                    except OSError: #the client is gone, the job is done anyway
+                        pass
+        finally:
+            server.close()
+            os.remove(self.socket_path)
+
+if __name__ == "__main__":
+    sys.stdout = sys.stderr
+    PATH = pathlib.Path(__file__).parent.resolve()
+    os.chdir(PATH)
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--socket", default="/tmp/sshape_worker.sock",
+                    help="Path of the Unix socket on which jobs are received.")
+    daemon_args = ap.parse_args(extract_args())
+
+    daemon = WorkerDaemon(os.path.abspath(daemon_args.socket))
+    signal.signal(signal.SIGINT, daemon.stop)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    daemon.serve()